@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime
+from json import dumps
+from random import Random
+from shutil import rmtree
+from statistics import median
+from subprocess import PIPE, run
+from tempfile import mkdtemp
+from time import perf_counter
+import os
+import platform
+
+import dotfiles
+
+""" Usage
+./benchmark.py                                  # Default synthetic repo, bench.json
+./benchmark.py --files 5000 --envs 4 --depth 3  # 20k dotfiles nested 3 dirs deep
+./benchmark.py -o before.json && git checkout other && ./benchmark.py -o after.json
+"""
+
+
+def parse_arguments():
+    """ Parse all the arguments from the CLI.
+
+    Returns:
+        args (argsparse.Namespace): args object. To access values I.E: args.files"""
+
+    description = "Times each phase of dotfiles.py against a synthetic repository"
+    parser = ArgumentParser(description=description)
+
+    parser.add_argument("--envs", type=int, default=3, help="Number of environments")
+    parser.add_argument("--files", type=int, default=1000,
+                        help="Number of dotfiles per environment")
+    parser.add_argument("--depth", type=int, default=2,
+                        help="Maximum nesting depth of the dotfiles in each env")
+    parser.add_argument("--binary", type=float, default=0.05,
+                        help="Fraction of binary dotfiles")
+    parser.add_argument("--custom-targets", type=float, default=0.3,
+                        help="Fraction of dotfiles with a TARGET= header")
+    parser.add_argument("--ignore-rules", type=int, default=20,
+                        help="Number of entries in the .dotignore file")
+    parser.add_argument("--junk", type=int, default=2000,
+                        help="Number of files in excluded (vendored) dirs per env")
+    parser.add_argument("--links", type=str, default="0.6,0.2,0.2",
+                        metavar="CORRECT,WRONG,MISSING",
+                        help="Fractions of targets correctly linked, wrongly linked "
+                        "and missing in the fake home")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of times each phase is timed")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generator")
+    parser.add_argument("--keep", action="store_true", default=False,
+                        help="Keep the synthetic repo and home once finished")
+    parser.add_argument("--output", "-o", type=str, default="bench.json",
+                        help="The file the results are written to (Default: bench.json)")
+    return parser.parse_args()
+
+
+def generate_repo(base_dir, args):
+    """Creates a synthetic dotfiles repository and a fake home with a mix of correct,
+    wrong and missing symlinks.
+
+    Args:
+        base_dir (str): Directory where repo/ and home/ are created
+        args (argsparse.Namespace): The generator parameters
+
+    Returns:
+        repo_dir, home_dir (tuple): The paths of the repo and of the fake home"""
+
+    rng = Random(args.seed)
+    repo_dir = os.path.join(base_dir, "repo")
+    home_dir = os.path.join(base_dir, "home")
+    os.makedirs(home_dir)
+
+    rules = [".git/", "vendor/", "*.swp", "/env0/.excluded"]
+    rules += [f".ignored_{index}" for index in range(args.ignore_rules - len(rules))]
+    os.makedirs(repo_dir)
+    with open(os.path.join(repo_dir, ".dotignore"), "w") as f:
+        f.write("\n".join(rules[:max(args.ignore_rules, 1)]) + "\n")
+
+    correct, wrong, _ = (float(value) for value in args.links.split(","))
+    locations = []
+    for env_index in range(args.envs):
+        env_dir = os.path.join(repo_dir, f"env{env_index}")
+        for file_index in range(args.files):
+            depth = rng.randint(0, args.depth)
+            sub_dirs = [f"d{rng.randint(0, 9)}" for _ in range(depth)]
+            file_dir = os.path.join(env_dir, *sub_dirs)
+            os.makedirs(file_dir, exist_ok=True)
+            name = f".e{env_index}_f{file_index}"
+            location = os.path.join(file_dir, name)
+            draw = rng.random()
+            if draw < args.binary:
+                with open(location, "wb") as f:
+                    f.write(bytes(rng.getrandbits(8) for _ in range(4096)))
+                target = f"~/{name}"
+            else:
+                if draw < args.binary + args.custom_targets:
+                    target = f"~/.config/e{env_index}/{'/'.join(sub_dirs)}/{name}"
+                    header = f"# TARGET={target}\n"
+                else:
+                    target = f"~/{name}"
+                    header = "# Synthetic dotfile\n"
+                with open(location, "w") as f:
+                    f.write(header + "export SYNTHETIC=1\n" * 20)
+            locations.append((os.path.realpath(location), target))
+
+        vendor_dir = os.path.join(env_dir, "vendor", "plugin")
+        os.makedirs(vendor_dir)
+        for junk_index in range(args.junk):
+            open(os.path.join(vendor_dir, f".junk{junk_index}"), "w").close()
+
+    for location, target in locations:
+        path = target.replace("~", home_dir, 1)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        draw = rng.random()
+        if draw < correct:
+            os.symlink(location, path)
+        elif draw < correct + wrong:
+            os.symlink(rng.choice(locations)[0], path)
+    return repo_dir, home_dir
+
+
+def time_phase(phase, repeat, setup=None):
+    """Runs phase() repeat times and returns its timings and last result.
+
+    Args:
+        phase (function): The phase to time
+        repeat (int): Number of times the phase is run
+        setup (function): Called before each run, outside of the timing
+
+    Returns:
+        timings, result (tuple): The wall time of each run in seconds and the result of
+        the last run"""
+
+    timings = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            result = phase()
+        timings.append(perf_counter() - start)
+    return timings, result
+
+
+def clear_stat_cache():
+    """Forgets every target stat so each run verifies the targets from scratch."""
+
+    dotfiles.forget_filesystem()
+
+
+def run_benchmark(args, repo_dir):
+    """Times each phase of dotfiles.py against the synthetic repo.
+
+    Args:
+        args (argsparse.Namespace): The benchmark parameters
+        repo_dir (str): The synthetic repository
+
+    Returns:
+        phases, counts (tuple): {phase: [timings]} and the size of the inventory"""
+
+    repeat = args.repeat
+    phases = {}
+    phases["get_exclusions"], exclusions = time_phase(dotfiles.get_exclusions, repeat)
+    phases["compile_exclusions"], is_excluded = time_phase(
+        lambda: dotfiles.compile_exclusions(exclusions), repeat)
+    phases["get_envs"], environments = time_phase(
+        lambda: sorted(dotfiles.get_envs(is_excluded)), repeat)
+    phases["scan_dotfiles"], records = time_phase(
+        lambda: dotfiles.scan_dotfiles(environments, is_excluded), repeat)
+    phases["get_files_targets (cold)"], files_targets = time_phase(
+        lambda: dotfiles.get_files_targets(records, cache=None), repeat)
+    cache = {}
+    dotfiles.get_files_targets(records, cache=cache)
+    phases["get_files_targets (cached)"], _ = time_phase(
+        lambda: dotfiles.get_files_targets(records, cache=cache), repeat)
+
+    phases["Inventory"], inventory = time_phase(
+        lambda: dotfiles.Inventory(records, files_targets), repeat)
+    files_envs = inventory.envs
+    files_locations = inventory.locations
+    phases["get_nonexistent_targets"], _ = time_phase(
+        lambda: dotfiles.get_nonexistent_targets(files_locations, files_targets),
+        repeat, setup=clear_stat_cache)
+    phases["select_dotfiles"], filtered_dotfiles = time_phase(
+        lambda: dotfiles.select_dotfiles(inventory, environments), repeat)
+    phases["check_symlinks"], erroneous_symlinks = time_phase(
+        lambda: dotfiles.check_symlinks(filtered_dotfiles), repeat,
+        setup=clear_stat_cache)
+
+    table_data = dotfiles.create_row_tables(files_locations, files_targets, files_envs)
+    phases["print_table"], _ = time_phase(
+        lambda: dotfiles.print_table(table_data, files_envs), repeat)
+    json_file = os.path.join(os.path.dirname(repo_dir), "db.json")
+    phases["table_to_json_file"], _ = time_phase(
+        lambda: dotfiles.table_to_json_file(table_data, environments, json_file), repeat)
+
+    counts = {"envs": len(environments), "dotfiles": len(records),
+              "erroneous_symlinks": len(erroneous_symlinks)}
+    return phases, counts
+
+
+def git_commit():
+    """Returns the commit of the dotfiles.py being benchmarked, if known."""
+
+    result = run(["git", "rev-parse", "HEAD"], stdout=PIPE, stderr=PIPE,
+                 universal_newlines=True,
+                 cwd=os.path.dirname(os.path.abspath(dotfiles.__file__)))
+    return result.stdout.strip() or None
+
+
+def main():
+
+    args = parse_arguments()
+    base_dir = mkdtemp(prefix="dotfiles-bench-")
+    output = os.path.abspath(args.output)
+    cwd = os.getcwd()
+    try:
+        repo_dir, home_dir = generate_repo(base_dir, args)
+        os.environ["HOME"] = home_dir
+        os.chdir(repo_dir)
+        phases, counts = run_benchmark(args, repo_dir)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Synthetic repo kept at {base_dir}")
+        else:
+            rmtree(base_dir)
+
+    results = {
+        "version": 1,
+        "created": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": vars(args),
+        "counts": counts,
+        "phases": {name: {"min": min(timings), "median": median(timings),
+                          "runs": timings} for name, timings in phases.items()},
+    }
+    with open(output, "w") as f:
+        f.write(dumps(results, indent=4))
+
+    print(f"{counts['dotfiles']} dotfiles in {counts['envs']} envs, "
+          f"{counts['erroneous_symlinks']} erroneous symlinks")
+    for name, result in results["phases"].items():
+        print(f"{name:<30} min {result['min'] * 1000:9.2f} ms   "
+              f"median {result['median'] * 1000:9.2f} ms")
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
-from datetime import date
-from getpass import getuser
-from itertools import cycle
-from json import dumps
+from collections import Counter, deque, namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache, wraps
+from hashlib import sha1, sha256
+from io import BytesIO
+from itertools import chain, cycle, islice
+from json import dumps, loads
 from pathlib import Path
-from pprint import pprint
-from random import choice
-from shutil import copy
-from sys import exit
-from termcolor import colored
-from terminaltables import AsciiTable
+from stat import S_IMODE, S_ISDIR, S_ISLNK, S_ISREG
+from sys import exit, stderr, stdin, stdout
+from threading import Lock, RLock, get_ident
+from time import perf_counter, sleep
+import builtins
 import logging
+import os
+import re
 
 """
 Logging Structure
@@ -29,10 +33,118 @@ Define a function to setup logging to DEBUG when passed a parameter form the CLI
 """
 
 
-ERROR_PREFIX = colored('ERROR:', 'red')
-WARNING_PREFIX = colored('WARNING:', 'cyan')
-SUCCESS_PREFIX = colored('SUCCESS:', 'green')
 HEADERS = ["ID", "NAME", "LOCATION", "TARGET", "ENV"]
+CACHE_FILE = ".dotcache"
+CACHE_VERSION = 4
+JOURNAL_FILE = ".dotjournal"
+DEPLOY_STATE_FILE = ".dotdeployed"
+DEPLOY_MODES = ("symlink", "hardlink", "reflink", "copy")
+DEPLOY_VERBS = {"symlink": "symlink", "hardlink": "hardlinked", "reflink": "reflinked",
+                "copy": "copied"}
+BACKUP_DIR = ".dotbackups"
+BACKUP_RETENTION_DAYS = 90
+BUNDLE_DIR = "~/.dotfiles-bundle"
+BUNDLE_MANIFEST = "manifest.json"
+BUNDLE_VERSION = 1
+RENDER_DIR = ".rendered"
+RENDER_CACHE_FILE = ".rendercache"
+TEMPLATE_SUFFIX = ".tmpl"
+COMPILE_DIR = ".compiled"
+COMPILE_CACHE_FILE = ".compilecache"
+# The directories written by the script in the repo, never scanned even when the
+# .dotignore of the repo doesn't list them
+STATE_EXCLUSIONS = [f"/{BACKUP_DIR}/", f"/{RENDER_DIR}/", f"/{COMPILE_DIR}/"]
+# Dotfiles sourced by the shells, which --compile merges into a single init file
+SHELL_INIT_NAMES = {".profile", ".bashrc", ".bash_profile", ".bash_login", ".bash_aliases",
+                    ".zshenv", ".zprofile", ".zshrc", ".zlogin", ".aliases", ".exports",
+                    ".functions"}
+SHELL_INIT_SUFFIXES = (".sh", ".bash", ".zsh")
+SHELL_TEST = r"(?:\[\[?|test)\s+-[efr]\s+(?P<guard>[^\s\]]+)\s*\]?\]?"
+SHELL_SOURCE = re.compile(rf"^\s*(?:{SHELL_TEST}\s*&&\s*)?(?:source|\.)\s+(?P<path>[^\s;]+)"
+                          r"\s*;?\s*$")
+SHELL_IF_GUARD = re.compile(rf"^\s*if\s+{SHELL_TEST}\s*;\s*then\s*$")
+SHELL_HEREDOC = re.compile(r"<<(-?)\s*(['\"]?)\\?([A-Za-z_]\w*)\2")
+TEMPLATE_TAG = re.compile(r"{{\s*(\w+)\s*}}|(?:^[ \t]*)?{%\s*(\w+)(.*?)%}(?:[ \t]*\n)?",
+                          re.MULTILINE)
+PLAN_VERSION = 1
+HEADER_SIZE = 512
+TABLE_SAMPLE_ROWS = 256
+EXPORT_VERSION = 2
+DIGEST_CHUNK_SIZE = 1024 * 1024
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+WATCH_INTERVAL = 1.0
+PROFILE_INTERVAL = 0.001
+TRACE_BUFFER_SIZE = 256
+WATCH_DEBOUNCE = 0.05
+
+# ioctl_ficlone(2) request used to reflink the backups
+FICLONE = 0x40049409
+
+# inotify(7) flags used by --watch
+IN_CLOEXEC = 0o2000000
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                IN_DELETE)
+INOTIFY_EVENT_SIZE = 16  # struct.calcsize("iIII"), the event without its name
+
+_LSTAT_CACHE = {}
+_DIGEST_CACHE = {}
+_DISCOVERY_CACHE = {}
+_DEPLOYED = {"key": None, "entries": {}}
+_SCRATCH = {"dir": None}
+_TOUCHED = set()
+_SHARED_INVENTORY = None
+_BACKUP_INDEX_LOCK = Lock()
+_UNFOLD_LOCK = Lock()
+_TRACE = {"buffer": deque(maxlen=TRACE_BUFFER_SIZE), "file": None, "debug": False,
+          "lock": Lock(), "started": perf_counter()}
+_PROFILE = {"enabled": False, "stages": {}, "fs_ops": Counter(), "lock": Lock()}
+
+Dotfile = namedtuple("Dotfile", ["env", "location", "name"])
+InventoryRecord = namedtuple("InventoryRecord", ["env", "location", "name", "target"])
+
+
+class DotfilesError(Exception):
+    """A dotfile or a plan which cannot be used, printed by the CLI as an ERROR."""
+
+
+def colored(text, color=None, on_color=None, attrs=None):
+    """termcolor.colored() imported on first use, so runs which print nothing colored
+    (I.E --check) never pay for importing it. Without termcolor (I.E a host bootstrapped
+    with --install-bundle) the text is returned uncolored."""
+
+    try:
+        from termcolor import colored as termcolor_colored
+    except ImportError:
+        return text
+    return termcolor_colored(text, color, on_color, attrs)
+
+
+class ColoredPrefix:
+    """A message prefix which is only colored when it is printed."""
+
+    def __init__(self, text, color):
+        self.text = text
+        self.color = color
+
+    def __str__(self):
+        return colored(self.text, self.color)
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+
+ERROR_PREFIX = ColoredPrefix('ERROR:', 'red')
+WARNING_PREFIX = ColoredPrefix('WARNING:', 'cyan')
+SUCCESS_PREFIX = ColoredPrefix('SUCCESS:', 'green')
 
 
 def parse_arguments():
@@ -48,20 +160,141 @@ def parse_arguments():
                         help="Choose your environment")
     parser.add_argument("--print", "-p", action='store_true', default=True,
                         help="To print the dotfiles DB")
+    parser.add_argument("--format", "-f", choices=["table", "tsv", "ndjson"],
+                        default="table", help="Format of the dotfiles DB (Default: table)")
+    parser.add_argument("--no-color", action='store_true', default=False,
+                        help="Disable colored output")
     parser.add_argument("--json", "-j", nargs="?", const="db.json", type=str,
                         help="The DB will be saved in <filename.json> or db.json (Default)")
+    parser.add_argument("--since", nargs="?", const=True, type=str,
+                        metavar="db.json", help="Only hash and rewrite the --json entries "
+                        "changed since a previous export (Default: the --json file)")
     parser.add_argument("--debug", "-d", action='store_true', default=False,
                         help="This option enables debug mode")
+    parser.add_argument("--trace", type=str, metavar="trace.jsonl",
+                        help="Write a structured trace of the run to a JSON lines file")
+    parser.add_argument("--workers", "-w", type=int, default=DEFAULT_WORKERS,
+                        metavar="N", help="Number of workers used to read the dotfiles "
+                        f"(Default: {DEFAULT_WORKERS})")
+    parser.add_argument("--root", "-r", nargs='+', type=str,
+                        metavar="/home/user @roots.txt",
+                        help="Link the dotfiles under each root instead of your home dir."
+                        " @file reads the roots from a file, one per line")
+    parser.add_argument("--plan", type=str, metavar="plan.json",
+                        help="Write the changes needed by --env to a plan file "
+                        "instead of applying them")
+    parser.add_argument("--apply", type=str, metavar="plan.json",
+                        help="Apply a plan file created by --plan non-interactively")
+    parser.add_argument("--watch", action='store_true', default=False,
+                        help="Keep running and fix the symlinks of --env as soon as the "
+                        "dotfiles change")
+    parser.add_argument("--check", action='store_true', default=False,
+                        help="Only check if the symlinks of --env (Default: all envs) are "
+                        "in sync: prints a one line summary and exits with 1 on drift")
+    parser.add_argument("--diff", action='store_true', default=False,
+                        help="Show how the targets of --env (Default: all envs) that are "
+                        "regular files differ from their dotfiles and exit with 1 if any "
+                        "does, without changing anything")
+    parser.add_argument("--compile", action='store_true', default=False,
+                        help=f"Link the shell dotfiles of --env (.bashrc, .zshrc, *.sh...) "
+                        f"to compiled copies in {COMPILE_DIR}, without comments and with "
+                        "the dotfiles they source inlined")
+    parser.add_argument("--fold", action='store_true', default=False,
+                        help="Link a whole directory with a single symlink when all its "
+                        "dotfiles come from the same directory of an env (like GNU Stow)")
+    parser.add_argument("--var", action="append", type=str, metavar="NAME=VALUE",
+                        help="Set a variable used by the .tmpl templates, I.E --var "
+                        "work=1. Can be repeated")
+    parser.add_argument("--rollback", action='store_true', default=False,
+                        help="Undo the symlink changes made by the last run")
+    parser.add_argument("--backups", nargs="?", const=True, type=str, metavar="~/.vimrc",
+                        help=f"List the backups in {BACKUP_DIR}, optionally of a target")
+    parser.add_argument("--restore", nargs="+", type=str, metavar=("~/.vimrc", "TIME"),
+                        help="Restore the latest backup of a target or the latest one "
+                        "made at TIME, I.E 2020-10-10 or 2020-10-10T14:01")
+    parser.add_argument("--gc", nargs="?", const=BACKUP_RETENTION_DAYS, type=int,
+                        metavar="DAYS", help="Remove the backups older than DAYS, except "
+                        f"the latest of each target (Default: {BACKUP_RETENTION_DAYS})")
+    parser.add_argument("--export-bundle", type=str, metavar="bundle.tar.gz",
+                        help="Write the dotfiles of --env (Default: all envs) and their "
+                        "targets to a compressed bundle, - for stdout")
+    parser.add_argument("--install-bundle", type=str, metavar="bundle.tar.gz",
+                        help=f"Extract a bundle to {BUNDLE_DIR} and link all its targets "
+                        "without scanning any repo, - for stdin")
+    parser.add_argument("--profile", action='store_true', default=False,
+                        help="Print the time spent on each stage, the filesystem "
+                        "operations and the peak memory once finished")
+    parser.add_argument("--profile-json", type=str, metavar="profile.json",
+                        help="Also write the --profile report to a JSON file")
+    parser.add_argument("--profile-samples", type=str, metavar="stacks.txt",
+                        help="Sample the stack while running and write the samples in "
+                        "the collapsed format used by flamegraph tools")
+    parser.add_argument("--discovery", choices=["scan", "git"], default="scan",
+                        help="Find the dotfiles by scanning the envs (Default) or from the "
+                        "git index, which is skipped when HEAD and the index are unchanged")
+    parser.add_argument("--untracked", action='store_true', default=False,
+                        help="With --discovery git, also find the untracked dotfiles not "
+                        "ignored by git")
+    parser.add_argument("--deploy", action="append", type=str, metavar="[ENV=]MODE",
+                        help=f"Deploy the dotfiles of ENV (Default: all envs) as a "
+                        f"{', '.join(DEPLOY_MODES)} instead of a symlink. A DEPLOY=MODE "
+                        "header next to TARGET= overrides it for a single dotfile")
+    parser.add_argument("--no-cache", action='store_true', default=False,
+                        help=f"Ignore and do not update the {CACHE_FILE} inventory cache")
     args = parser.parse_args()
+    if args.plan and not args.env:
+        parser.error("--plan requires --env")
+    if args.watch and not args.env:
+        parser.error("--watch requires --env")
+    if args.watch and (args.root or args.fold or args.compile or args.discovery != "scan"):
+        parser.error("--watch can't be combined with --root, --fold, --compile or "
+                     "--discovery git")
+    if args.since and not args.json:
+        parser.error("--since requires --json")
+    try:
+        args.var = dict(variable.split("=", 1) for variable in args.var or [])
+    except ValueError:
+        parser.error("--var expects NAME=VALUE")
+    try:
+        args.deploy = parse_deploy_modes(args.deploy or [])
+    except ValueError as err:
+        parser.error(f"--deploy: {err}")
+    if args.restore and len(args.restore) > 2:
+        parser.error("--restore takes a target and optionally a TIME")
+    if args.root:
+        try:
+            args.root = get_roots(args.root)
+        except OSError as err:
+            parser.error(f"--root: {err}")
     return args
 
 
-def conf_logging(debug):
+def parse_deploy_modes(values):
+    """Parses the values passed to --deploy.
+
+    Args:
+        values (list): I.E ["copy", "work=hardlink"]
+
+    Returns:
+        env_modes (dict): {env: mode} where the env None applies to all the envs"""
+
+    env_modes = {}
+    for value in values:
+        env, _, mode = value.rpartition("=")
+        if mode not in DEPLOY_MODES:
+            raise ValueError(f"unknown mode {mode}, expected one of "
+                             f"{', '.join(DEPLOY_MODES)}")
+        env_modes[env or None] = mode
+    return env_modes
+
+
+def conf_logging(debug, trace_file=None):
     """Configures the logger and expects --debug to be passed to override the default
     warning level.
     
     Args:
         debug (bool): To define the debug level, if false (warning), if True(debug)
+        trace_file (str): Also write every trace() event to this file as JSON lines
 
     Returns:
         logger (logging.Logger): The logger object"""
@@ -69,7 +302,6 @@ def conf_logging(debug):
     log_sev = 'WARNING'
     if debug is True:
         log_sev = 'DEBUG'
-    print(debug)
     log_format = '[%(name)s]-[%(levelname)s]-%(asctime)s-[%(funcName)s]-%(message)s'
     datefmt='[%d/%m/%y]-[%H:%M:%S]'
     file='dotfiles.log'
@@ -77,186 +309,1410 @@ def conf_logging(debug):
     # File Handler
     logging.basicConfig(format=log_format, datefmt=datefmt, filename=file, level=log_sev,
         filemode="w")
+    logging.getLogger().addHandler(TraceDumpHandler())
+    _TRACE["debug"] = debug
+    if trace_file:
+        _TRACE["file"] = open(trace_file, "w", buffering=1)
     logger = logging.getLogger(__name__)
     return logger
 
 
-def get_exclusions():
+def trace(event, **fields):
+    """Records a structured debug event, I.E trace("cache_saved", entries=10).
+
+    The event is kept as it is, without formatting its fields, in a ring buffer of the
+    last TRACE_BUFFER_SIZE events which is only written to the log when an error is
+    logged. The fields are only formatted when --debug or --trace are enabled.
+
+    Args:
+        event (str): The name of the event
+        fields: The data of the event
+
+    Returns:
+        None"""
+
+    record = (perf_counter() - _TRACE["started"], event, fields)
+    _TRACE["buffer"].append(record)
+    if _TRACE["file"] is not None:
+        line = dumps({"t": round(record[0], 6), "event": event, **fields}, default=str)
+        with _TRACE["lock"]:
+            _TRACE["file"].write(line + "\n")
+    if _TRACE["debug"]:
+        logging.debug("%s", format_trace(record))
+
+
+def format_trace(record):
+    """Formats a trace record as: 0.001234s event field=value ..."""
+
+    seconds, event, fields = record
+    values = " ".join(f"{name}={value!r}" for name, value in fields.items())
+    return f"{seconds:.6f}s {event} {values}"
+
+
+class TraceDumpHandler(logging.Handler):
+    """Writes the events of the trace ring buffer to the log the first time an error
+    is logged, so the log explains what led to the error even without --debug."""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.dumped = False
+
+    def emit(self, record):
+        if self.dumped or _TRACE["debug"]:
+            return
+        self.dumped = True
+        trace_logger = logging.getLogger("trace")
+        trace_logger.warning("Last %d trace events before the error:", len(_TRACE["buffer"]))
+        for trace_record in list(_TRACE["buffer"]):
+            trace_logger.warning("%s", format_trace(trace_record))
+
+
+def profiled(function):
+    """Decorator recording the wall time and number of calls of a pipeline stage when
+    --profile is enabled. When it is not, the stage is called straight away."""
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _PROFILE["enabled"]:
+            return function(*args, **kwargs)
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stage = _PROFILE["stages"].setdefault(function.__name__, [0, 0.0])
+            stage[0] += 1
+            stage[1] += perf_counter() - start
+    return wrapper
+
+
+def count_fs_calls(module, name, counter):
+    """Replaces module.name by a wrapper which counts its calls in counter."""
+
+    function = getattr(module, name)
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with _PROFILE["lock"]:
+            _PROFILE["fs_ops"][counter] += 1
+        return function(*args, **kwargs)
+    setattr(module, name, wrapper)
+
+
+def start_profiling(json_file=None, samples_file=None, interval=PROFILE_INTERVAL):
+    """Enables --profile: stage timings, filesystem operation counts and peak memory
+    are reported when the script exits.
+
+    Args:
+        json_file (str): Also write the report as JSON to this file
+        samples_file (str): Sample the stack every interval seconds and write the
+        samples to this file in the collapsed format used by flamegraph tools
+        interval (float): Seconds between two samples
+
+    Returns:
+        None"""
+
+    import atexit
+    import signal
+
+    _PROFILE.update(enabled=True, started=perf_counter(), fs_ops=Counter())
+    for name, counter in (("stat", "stat"), ("lstat", "stat"), ("open", "open"),
+                          ("readlink", "readlink"), ("symlink", "symlink"),
+                          ("scandir", "scandir"), ("replace", "replace"),
+                          ("unlink", "unlink")):
+        count_fs_calls(os, name, counter)
+    count_fs_calls(builtins, "open", "open")
+
+    if samples_file:
+        samples = Counter()
+
+        def sample(signum, frame):
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({Path(frame.f_code.co_filename).name})")
+                frame = frame.f_back
+            samples[";".join(reversed(stack))] += 1
+
+        signal.signal(signal.SIGPROF, sample)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        _PROFILE["samples"] = (samples, samples_file)
+    atexit.register(print_profile_report, json_file)
+
+
+def profile_report():
+    """Returns the --profile report as a dict."""
+
+    try:
+        import resource
+        peak_memory_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        peak_memory_kb = None
+    return {
+        "wall_seconds": perf_counter() - _PROFILE["started"],
+        "stages": {name: {"calls": calls, "seconds": seconds}
+                   for name, (calls, seconds) in _PROFILE["stages"].items()},
+        "fs_ops": dict(_PROFILE["fs_ops"]),
+        "peak_memory_kb": peak_memory_kb,
+    }
+
+
+def print_profile_report(json_file=None):
+    """Prints the --profile report and writes it to json_file if passed.
+
+    Args:
+        json_file (str): The file the report is written to as JSON or None
+
+    Returns:
+        None"""
+
+    import signal
+
+    report = profile_report()
+    if _PROFILE.get("samples"):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        samples, samples_file = _PROFILE["samples"]
+        with open(samples_file, "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in samples.items())
+        report["samples_file"] = samples_file
+
+    print(f"\nPROFILE: {report['wall_seconds'] * 1000:.1f} ms total (stage times "
+          f"include the stages they call)")
+    rows = [["STAGE", "CALLS", "MS"]]
+    rows += [[name, str(stage["calls"]), f"{stage['seconds'] * 1000:.2f}"] for name, stage
+             in sorted(report["stages"].items(), key=lambda item: -item[1]["seconds"])]
+    rows += [["FS OP", "CALLS", ""]]
+    rows += [[name, str(calls), ""] for name, calls in sorted(report["fs_ops"].items())]
+    print(render_table(rows))
+    if report["peak_memory_kb"] is not None:
+        print(f"Peak memory: {report['peak_memory_kb'] / 1024:.1f} MB")
+    if json_file:
+        with open(json_file, "w") as f:
+            f.write(dumps(report, indent=4))
+        print(f'The profile has been written to "{Path(json_file).absolute()}"')
+
+
+@profiled
+def get_exclusions(repo="."):
     """ Reads the .gitignore file and returns a list of files/dirs to be excluded
+
+    Args:
+        repo (str): The dotfiles repo (Default: the current dir)
     
     Returns:
-        exclusions (list): With all the file/folders to be excluded in this script"""
+        exclusions (list): With all the file/folders to be excluded in this script,
+        followed by the STATE_EXCLUSIONS so they can't be included again"""
 
-    dotignore = ".dotignore"
+    dotignore = os.path.join(repo, ".dotignore")
     try:
         with open(dotignore) as f:
-            exclusions = f.read().strip('\n').split("\n")
-            logging.debug(f"Exclusions: {exclusions}")
+            exclusions = f.read().strip('\n').split("\n") + STATE_EXCLUSIONS
+            trace("exclusions", exclusions=exclusions)
         return exclusions
     except FileNotFoundError as err:
-        print(f"{ERROR_PREFIX} The file {dotignore} cannot be found in the current dir")
-        logging.exception(
-            f"{ERROR_PREFIX} The file {dotignore} cannot be found in the current dir")
-        exit(1)
-    except Exception as err:
-        print(f"{ERROR_PREFIX} General exception {err}")
-        logging.exception(f"{ERROR_PREFIX} {err}")
-        exit(1)
+        where = "the current dir" if repo == "." else repo
+        raise DotfilesError(f"The file .dotignore cannot be found in {where}") from err
+    except (OSError, ValueError) as err:
+        raise DotfilesError(f"The file {dotignore} cannot be read: {err}") from err
 
 
-def get_envs(exclusions):
-    """ Creates a list of environments not excluded and return it.
+@profiled
+def compile_exclusions(exclusions):
+    """Compiles the .dotignore entries into a matcher with gitignore-style rules.
+
+    - name           Excludes files or dirs called "name" at any depth
+    - dir/           Only excludes directories
+    - *.swp, .c?nf   Globs: * and ? never match a /, ** matches across dirs
+    - /work/.zshrc   Anchored to the root of the repo (so is any entry with a /)
+    - !name          Includes again something excluded by a previous entry
+
+    As in .gitignore, the last entry matching a path wins. Entries without globs are
+    looked up in a dict and the rest are combined in a single regex, so the cost of
+    a lookup doesn't grow with the number of entries.
 
     Args:
         exclusions (list): A list of exclusions defined on the .dotignore file
 
     Returns:
-        environments (list): Environments(dirs not excluded)"""
+        is_excluded (function): is_excluded(path, is_dir) where path is relative to the
+        repo I.E home/.zshrc"""
+
+    literals = ({}, {})
+    patterns = ([], [])
+    negated = set()
+    for index, entry in enumerate(exclusions):
+        entry = entry.strip()
+        if not entry or entry.startswith("#"):
+            continue
+        if entry.startswith("!"):
+            negated.add(index)
+            entry = entry[1:]
+        dir_only = entry.endswith("/")
+        entry = entry.rstrip("/")
+        anchored = "/" in entry
+        entry = entry.lstrip("/")
+        if not entry:
+            continue
+        # Rules in [1] match dirs and files, rules in [0] only match dirs
+        for kind in ((0,) if dir_only else (0, 1)):
+            if not anchored and not any(char in entry for char in "*?["):
+                literals[kind][entry] = index
+            else:
+                prefix = "" if anchored else "(?:.*/)?"
+                patterns[kind].append(
+                    (index, f"(?P<r{index}>{prefix}{glob_to_regex(entry)})"))
+    regexes = tuple(
+        re.compile("|".join(regex for _, regex in reversed(kind_patterns)))
+        if kind_patterns else None for kind_patterns in patterns)
+    trace("exclusions_compiled", names=len(literals[0]), patterns=len(patterns[0]),
+          negations=len(negated))
+
+    def is_excluded(path, is_dir=False):
+        kind = 0 if is_dir else 1
+        index = literals[kind].get(path.rpartition("/")[2], -1)
+        regex = regexes[kind]
+        if regex is not None:
+            match = regex.fullmatch(path)
+            if match:
+                index = max(index, int(match.lastgroup[1:]))
+        return index >= 0 and index not in negated
+
+    return is_excluded
+
+
+def glob_to_regex(pattern):
+    """Translates a .dotignore glob into a regex where * and ? don't match a /."""
+
+    regex = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith("**/", index):
+            regex.append("(?:.*/)?")
+            index += 3
+            continue
+        if pattern.startswith("**", index):
+            regex.append(".*")
+            index += 2
+            continue
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[" and "]" in pattern[index + 2:]:
+            end = pattern.index("]", index + 2)
+            charset = pattern[index + 1:end].replace("\\", "\\\\")
+            if charset.startswith("!"):
+                charset = "^" + charset[1:]
+            regex.append(f"[{charset}]")
+            index = end
+        else:
+            regex.append(re.escape(char))
+        index += 1
+    return "".join(regex)
+
+
+@profiled
+def get_envs(is_excluded, repo="."):
+    """ Creates a list of environments not excluded and return it.
+
+    Args:
+        is_excluded (function): The .dotignore matcher from compile_exclusions()
+        repo (str): The dotfiles repo (Default: the current dir)
+
+    Returns:
+        environments (list): Environments(dirs not excluded) in sorted order, which is
+        their precedence when all of them are selected"""
 
-    all_dirs = [x.as_posix() for x in Path(".").iterdir() if x.is_dir()]
-    dirs_excluded = [dirs for dirs in exclusions if dirs.endswith("/")]
-    dirs_excluded = [dir_name.strip("/") for dir_name in dirs_excluded]
-    logging.debug(f"All Dirs: {all_dirs}")
-    logging.debug(f"Excluded dirs: {dirs_excluded}")
-    environments = list(set(all_dirs) - set(dirs_excluded))
-    logging.debug(f"Environments not excluded: {environments}")
+    all_dirs = sorted(x.name for x in Path(repo).iterdir() if x.is_dir())
+    environments = [dir_name for dir_name in all_dirs
+                    if not is_excluded(dir_name, is_dir=True)]
+    trace("environments", all_dirs=all_dirs, environments=environments)
     return environments
 
 
-def get_files_envs(environment, exclusions):
-    """Creates a list of environments associated to each dotfile if the env is not 
-    excluded
-    
+@profiled
+def scan_dotfiles(environments, is_excluded, repo="."):
+    """Walks every environment once and returns a record for each dotfile found.
+
+    Directories are scanned with os.scandir() and excluded subtrees (entries in the
+    .dotignore file) are pruned before being entered, so the cost of the scan grows
+    with the number of files included rather than the size of the whole tree.
+
     Args:
         environments (list): Environments(dirs not excluded)
-        exclusions (list): A list of exclusions defined on the .dotignore file
+        is_excluded (function): The .dotignore matcher from compile_exclusions()
+        repo (str): The dotfiles repo (Default: the current dir)
 
     Returns:
-        files_envs (list): Included environments associated to each dotfile
-    """
-    files_envs = []
-    for dirs in environment:
-        for fls in Path(dirs).rglob(".*"):
-            if fls.name not in exclusions and not fls.is_dir():
-                files_envs.append(dirs)
-    logging.debug(f"files_envs: {files_envs}")
-    logging.debug(f"Total elements of files_envs: {len(files_envs)}")
-    return files_envs
+        dotfiles (list): Dotfile(env, location, name) records, one per dotfile"""
 
+    dotfiles = []
+    for env in environments:
+        files_counter = 0
+        env_root = os.path.realpath(os.path.join(repo, env))
+        pending = [(env_root, env)]
+        while pending:
+            current_dir, relative_dir = pending.pop()
+            subdirs = []
+            try:
+                with os.scandir(current_dir) as entries:
+                    for entry in entries:
+                        name = entry.name
+                        relative_path = f"{relative_dir}/{name}"
+                        if entry.is_dir(follow_symlinks=False):
+                            if not is_excluded(relative_path, is_dir=True):
+                                subdirs.append((entry.path, relative_path))
+                            continue
+                        if not name.startswith(".") or is_excluded(relative_path):
+                            continue
+                        location = entry.path
+                        if entry.is_symlink():
+                            if os.path.isdir(location):
+                                continue
+                            location = os.path.realpath(location)
+                        dotfiles.append(Dotfile(env, location, name))
+                        files_counter += 1
+            except OSError as err:
+                trace("scan_skipped", path=current_dir, error=err)
+            pending.extend(reversed(subdirs))
+        trace("env_scanned", env=env, dotfiles=files_counter)
+    trace("scan_done", dotfiles=len(dotfiles))
+    return dotfiles
 
-def get_files_locations(environment, exclusions):
-    """Parse the current files locations of each environment and file that is not
-        excluded in the .dotignore file
+
+def discover_dotfiles(is_excluded, selected_env=None, discovery="scan", untracked=False,
+    verbose=True, repo="."):
+    """Finds the environments and their dotfiles with the discovery backend selected.
 
     Args:
-        environment (list): All of the environemnts not excluded
-        exclusions (list): Files and envs to be excluded
+        is_excluded (function): The .dotignore matcher from compile_exclusions()
+        selected_env (list): Environments to find the dotfiles of or None for all
+        discovery (str): "scan" to walk the envs or "git" to read the git index
+        untracked (bool): Whether the git backend also finds the untracked dotfiles
+        verbose (bool): Whether a warning is printed when falling back to scanning
+        repo (str): The dotfiles repo (Default: the current dir)
 
     Returns:
-        files_locations(list): Current files' location, excluding files in .dotignore"""
+        environments, dotfiles (tuple): The environments and Dotfile(env, location,
+        name) records, one per dotfile"""
 
-    files_locations = []
-    for dirs in environment:
-        files_counter = 0
-        for fls in (Path(dirs).rglob(".*")):
-            if fls.name not in exclusions and not fls.is_dir():
-                logging.debug(f"Adding to files_locations: {fls.resolve().as_posix()}")
-                files_locations.append(fls.resolve().as_posix())
-                files_counter += 1
-        logging.debug(f"{files_counter} files were added to files_locations for the"
-            f' "{dirs.upper()}/" environment')
-    logging.debug(f"Total elements of files_locations: {len(files_locations)}")
-    return files_locations
-
-
-def get_files_targets(files_locations):
+    if not os.path.isdir(repo):
+        raise DotfilesError(f"The dotfiles repo {repo} cannot be found")
+    if discovery == "git":
+        try:
+            environments, dotfiles = discover_git(is_excluded, untracked, repo)
+        except (OSError, ValueError) as err:
+            if verbose:
+                print(f"{WARNING_PREFIX} The git index could not be read ({err}), "
+                      f"scanning the environments instead.")
+            trace("git_discovery_failed", error=err)
+        else:
+            if selected_env:
+                environments = [env for env in environments if env in selected_env]
+                dotfiles = [dotfile for dotfile in dotfiles if dotfile.env in selected_env]
+            return environments, dotfiles
+    try:
+        environments = [env for env in get_envs(is_excluded, repo)
+                        if not selected_env or env in selected_env]
+    except OSError as err:
+        raise DotfilesError(f"The environments of {repo} cannot be listed: {err}") from err
+    return environments, scan_dotfiles(environments, is_excluded, repo)
+
+
+@profiled
+def discover_git(is_excluded, untracked=False, repo="."):
+    """Finds the dotfiles from the paths tracked in the git index instead of walking
+    the environments, so untracked build output is never visited.
+
+    The HEAD commit and the state of the index are recorded in _DISCOVERY_CACHE, which
+    is saved with the inventory cache. When neither has changed since the last run the
+    tracked paths of that run are reused without reading the index. Either way the
+    headers are only read again for the files whose stat has changed, which after a
+    git pull are the files the pull changed.
+
+    Args:
+        is_excluded (function): The .dotignore matcher from compile_exclusions()
+        untracked (bool): Whether the untracked files not ignored by git are added
+        repo (str): The dotfiles repo (Default: the current dir)
+
+    Returns:
+        environments, dotfiles (tuple): The environments and Dotfile(env, location,
+        name) records, one per dotfile"""
+
+    git_dir = find_git_dir(repo)
+    index_file = os.path.join(git_dir, "index")
+    state = [git_head(git_dir, repo)] + list(git_index_state(index_file))
+    if _DISCOVERY_CACHE.get("state") == state:
+        paths = _DISCOVERY_CACHE["paths"]
+        trace("git_discovery_cached", head=state[0], paths=len(paths))
+    else:
+        try:
+            paths = read_git_index(index_file)
+        except ValueError as err:
+            trace("git_index_unsupported", index_file=index_file, error=err)
+            paths = git_ls_files("--stage", repo=repo)
+        paths = [path for path in paths if "/." in path]
+        _DISCOVERY_CACHE.update(state=state, paths=paths)
+        trace("git_discovery_indexed", head=state[0], paths=len(paths))
+    if untracked:
+        paths = paths + git_ls_files("--others", "--exclude-standard", repo=repo)
+
+    environments = {}
+    dotfiles = []
+    dirs_excluded = {}
+    for path in dict.fromkeys(paths):
+        parts = path.split("/")
+        if len(parts) < 2 or not parts[-1].startswith("."):
+            continue
+        for depth in range(1, len(parts)):
+            relative_dir = "/".join(parts[:depth])
+            if relative_dir not in dirs_excluded:
+                dirs_excluded[relative_dir] = (
+                    dirs_excluded.get("/".join(parts[:depth - 1]), False) or
+                    is_excluded(relative_dir, is_dir=True))
+        env = parts[0]
+        if dirs_excluded["/".join(parts[:-1])]:
+            continue
+        environments.setdefault(env, os.path.realpath(os.path.join(repo, env)))
+        if is_excluded(path):
+            continue
+        location = os.path.join(environments[env], *parts[1:])
+        if os.path.islink(location):
+            if os.path.isdir(location):
+                continue
+            location = os.path.realpath(location)
+        elif not os.path.exists(location):
+            # Deleted from the worktree but still in the index
+            continue
+        dotfiles.append(Dotfile(env, location, parts[-1]))
+    trace("git_discovery_done", environments=list(environments), dotfiles=len(dotfiles))
+    return list(environments), dotfiles
+
+
+def find_git_dir(repo="."):
+    """Returns the git directory of the repo (Default: the current directory),
+    following the .git file of worktrees and submodules."""
+
+    dot_git = os.path.join(repo, ".git")
+    if os.path.isdir(dot_git):
+        return dot_git
+    with open(dot_git) as f:
+        git_dir = f.read().strip()
+    if not git_dir.startswith("gitdir:"):
+        raise ValueError(".git is neither a directory nor a gitdir file")
+    return os.path.join(repo, git_dir[len("gitdir:"):].strip())
+
+
+def git_head(git_dir, repo="."):
+    """Returns the commit HEAD points to, read from the git directory, or None when
+    the current branch has no commit yet. git is only run, from the repo, for
+    worktrees."""
+
+    with open(os.path.join(git_dir, "HEAD")) as f:
+        head = f.read().strip()
+    if not head.startswith("ref:"):
+        return head
+    ref = head[len("ref:"):].strip()
+    try:
+        with open(os.path.join(git_dir, *ref.split("/"))) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    try:
+        with open(os.path.join(git_dir, "packed-refs")) as f:
+            for line in f:
+                if line.rstrip("\n").endswith(f" {ref}"):
+                    return line.split(" ", 1)[0]
+    except FileNotFoundError:
+        pass
+    # Worktrees keep the branches in the common dir, ask git for the rest
+    from subprocess import PIPE, run
+    result = run(["git", "rev-parse", "--verify", "-q", "HEAD"], stdout=PIPE,
+                 stderr=PIPE, universal_newlines=True, cwd=repo)
+    return result.stdout.strip() or None
+
+
+def git_index_state(index_file):
+    """Returns (checksum, mtime, size) of a git index, which change whenever the
+    index is written (checkout, pull, add, ...), or Nones if there is no index."""
+
+    try:
+        index_stat = os.stat(index_file)
+        with open(index_file, "rb") as f:
+            f.seek(-20, os.SEEK_END)
+            checksum = f.read(20).hex()
+    except FileNotFoundError:
+        return None, None, None
+    return checksum, index_stat.st_mtime_ns, index_stat.st_size
+
+
+def read_git_index(index_file):
+    """Returns the paths of the files tracked in a git index, read directly from the
+    index file (versions 2, 3 and 4) without running git.
+
+    Submodules are skipped. Sparse indexes, which hold directories instead of files,
+    raise a ValueError so the caller can ask git to expand them.
+
+    Args:
+        index_file (str): I.E .git/index
+
+    Returns:
+        paths (list): The paths relative to the repo, I.E ["globals/.vimrc"]"""
+
+    try:
+        with open(index_file, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    if data[:4] != b"DIRC":
+        raise ValueError(f"{index_file} is not a git index")
+    version = int.from_bytes(data[4:8], "big")
+    if version not in (2, 3, 4):
+        raise ValueError(f"unsupported git index version {version}")
+    paths = []
+    offset = 12
+    previous = b""
+    for _ in range(int.from_bytes(data[8:12], "big")):
+        mode = int.from_bytes(data[offset + 24:offset + 28], "big")
+        flags = int.from_bytes(data[offset + 60:offset + 62], "big")
+        name_offset = offset + 62 + (2 if version >= 3 and flags & 0x4000 else 0)
+        if version == 4:
+            # The path is stored as the length to strip from the previous path and the
+            # suffix to append to it
+            strip, name_offset = read_git_varint(data, name_offset)
+            end = data.index(b"\0", name_offset)
+            path = previous[:len(previous) - strip] + data[name_offset:end]
+            offset = end + 1
+        else:
+            end = data.index(b"\0", name_offset)
+            path = data[name_offset:end]
+            # Entries are padded with 1 to 8 NULs to a multiple of 8 bytes
+            offset += (end - offset + 8) & ~7
+        previous = path
+        file_type = mode & 0o170000
+        if file_type == 0o040000:
+            raise ValueError("sparse git index")
+        if file_type != 0o160000:
+            paths.append(path.decode("utf-8", "surrogateescape"))
+    return paths
+
+
+def read_git_varint(data, offset):
+    """Reads the variable length integer of a version 4 git index entry.
+
+    Returns:
+        value, offset (tuple): The integer and the offset of the byte after it"""
+
+    byte = data[offset]
+    value = byte & 0x7f
+    while byte & 0x80:
+        offset += 1
+        byte = data[offset]
+        value = ((value + 1) << 7) | (byte & 0x7f)
+    return value, offset + 1
+
+
+def git_ls_files(*options, repo="."):
+    """Returns the paths listed by git ls-files run from the repo, relative to it.
+
+    With --stage the submodules are left out."""
+
+    from subprocess import PIPE, run
+
+    result = run(["git", "ls-files", "-z", *options], stdout=PIPE, stderr=PIPE, cwd=repo)
+    if result.returncode:
+        raise OSError(result.stderr.decode(errors="replace").strip())
+    paths = []
+    for line in result.stdout.decode("utf-8", "surrogateescape").split("\0"):
+        if not line:
+            continue
+        if "--stage" in options:
+            info, line = line.split("\t", 1)
+            if info.startswith("160000"):
+                continue
+        paths.append(line)
+    return paths
+
+
+@profiled
+def load_inventory_cache(cache_file=CACHE_FILE, dotignore=".dotignore"):
+    """Loads the inventory cache written by a previous run.
+
+    The cache is plain JSON, so loading it never runs code from the repo. It is
+    discarded when its version differs from CACHE_VERSION, when the .dotignore file has
+    changed since it was written or when it cannot be read.
+
+    Args:
+        cache_file (str): The file the inventory cache is stored in
+        dotignore (str): The .dotignore file the cache was built with
+
+    The content digests and the git discovery state stored along the entries are loaded
+    into _DIGEST_CACHE and _DISCOVERY_CACHE.
+
+    Returns:
+        cache (dict): {location: (dev, inode, size, mtime, target, env, deploy)}"""
+
+    try:
+        with open(cache_file) as f:
+            cache = loads(f.read())
+        if (cache.get("version") != CACHE_VERSION or
+                cache.get("dotignore") != file_fingerprint(dotignore)):
+            trace("cache_stale", cache_file=cache_file)
+            return {}
+        # JSON has no tuples, the entries and digest keys are compared as tuples
+        entries = {location: tuple(entry) for location, entry in cache["entries"].items()}
+        trace("cache_loaded", cache_file=cache_file, entries=len(entries))
+        _DIGEST_CACHE.update((path, (tuple(key), digest))
+                             for path, (key, digest) in cache.get("digests", {}).items())
+        _DISCOVERY_CACHE.update(cache.get("discovery", {}))
+        return entries
+    except FileNotFoundError:
+        return {}
+    except Exception as err:
+        trace("cache_unreadable", cache_file=cache_file, error=err)
+        return {}
+
+
+@profiled
+def save_inventory_cache(entries, cache_file=CACHE_FILE, dotignore=".dotignore"):
+    """Writes the inventory cache atomically so an interrupted run never leaves a
+    truncated cache behind.
+
+    Args:
+        entries (dict): {location: (dev, inode, size, mtime, target, env, deploy)}
+        cache_file (str): The file the inventory cache is stored in
+        dotignore (str): The .dotignore file the cache was built with
+
+    Returns:
+        None"""
+
+    repo = os.path.dirname(os.path.abspath(cache_file))
+    cache = {"version": CACHE_VERSION, "dotignore": file_fingerprint(dotignore),
+             "entries": entries, "digests": live_digests(entries, repo),
+             "discovery": dict(_DISCOVERY_CACHE)}
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            f.write(dumps(cache))
+        os.replace(tmp_file, cache_file)
+        trace("cache_saved", cache_file=cache_file, entries=len(entries))
+    except OSError as err:
+        logging.warning(f"The inventory cache could not be saved: {err}")
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+
+
+def live_digests(entries, repo="."):
+    """Returns the content digests worth keeping between runs: those of the dotfiles
+    in the cache, of their targets under the user's home and of the rendered and
+    compiled dotfiles of the repo, as long as the file has not changed since it was
+    hashed.
+
+    Args:
+        entries (dict): {location: (dev, inode, size, mtime, target, env, deploy)}
+        repo (str): The dotfiles repo
+
+    Returns:
+        digests (dict): {path: (stat_key, digest)} taken from _DIGEST_CACHE"""
+
+    paths = set(entries)
+    paths.update(expand_target(entry[4]) for entry in entries.values() if entry[4])
+    outputs = tuple(os.path.realpath(os.path.join(repo, output_dir)) + os.sep
+                    for output_dir in (RENDER_DIR, COMPILE_DIR))
+    digests = {}
+    for path, (key, digest) in _DIGEST_CACHE.items():
+        if path not in paths and not path.startswith(outputs):
+            continue
+        try:
+            if stat_key(os.stat(path)) == key:
+                digests[path] = (key, digest)
+        except OSError:
+            pass
+    return digests
+
+
+def file_fingerprint(file_name):
+    """Returns a digest of the file's content or None if the file does not exist."""
+
+    try:
+        with open(file_name, "rb") as f:
+            return sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def parse_target(first_line, location):
+    """Returns the target defined by TARGET=<path> on the first line of a dotfile or
+    the default target ~/<dotfile_name> (without the .tmpl suffix of templates) if there
+    is none.
+
+    Args:
+        first_line (str): The first line of the dotfile
+        location (str): The dotfile's location
+
+    Returns:
+        target (str): I.E ~/.vimrc"""
+
+    TARGET_ID = "TARGET="
+    if TARGET_ID in first_line:
+        target_path = [path for path in first_line.split() if TARGET_ID in path]
+        return target_path[0].replace(TARGET_ID, "")
+    name = os.path.basename(location)
+    if name.endswith(TEMPLATE_SUFFIX):
+        name = name[:-len(TEMPLATE_SUFFIX)]
+    return "~/" + name
+
+
+def parse_deploy(first_line):
+    """Returns the mode defined by DEPLOY=<mode> on the first line of a dotfile, I.E
+    # TARGET=~/.vimrc DEPLOY=copy, or None if there is none or it is unknown."""
+
+    DEPLOY_ID = "DEPLOY="
+    if DEPLOY_ID not in first_line:
+        return None
+    mode = [word for word in first_line.split() if word.startswith(DEPLOY_ID)]
+    mode = mode[0][len(DEPLOY_ID):] if mode else None
+    if mode not in DEPLOY_MODES:
+        trace("deploy_mode_unknown", first_line=first_line)
+        return None
+    return mode
+
+
+def read_header(location):
+    """Reads the target and the deploy mode of a dotfile from a bounded prefix of the
+    file.
+
+    Only the first HEADER_SIZE bytes are read, in binary mode, so binary dotfiles or
+    files without a newline never get read as a whole or fail to be decoded.
+
+    Args:
+        location (str): The dotfile's location
+
+    Returns:
+        target, deploy (tuple): I.E ("~/.vimrc", None) or ("~/.vimrc", "copy")"""
+
+    with open(location, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    first_line = header.split(b"\n", 1)[0].rstrip(b"\r")
+    first_line = first_line.decode("utf-8", errors="replace")
+    return parse_target(first_line, location), parse_deploy(first_line)
+
+
+def read_target_header(location):
+    """Reads the target of a dotfile, see read_header().
+
+    Returns:
+        target (str): I.E ~/.vimrc"""
+
+    return read_header(location)[0]
+
+
+@profiled
+def get_files_targets(dotfiles, cache=None, workers=DEFAULT_WORKERS, deploy=None):
     """Gets a lists of files targets. 
     
     Search the first line on each file for a string containing TARGET=<path> I.E 
     TARGET=~/.vimrc. If no TARGET= is present, by default the target will be 
     ~/.<dotfile_name>
+
+    When a cache is passed, files whose (dev, inode, size, mtime) have not changed
+    since the cache was written reuse the cached target instead of being re-read. The
+    cache is updated in place: the entries of the dotfiles passed are replaced and the
+    entries of the other dotfiles, I.E from environments not selected in this run, are
+    kept unless their file no longer exists. The remaining files are read concurrently
+    by a pool of workers.
+
+    Dotfiles removed since they were scanned are skipped: they are dropped from the
+    dotfiles list in place, so it stays aligned with the targets returned.
     
     Args:
-        files_locations(list): Current files' location, excluding files in .dotignore
+        dotfiles (list): Dotfile(env, location, name) records from scan_dotfiles()
+        cache (dict): {location: (dev, inode, size, mtime, target, env, deploy)} or None
+        workers (int): Number of threads used to read the files' headers
+        deploy (dict): Filled with {location: mode} for the DEPLOY= headers found
         
     Return:
         files_targets (list): Targets where files will be symlinked to on each env"""
     
+    from concurrent.futures import ThreadPoolExecutor
+
     files_targets = []
-    TARGET_ID = "TARGET="
-    for files in files_locations:
-        with open(files) as f:
-            target_path = f.readline().strip("\n")
-        if TARGET_ID in target_path:
-            target_path = target_path.split()
-            target_path = [path for path in target_path if TARGET_ID in path]
-            target_path = target_path[0].replace(TARGET_ID, "")
-            files_targets.append(target_path)
-            logging.debug(
-                f"File: {files} Custom Target: {target_path} added to files_targets")
+    modes = []
+    cached_entries = {} if cache is None else cache
+    keys = []
+    to_read = []
+    vanished = set()
+    for index, dotfile in enumerate(dotfiles):
+        try:
+            file_stat = os.stat(dotfile.location)
+        except FileNotFoundError:
+            vanished.add(index)
+            keys.append(None)
+            files_targets.append(None)
+            modes.append(None)
+            continue
+        key = (file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+               file_stat.st_mtime_ns)
+        keys.append(key)
+        cached = cached_entries.get(dotfile.location)
+        if cached is not None and cached[:4] == key:
+            files_targets.append(cached[4])
+            modes.append(cached[6])
         else:
-            file_name = Path(files)
-            file_name = file_name.name
-            file_path = "~/" + file_name
-            files_targets.append(file_path)
-            logging.debug(
-                f"File: {files} Default Target: {file_path} added to files_targets")
-    logging.debug(f"files_targets: {files_targets}")
+            files_targets.append(None)
+            modes.append(None)
+            to_read.append(index)
+
+    def read_existing_header(location):
+        try:
+            return read_header(location)
+        except FileNotFoundError:
+            return None
+
+    locations_to_read = [dotfiles[index].location for index in to_read]
+    if workers > 1 and len(locations_to_read) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            headers_read = list(pool.map(read_existing_header, locations_to_read))
+    else:
+        headers_read = [read_existing_header(files) for files in locations_to_read]
+    for index, header in zip(to_read, headers_read):
+        if header is None:
+            vanished.add(index)
+            continue
+        files_targets[index], modes[index] = header
+    trace("targets_read", locations=locations_to_read, headers=headers_read)
+
+    if vanished:
+        trace("dotfiles_vanished", locations=[dotfiles[index].location
+                                              for index in sorted(vanished)])
+        kept = [index for index in range(len(dotfiles)) if index not in vanished]
+        dotfiles[:] = [dotfiles[index] for index in kept]
+        keys, files_targets, modes = ([values[index] for index in kept]
+                                      for values in (keys, files_targets, modes))
+
+    if deploy is not None:
+        deploy.update((dotfile.location, mode) for dotfile, mode in zip(dotfiles, modes)
+                      if mode is not None)
+    if cache is not None:
+        for dotfile, key, target_path, mode in zip(dotfiles, keys, files_targets, modes):
+            cache[dotfile.location] = key + (target_path, dotfile.env, mode)
+        if len(cache) > len(dotfiles):
+            scanned = {dotfile.location for dotfile in dotfiles}
+            for location in [location for location in cache if location not in scanned]:
+                if not os.path.exists(location):
+                    del cache[location]
+        trace("targets_cached", cached=len(dotfiles) - len(to_read), total=len(dotfiles))
     return files_targets
 
 
-def get_nonexistent_targets(files_locations, files_targets):
-    """Check if the file's target exist and return a list with True if target DOES NOT
-    exists or False if the target exists
-    
+@profiled
+def render_templates(dotfiles, variables=None, output_dir=RENDER_DIR, dry_run=False,
+    repo="."):
+    """Renders the template dotfiles (I.E .zshrc.tmpl) into output_dir and returns the
+    dotfiles with the location of each template replaced by its rendered output, which
+    is what the targets get linked to.
+
+    Templates are rendered with the host facts from host_facts() and the variables
+    passed. The render cache records the digest of each template and the value of the
+    variables it used, so only the templates whose content or variables have changed
+    are rendered again.
+
+    With dry_run (--check, --diff) neither output_dir nor the render cache are
+    changed: the templates which would be rendered again are rendered to a scratch
+    directory instead, so their targets show up as drifted, and --diff shows what
+    rendering them would change.
+
     Args:
-        files_locations(list): Current files' location, excluding files in .dotignore 
-        files_targets (list): Targets where files will be symlinked to on each env
+        dotfiles (list): Dotfile(env, location, name) records from scan_dotfiles()
+        variables (dict): {name: value} overriding or adding to the host facts
+        output_dir (str): The directory the templates are rendered to
+        dry_run (bool): Whether output_dir is left as it is
+        repo (str): The dotfiles repo (Default: the current dir)
 
     Returns:
-        targets_to_add (list): Non-existent files in the current OS to be created."""
+        dotfiles (list): Dotfile(env, location, name) records"""
 
-    targets_to_add = []
-    dotfiles = (dict(zip(files_locations, files_targets)))
-    logging.debug(f"File Location: Target {dotfiles}")
-    for target in dotfiles.values():
-        path_target = Path(target).expanduser()
-        if path_target.exists():
-            targets_to_add.append(False)
-        else:
-            targets_to_add.append(True)
-            logging.debug(f'File: "{target}" will be created on create_targets()')
-    logging.debug(f"targets_to_add: {targets_to_add}")
-    logging.debug(f"Total elements of targets_to_add: {len(targets_to_add)}")
-    return targets_to_add
+    templates = [index for index, dotfile in enumerate(dotfiles)
+                 if dotfile.name.endswith(TEMPLATE_SUFFIX)]
+    if not templates:
+        return dotfiles
+    facts = dict(host_facts(), **(variables or {}))
+    cache_file = os.path.join(output_dir, RENDER_CACHE_FILE)
+    try:
+        with open(cache_file) as f:
+            cache = loads(f.read())
+    except (OSError, ValueError):
+        cache = {}
 
+    rendered = list(dotfiles)
+    rendered_count = 0
+    for index in templates:
+        dotfile = dotfiles[index]
+        output = render_output_path(dotfile, output_dir, repo)
+        try:
+            with open(dotfile.location, "rb") as f:
+                content = f.read()
+            digest = sha1(content).hexdigest()
+            cached = cache.get(dotfile.location)
+            if (cached is None or cached["digest"] != digest or cached["output"] != output
+                    or any(facts.get(name) != value
+                           for name, value in cached["vars"].items())
+                    or not os.path.isfile(output)):
+                used = {}
+                text = render_template(content.decode("utf-8"), facts, used)
+                if dry_run:
+                    output = render_output_path(dotfile, scratch_dir(RENDER_DIR), repo)
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                tmp_output = f"{output}.{os.getpid()}.tmp"
+                with open(tmp_output, "w") as f:
+                    f.write(text)
+                os.chmod(tmp_output, S_IMODE(os.stat(dotfile.location).st_mode))
+                os.replace(tmp_output, output)
+                forget_target(output)
+                if not dry_run:
+                    cache[dotfile.location] = {"digest": digest, "vars": used,
+                                               "output": output}
+                    rendered_count += 1
+                trace("template_rendered", location=dotfile.location, output=output, vars=used)
+        except (OSError, ValueError) as err:
+            raise DotfilesError(f"The template {dotfile.location} could not be "
+                                f"rendered: {err}") from err
+        rendered[index] = dotfile._replace(location=output)
+
+    if rendered_count:
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(dumps(cache))
+        os.replace(tmp_file, cache_file)
+    trace("templates_done", rendered=rendered_count, templates=len(templates))
+    return rendered
+
+
+def render_inventory(dotfiles, files_targets, variables=None, deploy=None, dry_run=False,
+    repo="."):
+    """Renders the templates and returns the inventory of the dotfiles, with the
+    DEPLOY= modes of the templates moved to their rendered outputs.
 
-def create_targets(targets_to_add, files_targets, selected_env, files_envs,
-    files_locations):
-    """ Creates non-existent files/symlinks only for environments selected via the CLI
-    
     Args:
-        targets_to_add (list): Non-existent files in the current OS to be created.
-        files_targets (list): Targets where files will be symlinked to on each env
-        selected_env (list): Environments selected by the user via the CLI
-        files_envs (list): Included environments associated to each dotfile
-        files_locations(list): Current files' location, excluding files in .dotignore
+        dotfiles (list): Dotfile(env, location, name) records from scan_dotfiles()
+        files_targets (list): Targets from get_files_targets()
+        variables (dict): Template variables passed with --var
+        deploy (dict): {location: mode} filled by get_files_targets()
+        dry_run (bool): Whether the rendered outputs are left as they are, see
+        render_templates()
+        repo (str): The dotfiles repo, the templates are rendered to its RENDER_DIR
 
     Returns:
-        None"""
+        inventory (Inventory): The dotfiles and their targets"""
 
-    print("\n1 - CHECKING IF TARGETS EXISTS IN THE OS")
-    for index, file_to_add in enumerate(targets_to_add):
-        if (file_to_add is True) and (files_envs[index] in selected_env):
-            new_file = files_targets[index]
-            try:
-                Path(new_file).expanduser().touch()
-                logging.debug(f"File/Symlink target has been created: {new_file}")
-                new_file = colored(new_file, "green")
-                print(f"{colored(SUCCESS_PREFIX)} File: {new_file} ---> "
-                      f"has been created")
-            except PermissionError:
-                error_file = colored(new_file, "red")
+    rendered = render_templates(dotfiles, variables, os.path.join(repo, RENDER_DIR),
+                                dry_run, repo)
+    deploy = {new.location: deploy[old.location] for old, new in zip(dotfiles, rendered)
+              if old.location in (deploy or {})}
+    return Inventory(rendered, files_targets, deploy)
+
+
+def scratch_dir(name):
+    """Returns a directory removed when the process exits, where --check and --diff
+    write what would otherwise be written to the repo, I.E scratch_dir(RENDER_DIR)."""
+
+    if _SCRATCH["dir"] is None:
+        import atexit
+        from shutil import rmtree
+        from tempfile import mkdtemp
+
+        _SCRATCH["dir"] = mkdtemp(prefix="dotfiles-")
+        atexit.register(rmtree, _SCRATCH["dir"], ignore_errors=True)
+    path = os.path.join(_SCRATCH["dir"], name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def in_scratch_dir(location):
+    """Returns True if location was written to the scratch_dir() by a dry run."""
+
+    return _SCRATCH["dir"] is not None and location.startswith(_SCRATCH["dir"] + os.sep)
+
+
+def render_output_path(dotfile, output_dir=RENDER_DIR, repo="."):
+    """Returns where a template is rendered to: <output_dir>/<env>/<path in the env>
+    without the template suffix."""
+
+    env_root = os.path.realpath(os.path.join(repo, dotfile.env))
+    relative_path = os.path.relpath(dotfile.location, env_root)
+    if relative_path.startswith(os.pardir):
+        # The template is a symlink to a file outside of its environment
+        relative_path = dotfile.name
+    return os.path.join(os.path.realpath(output_dir), dotfile.env,
+                        relative_path[:-len(TEMPLATE_SUFFIX)])
+
+
+def host_facts():
+    """Returns the facts about this host available to the templates."""
+
+    from getpass import getuser
+    import platform
+
+    return {
+        "hostname": platform.node(),
+        "os": platform.system().lower(),
+        "arch": platform.machine(),
+        "user": getuser(),
+        "home": os.path.expanduser("~"),
+        "shell": os.path.basename(os.environ.get("SHELL", "")),
+    }
+
+
+def render_template(text, facts, used):
+    """Renders a template.
+
+    {{ name }} is replaced by the value of a variable and {% if condition %},
+    {% elif condition %}, {% else %} and {% endif %} keep or drop the lines between
+    them. Conditions are a variable (true when set and not empty), name == "value",
+    name != "value", not, and, or. Block tags on their own line don't leave an empty
+    line or their indentation behind.
+
+    Args:
+        text (str): The content of the template
+        facts (dict): {name: value} of the variables
+        used (dict): Filled with {name: value} of the variables the output depends on
+
+    Returns:
+        text (str): The rendered template"""
+
+    def line_number(match):
+        return text.count("\n", 0, match.start()) + 1
+
+    output = []
+    # One [parent_active, branch_taken] per open {% if %}
+    blocks = []
+    active = True
+    position = 0
+    for match in TEMPLATE_TAG.finditer(text):
+        if active:
+            output.append(text[position:match.start()])
+        position = match.end()
+        variable, keyword, condition = match.groups()
+        if variable:
+            if not active:
+                continue
+            if variable not in facts:
+                raise ValueError(f"line {line_number(match)}: unknown variable "
+                                 f"{variable!r}, pass it with --var {variable}=VALUE")
+            used[variable] = facts[variable]
+            output.append(str(facts[variable]))
+        elif keyword == "if":
+            taken = active and evaluate_condition(condition, facts, used)
+            blocks.append([active, taken])
+            active = taken
+        elif keyword in ("elif", "else", "endif"):
+            if not blocks:
+                raise ValueError(f"line {line_number(match)}: {{% {keyword} %}} without "
+                                 f"{{% if %}}")
+            parent_active, taken = blocks[-1]
+            if keyword == "endif":
+                active = blocks.pop()[0]
+                continue
+            active = parent_active and not taken and (
+                keyword == "else" or evaluate_condition(condition, facts, used))
+            blocks[-1][1] = taken or active
+        else:
+            raise ValueError(f"line {line_number(match)}: unknown tag {keyword!r}")
+    if blocks:
+        raise ValueError(f"{len(blocks)} {{% if %}} without {{% endif %}}")
+    if active:
+        output.append(text[position:])
+    return "".join(output)
+
+
+def evaluate_condition(condition, facts, used):
+    """Evaluates the condition of an {% if %} or {% elif %} tag.
+
+    Args:
+        condition (str): I.E os == "darwin" and not work
+        facts (dict): {name: value} of the variables
+        used (dict): Filled with {name: value} of the variables evaluated
+
+    Returns:
+        result (bool)"""
+
+    condition = condition.strip()
+    parts = split_condition(condition, " or ")
+    if len(parts) > 1:
+        return any(evaluate_condition(part, facts, used) for part in parts)
+    parts = split_condition(condition, " and ")
+    if len(parts) > 1:
+        return all(evaluate_condition(part, facts, used) for part in parts)
+    if condition.startswith("not "):
+        return not evaluate_condition(condition[4:], facts, used)
+    comparison = re.fullmatch(r"(\w+)\s*(==|!=)\s*(['\"])(.*)\3", condition)
+    name = comparison.group(1) if comparison else condition
+    if not re.fullmatch(r"\w+", name):
+        raise ValueError(f"invalid condition {condition!r}")
+    used[name] = facts.get(name)
+    if comparison:
+        return (used[name] == comparison.group(4)) == (comparison.group(2) == "==")
+    return bool(used[name])
+
+
+def split_condition(condition, operator):
+    """Splits a condition on a boolean operator, I.E " or ", ignoring the operators
+    inside quoted strings like shell == "zsh or bash"."""
+
+    parts = []
+    quote = None
+    start = index = 0
+    while index < len(condition):
+        char = condition[index]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif condition.startswith(operator, index):
+            parts.append(condition[start:index])
+            index += len(operator)
+            start = index
+            continue
+        index += 1
+    parts.append(condition[start:])
+    return parts
+
+
+class Inventory:
+    """The dotfiles of the repo and their targets, indexed by environment, target and
+    name.
+
+    Each dotfile is stored once as a compact InventoryRecord(env, location, name,
+    target) and the indexes map each key to the positions of its records, so selecting
+    an environment or looking up a target never scans the whole inventory. The modes
+    of the DEPLOY= headers are kept in deploy as {location: mode}."""
+
+    def __init__(self, dotfiles, files_targets, deploy=None):
+        self.records = [InventoryRecord(dotfile.env, dotfile.location, dotfile.name, target)
+                        for dotfile, target in zip(dotfiles, files_targets)]
+        self.deploy = deploy or {}
+        self.by_env = {}
+        self.by_target = {}
+        self.by_name = {}
+        for index, record in enumerate(self.records):
+            self.by_env.setdefault(record.env, []).append(index)
+            self.by_target.setdefault(target_key(record.target), []).append(index)
+            self.by_name.setdefault(record.name, []).append(index)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    @property
+    def locations(self):
+        return [record.location for record in self.records]
+
+    @property
+    def targets(self):
+        return [record.target for record in self.records]
+
+    @property
+    def envs(self):
+        return [record.env for record in self.records]
+
+    def env(self, env):
+        """Returns the records of an environment."""
+
+        return [self.records[index] for index in self.by_env.get(env, ())]
+
+    def target(self, target):
+        """Returns the records of the dotfiles claiming a target, I.E ~/.vimrc"""
+
+        return [self.records[index] for index in self.by_target.get(target_key(target), ())]
+
+    def name(self, name):
+        """Returns the records of the dotfiles named name, I.E .vimrc"""
+
+        return [self.records[index] for index in self.by_name.get(name, ())]
+
+    def select(self, selected_env):
+        """Selects the records of some environments, keeping a single record per target.
+
+        When many dotfiles claim the same target, the one of the environment selected
+        last wins (I.E with --env globals work, work overrides globals). All the
+        environments are selected in sorted order, see get_envs(). Within a single
+        environment the dotfile whose location sorts last wins, so the winner never
+        depends on the order the filesystem lists the files in.
+
+        Args:
+            selected_env (list): Environments selected by the user via the CLI
+
+        Returns:
+            selected, collisions (tuple): {target: record} with the records selected and
+            {target: [records]} with all the records claiming each conflicting target,
+            the one selected last"""
+
+        selected = {}
+        collisions = {}
+        for env in dict.fromkeys(selected_env):
+            for index in self.by_env.get(env, ()):
+                record = self.records[index]
+                key = target_key(record.target)
+                if key in selected:
+                    previous = selected[key]
+                    records = collisions.setdefault(key, [previous])
+                    if previous.env == env and previous.location > record.location:
+                        # The winner is kept last
+                        records.insert(-1, record)
+                        continue
+                    records.append(record)
+                selected[key] = record
+        return selected, collisions
+
+
+def target_key(target):
+    """Normalises a target so the spellings of the same path collide, I.E ~//.vimrc"""
+
+    return os.path.normpath(target)
+
+
+def print_collisions(collisions, file=None):
+    """Prints a warning for each target claimed by many dotfiles.
+
+    Args:
+        collisions (dict): {target: [records]} from Inventory.select()
+        file (file): Where the warnings are printed (Default: stdout)
+
+    Returns:
+        None"""
+
+    for records in collisions.values():
+        winner = records[-1]
+        overridden = ", ".join(f"{record.location} ({record.env})" for record in records[:-1])
+        print(f"{WARNING_PREFIX} {winner.target} is claimed by {len(records)} dotfiles, "
+              f"using {winner.location} ({winner.env}) over {overridden}.", file=file)
+
+
+def expand_target(target, root=None):
+    """Expands a target like ~/.vimrc into an absolute path without resolving it.
+
+    When a root is passed, ~ is replaced by the root instead of the current user's
+    home directory and absolute targets are rebased under the root, I.E /etc/hosts
+    becomes <root>/etc/hosts, so the roots never write to the same host path."""
+
+    if root is None:
+        return os.path.abspath(os.path.expanduser(target))
+    if target == "~" or target.startswith("~/"):
+        return os.path.normpath(root + target[1:])
+    return os.path.normpath(root + os.path.abspath(os.path.expanduser(target)))
+
+
+def lstat_target(path):
+    """Calls lstat() once per path and caches the result for the whole run.
+
+    Args:
+        path (str): An expanded target I.E /home/user/.vimrc
+
+    Returns:
+        stat (os.stat_result): The stat of the path itself or None if it doesn't exist"""
+
+    try:
+        return _LSTAT_CACHE[path]
+    except KeyError:
+        pass
+    try:
+        path_stat = os.lstat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        path_stat = None
+    _LSTAT_CACHE[path] = path_stat
+    return path_stat
+
+
+def forget_target(path):
+    """Drops a path from the stat cache after it has been modified."""
+
+    _LSTAT_CACHE.pop(path, None)
+
+
+@lru_cache(maxsize=None)
+def real_parent(dir_name):
+    """Memoised os.path.realpath() for the parent directories of the targets."""
+
+    return os.path.realpath(dir_name)
+
+
+def link_destination(path):
+    """Returns the normalised destination of a symlink using a single readlink().
+
+    Relative destinations are joined to the resolved parent directory of the link,
+    which is where the kernel resolves them from.
+
+    Args:
+        path (str): An expanded target which is a symlink
+
+    Returns:
+        destination (str): The absolute, normalised destination of the symlink"""
+
+    destination = os.readlink(path)
+    if not os.path.isabs(destination):
+        destination = os.path.join(real_parent(os.path.dirname(path)), destination)
+    return os.path.normpath(destination)
+
+
+@profiled
+def get_nonexistent_targets(files_locations, files_targets, root=None):
+    """Check if the file's target exist and return a list with True if target DOES NOT
+    exists or False if the target exists
+    
+    Args:
+        files_locations(list): Current files' location, excluding files in .dotignore 
+        files_targets (list): Targets where files will be symlinked to on each env
+        root (str): The directory ~ is expanded to or None for the user's home
+
+    Returns:
+        targets_to_add (list): Non-existent files in the current OS to be created."""
+
+    targets_to_add = []
+    for target in files_targets:
+        targets_to_add.append(lstat_target(expand_target(target, root)) is None)
+    trace("targets_to_add", targets=files_targets, missing=targets_to_add)
+    return targets_to_add
+
+
+@profiled
+def create_targets(targets_to_add, files_targets, selected_env, files_envs,
+    files_locations):
+    """ Creates non-existent files/symlinks only for environments selected via the CLI
+    
+    Args:
+        targets_to_add (list): Non-existent files in the current OS to be created.
+        files_targets (list): Targets where files will be symlinked to on each env
+        selected_env (list): Environments selected by the user via the CLI
+        files_envs (list): Included environments associated to each dotfile
+        files_locations(list): Current files' location, excluding files in .dotignore
+
+    Returns:
+        None"""
+
+    from getpass import getuser
+
+    print("\n1 - CHECKING IF TARGETS EXISTS IN THE OS")
+    for index, file_to_add in enumerate(targets_to_add):
+        if (file_to_add is True) and (files_envs[index] in selected_env):
+            new_file = files_targets[index]
+            if is_folded(expand_target(new_file)):
+                # Touching it would write into the repo, it is unfolded and linked once
+                # the changes are confirmed
+                continue
+            try:
+                Path(new_file).expanduser().touch()
+                forget_target(expand_target(new_file))
+                _TOUCHED.add(expand_target(new_file))
+                trace("target_created", target=new_file)
+                new_file = colored(new_file, "green")
+                print(f"{colored(SUCCESS_PREFIX)} File: {new_file} ---> "
+                      f"has been created")
+            except PermissionError:
+                error_file = colored(new_file, "red")
                 username = colored(getuser(), "red")
                 error_source = colored(files_locations[index], "red")
                 print(f'{ERROR_PREFIX} "{username}" is not allowed to create '
@@ -272,197 +1728,2194 @@ def create_targets(targets_to_add, files_targets, selected_env, files_envs,
                 logging.exception(f"{ERROR_PREFIX} {err}")
                 exit(1)
 
-    print(f'{SUCCESS_PREFIX} All targets exist in the OS.')
+    print(f'{SUCCESS_PREFIX} All targets exist in the OS.')
+
+
+@profiled
+def filter_dotfiles(inventory, selected_env, collisions=None):
+    """ 
+    Filters all the files depending on the selected env I.E: --env home and warns about
+    the targets claimed by many dotfiles
+
+    Args:
+        inventory (Inventory): The dotfiles and their targets
+        selected_env (list): Environments selected by the user via the CLI
+        collisions (dict): The collisions to warn about if the inventory has already
+        been resolved, I.E by fold_dotfiles()
+
+    Returns:
+        filtered_dotfiles (dict): {filtered_targets: filtered locations}"""
+
+    selected_env_str = " - ".join(selected_env).upper()
+    print(f'\n2 - CHECKING ALL SYMLINKS ON THE ENVS: "{selected_env_str}"')
+    if collisions is None:
+        collisions = inventory.select(selected_env)[1]
+    print_collisions(collisions)
+    return select_dotfiles(inventory, selected_env)
+
+
+def select_dotfiles(inventory, selected_env):
+    """Filters all the files depending on the selected env without printing anything.
+
+    When many dotfiles claim the same target, only the one with precedence is kept, see
+    Inventory.select().
+
+    Args:
+        inventory (Inventory): The dotfiles and their targets
+        selected_env (list): Environments selected by the user via the CLI
+
+    Returns:
+        filtered_dotfiles (dict): {filtered_targets: filtered locations}"""
+
+    selected, collisions = inventory.select(selected_env)
+    filtered_dotfiles = {record.target: record.location for record in selected.values()}
+    trace("dotfiles_selected", envs=selected_env, dotfiles=filtered_dotfiles,
+          collisions=collisions)
+    return filtered_dotfiles
+
+
+def deploy_modes(inventory, selected_env, env_modes=None):
+    """Returns how the selected dotfiles which are not symlinked get deployed.
+
+    The DEPLOY= header of a dotfile has precedence over --deploy ENV=MODE, which has
+    precedence over --deploy MODE.
+
+    Args:
+        inventory (Inventory): The dotfiles and their targets
+        selected_env (list): Environments selected by the user via the CLI
+        env_modes (dict): {env: mode} from --deploy, the env None for all the envs
+
+    Returns:
+        modes (dict): {location: mode} only for the modes other than symlink"""
+
+    env_modes = env_modes or {}
+    modes = {}
+    for record in inventory.select(selected_env)[0].values():
+        mode = (inventory.deploy.get(record.location) or env_modes.get(record.env) or
+                env_modes.get(None, "symlink"))
+        if mode != "symlink":
+            modes[record.location] = mode
+    trace("deploy_modes", modes=modes)
+    return modes
+
+
+@profiled
+def fold_dotfiles(inventory, selected_env, root=None, modes=None, repo="."):
+    """Folds the dotfiles of the selected environments like GNU Stow does: when all the
+    dotfiles under a target directory come from the same directory of an environment,
+    and that directory holds nothing else, the target directory is linked to it with a
+    single symlink instead of linking each dotfile.
+
+    Target directories which already exist as real directories, or which hold
+    dotfiles not deployed as symlinks, are not folded.
+
+    Args:
+        inventory (Inventory): The dotfiles and their targets
+        selected_env (list): Environments selected by the user via the CLI
+        root (str): The directory ~ is expanded to or None for the user's home
+        modes (dict): {location: mode} from deploy_modes()
+        repo (str): The dotfiles repo (Default: the current dir)
+
+    Returns:
+        inventory (Inventory): The dotfiles selected, with the dotfiles of each folded
+        directory replaced by the directory itself, and those of the other envs"""
+
+    selected = list(inventory.select(selected_env)[0].values())
+    env_roots = [os.path.realpath(os.path.join(repo, env)) for env in selected_env]
+    home = expand_target("~", root)
+    # {target_dir: {source_dir or None when the layout differs}}
+    sources = {}
+    dotfiles_under = Counter()
+    for env, location, _, target in selected:
+        path = expand_target(target, root)
+        source_dir, target_dir = os.path.dirname(location), os.path.dirname(path)
+        same_layout = (os.path.basename(location) == os.path.basename(path) and
+                       location not in (modes or {}))
+        while target_dir.startswith(home + os.sep):
+            same_layout = same_layout and any(
+                source_dir.startswith(env_root + os.sep) for env_root in env_roots)
+            sources.setdefault(target_dir, set()).add(source_dir if same_layout else None)
+            dotfiles_under[target_dir] += 1
+            same_layout = (same_layout and
+                           os.path.basename(source_dir) == os.path.basename(target_dir))
+            source_dir, target_dir = os.path.dirname(source_dir), os.path.dirname(target_dir)
+
+    folded = {}
+    for target_dir in sorted(sources, key=len):
+        if folded_parent(target_dir, folded, home) or len(sources[target_dir]) != 1:
+            continue
+        source_dir = next(iter(sources[target_dir]))
+        if source_dir is None or count_files(source_dir) != dotfiles_under[target_dir]:
+            continue
+        target_stat = lstat_target(target_dir)
+        if target_stat is None or S_ISLNK(target_stat.st_mode):
+            folded[target_dir] = source_dir
+    trace("dirs_folded", folded=folded)
+
+    records = [record for record in inventory if record.env not in selected_env]
+    added = set()
+    for record in selected:
+        path = expand_target(record.target, root)
+        target_dir = folded_parent(path, folded, home)
+        if target_dir is None:
+            records.append(record)
+        elif target_dir not in added:
+            added.add(target_dir)
+            suffix = path[len(target_dir):]
+            dir_target = (record.target[:-len(suffix)] if record.target.endswith(suffix)
+                          else target_dir)
+            source_dir = folded[target_dir]
+            records.append(InventoryRecord(record.env, source_dir,
+                                           os.path.basename(source_dir), dir_target))
+    return Inventory(records, [record.target for record in records], inventory.deploy)
+
+
+def folded_parent(path, folded, home):
+    """Returns the directory of folded which path is under or None."""
+
+    parent = os.path.dirname(path)
+    while parent.startswith(home + os.sep):
+        if parent in folded:
+            return parent
+        parent = os.path.dirname(parent)
+    return None
+
+
+def count_files(directory):
+    """Returns the number of files (anything but directories) under a directory."""
+
+    return sum(len(files) for _, _, files in os.walk(directory))
+
+
+@profiled
+def compile_shell_init(inventory, selected_env, output_dir=COMPILE_DIR, dry_run=False):
+    """Compiles the shell dotfiles of the selected environments (I.E .bashrc) into
+    output_dir and returns the inventory with their locations replaced by the compiled
+    files, which is what their targets get linked to.
+
+    Each compiled file is the dotfile without blank lines and comments, with every
+    selected shell dotfile it sources (source ~/.aliases, . "$HOME/.aliases" or
+    [ -f ~/.aliases ] && . ~/.aliases) inlined in its place, recursively, so the shell
+    reads a single file at startup. The compile cache records the digest of every
+    input of each compiled file, so files are only compiled again when one of their
+    inputs has changed. With dry_run the files which would be compiled again are
+    compiled to a scratch directory instead, like render_templates() does.
+
+    Args:
+        inventory (Inventory): The dotfiles and their targets
+        selected_env (list): Environments selected by the user via the CLI
+        output_dir (str): The directory the dotfiles are compiled to
+        dry_run (bool): Whether output_dir is left as it is (--check, --diff)
+
+    Returns:
+        inventory (Inventory): The same dotfiles, the shell ones selected compiled"""
+
+    shell = {key: record for key, record in inventory.select(selected_env)[0].items()
+             if is_shell_init(record.target)}
+    if not shell:
+        return inventory
+    # Adding or removing a shell dotfile may change what gets inlined
+    fingerprint = sha1(dumps(sorted((key, record.location)
+                                    for key, record in shell.items())).encode()).hexdigest()
+    cache_file = os.path.join(output_dir, COMPILE_CACHE_FILE)
+    try:
+        with open(cache_file) as f:
+            cache = loads(f.read())
+    except (OSError, ValueError):
+        cache = {}
+
+    compiled = {}
+    compiled_count = 0
+    for record in shell.values():
+        output = os.path.join(os.path.realpath(output_dir),
+                              *env_target_path(record).split("/"))
+        cached = cache.get(record.location)
+        try:
+            if (cached is None or cached["output"] != output
+                    or cached["shell"] != fingerprint or not os.path.isfile(output)
+                    or inputs_changed(cached["inputs"])):
+                inputs = {}
+                lines = compile_shell_file(record.location, shell, inputs)
+                if dry_run:
+                    output = os.path.join(scratch_dir(COMPILE_DIR),
+                                          *env_target_path(record).split("/"))
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                tmp_output = f"{output}.{os.getpid()}.tmp"
+                with open(tmp_output, "w") as f:
+                    f.write("\n".join(lines) + "\n")
+                os.chmod(tmp_output, S_IMODE(os.stat(record.location).st_mode))
+                os.replace(tmp_output, output)
+                forget_target(output)
+                if not dry_run:
+                    cache[record.location] = {"inputs": inputs, "shell": fingerprint,
+                                              "output": output}
+                    compiled_count += 1
+                trace("shell_compiled", location=record.location, output=output,
+                      inputs=len(inputs))
+        except (OSError, ValueError) as err:
+            raise DotfilesError(f"The shell dotfile {record.location} could not be "
+                                f"compiled: {err}") from err
+        compiled[record.location] = output
+
+    if compiled_count:
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(dumps(cache))
+        os.replace(tmp_file, cache_file)
+    trace("shell_compile_done", compiled=compiled_count, shell=len(shell))
+    records = [record._replace(location=compiled.get(record.location, record.location))
+               for record in inventory]
+    deploy = {compiled.get(location, location): mode
+              for location, mode in inventory.deploy.items()}
+    return Inventory(records, [record.target for record in records], deploy)
+
+
+def is_shell_init(target):
+    """Returns True if a target is a dotfile read by the shells, I.E ~/.zshrc"""
+
+    name = os.path.basename(target)
+    return name in SHELL_INIT_NAMES or name.endswith(SHELL_INIT_SUFFIXES)
+
+
+def inputs_changed(inputs):
+    """Returns True if any of the {location: digest} inputs has changed or is gone."""
+
+    try:
+        return any(content_digest(location) != digest
+                   for location, digest in inputs.items())
+    except OSError:
+        return True
+
+
+def compile_shell_file(location, shell, inputs, stack=()):
+    """Returns the lines of a shell dotfile without blank lines and comments and with
+    the shell dotfiles it sources inlined.
+
+    Args:
+        location (str): The dotfile compiled
+        shell (dict): {target: record} with the shell dotfiles which may be inlined
+        inputs (dict): {location: digest} filled with every file read
+        stack (tuple): The locations being inlined, to leave circular sources alone
+
+    Returns:
+        lines (list): The compiled lines"""
+
+    with open(location, encoding="utf-8") as f:
+        text = f.read()
+    inputs[location] = content_digest(location)
+    stack = stack + (location,)
+    lines = strip_shell_comments(text.splitlines(), keep_shebang=len(stack) == 1)
+    compiled = []
+    index = 0
+    while index < len(lines):
+        line, consumed = lines[index], 1
+        source = SHELL_SOURCE.match(line)
+        if_guard = SHELL_IF_GUARD.match(line)
+        if if_guard and index + 2 < len(lines) and lines[index + 2].strip() == "fi":
+            # if [ -f ~/.aliases ]; then . ~/.aliases; fi on three lines
+            inner = SHELL_SOURCE.match(lines[index + 1])
+            if (inner and not inner.group("guard") and
+                    source_key(if_guard.group("guard")) == source_key(inner.group("path"))):
+                source, consumed = inner, 3
+        elif source and source.group("guard") and (source_key(source.group("guard")) !=
+                                                   source_key(source.group("path"))):
+            source = None
+        record = shell.get(source_key(source.group("path"))) if source else None
+        if record is None or record.location in stack:
+            compiled.append(line)
+            index += 1
+            continue
+        compiled.append(f"# {record.target}")
+        compiled.extend(compile_shell_file(record.location, shell, inputs, stack))
+        index += consumed
+    return compiled
+
+
+def source_key(path):
+    """Returns the target key of a path sourced by a shell dotfile or None.
+
+    I.E "$HOME/.aliases", ${HOME}/.aliases and '~/.aliases' all return ~/.aliases"""
+
+    if len(path) > 1 and path[0] == path[-1] and path[0] in "'\"":
+        path = path[1:-1]
+    for home in ("$HOME", "${HOME}"):
+        if path == home or path.startswith(home + "/"):
+            path = "~" + path[len(home):]
+    if path == "~" or path.startswith(("~/", "/")):
+        return target_key(path)
+    return None
+
+
+def strip_shell_comments(lines, keep_shebang=True):
+    """Removes blank lines and full line comments from a shell script, leaving the
+    here-documents and the quoted strings spanning many lines untouched.
+
+    Args:
+        lines (list): The lines of the script
+        keep_shebang (bool): Whether a #! first line is kept
+
+    Returns:
+        lines (list): The lines kept"""
+
+    kept = []
+    quote = heredoc = None
+    for number, line in enumerate(lines):
+        if heredoc is not None:
+            kept.append(line)
+            if (line.lstrip("\t") if heredoc[1] else line) == heredoc[0]:
+                heredoc = None
+            continue
+        if quote is None:
+            if number == 0 and line.startswith("#!"):
+                if keep_shebang:
+                    kept.append(line)
+                continue
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+        kept.append(line)
+        quote, heredoc = scan_shell_line(line, quote)
+    return kept
+
+
+def scan_shell_line(line, quote=None):
+    """Scans a line of shell script and returns the quote still open at its end and
+    the here-document it starts, if any.
+
+    Args:
+        line (str): The line scanned
+        quote (str): The quote open at the start of the line or None
+
+    Returns:
+        quote, heredoc (tuple): The quote or None and (delimiter, strip_tabs) or None"""
+
+    heredoc = None
+    index = 0
+    while index < len(line):
+        char = line[index]
+        if quote == "'":
+            if char == "'":
+                quote = None
+        elif char == "\\":
+            index += 1
+        elif quote == '"':
+            if char == '"':
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == "#" and (index == 0 or line[index - 1] in " \t;|&("):
+            break
+        elif line.startswith("<<<", index):
+            index += 2
+        elif line.startswith("<<", index):
+            match = SHELL_HEREDOC.match(line, index)
+            if match:
+                heredoc = (match.group(3), bool(match.group(1)))
+                index = match.end()
+                continue
+        index += 1
+    return quote, heredoc
+
+
+def verify_symlinks(filtered_dotfiles, root=None, modes=None, repo="."):
+    """ Checks if the filtered_targets are correctly symlinked to the filtered_locations
+    without printing anything.
+
+    Args:
+        filtered_dotfiles: (dict) {filtered_targets: filtered locations}
+        root (str): The directory ~ is expanded to or None for the user's home
+        modes (dict): {location: mode} of the dotfiles not symlinked, see deploy_modes()
+        repo (str): The dotfiles repo, which records the copies deployed
+
+    Returns:
+        symlinks_status (list): [[target, location, is_correct, path_target_str]]
+        where path_target_str is None when the target is not a symlink"""
+
+    symlinks_status = []
+    modes = modes or {}
+    for target, location in filtered_dotfiles.items():
+        status, path_target_str = link_status(location, target, root,
+                                              modes.get(location, "symlink"), repo)
+        symlinks_status.append([target, location, status == "linked", path_target_str])
+    return symlinks_status
+
+
+def link_status(location, target, root=None, mode="symlink", repo="."):
+    """Returns the status of the target of a single dotfile.
+
+    Args:
+        location (str): The dotfile's location
+        target (str): The dotfile's target I.E ~/.vimrc
+        root (str): The directory ~ is expanded to or None for the user's home
+        mode (str): How the dotfile is deployed, one of DEPLOY_MODES
+        repo (str): The dotfiles repo, which records the copies deployed
+
+    Returns:
+        status, path_target_str (tuple): status is "linked" (or deployed), "wrong"
+        (linked to another location or a symlink instead of a copy), "not_linked" or
+        "missing" and path_target_str is the location the target is linked to or None
+        if it isn't a symlink"""
+
+    path_target = expand_target(target, root)
+    target_stat = lstat_target(path_target)
+    if target_stat is None:
+        return "missing", None
+    if mode != "symlink":
+        if S_ISLNK(target_stat.st_mode):
+            return "wrong", link_destination(path_target)
+        return deployed_status(location, path_target, target_stat, repo), None
+    if not S_ISLNK(target_stat.st_mode):
+        target_dir = os.path.dirname(path_target)
+        if os.path.join(real_parent(target_dir), os.path.basename(path_target)) == location:
+            # Linked through a directory folded by --fold
+            return "linked", location
+        return "not_linked", None
+    path_target_str = link_destination(path_target)
+    if path_target_str != location:
+        # The link may point to location through other symlinks
+        path_target_str = os.path.realpath(path_target)
+    return ("linked" if path_target_str == location else "wrong"), path_target_str
+
+
+def deployed_status(location, path, path_stat, repo="."):
+    """Returns "linked" if a target deployed as a hardlink, reflink or copy holds the
+    content of its dotfile and "not_linked" otherwise.
+
+    Hardlinks are checked by inode. Copies are checked against the sha256 recorded in
+    the DEPLOY_STATE_FILE when they were deployed, so as long as neither the copy nor
+    the dotfile has changed nothing is read. Copies which are not recorded are hashed.
+
+    Args:
+        location (str): The dotfile's location
+        path (str): The expanded target
+        path_stat (os.stat_result): The lstat of the target
+        repo (str): The dotfiles repo, which holds the DEPLOY_STATE_FILE
+
+    Returns:
+        status (str): Either linked or not_linked"""
+
+    if not S_ISREG(path_stat.st_mode):
+        return "not_linked"
+    location_stat = os.stat(location)
+    if (path_stat.st_dev, path_stat.st_ino) == (location_stat.st_dev, location_stat.st_ino):
+        return "linked"
+    if path_stat.st_size != location_stat.st_size:
+        return "not_linked"
+    digest = content_digest(location, location_stat)
+    deployed = load_deployed(os.path.join(repo, DEPLOY_STATE_FILE)).get(path)
+    if deployed is not None and deployed["stat"] == list(stat_key(path_stat)):
+        return "linked" if deployed["sha256"] == digest else "not_linked"
+    return "linked" if content_digest(path, path_stat) == digest else "not_linked"
+
+
+def stat_key(file_stat):
+    """Returns (dev, inode, size, mtime), which changes whenever a file is modified."""
+
+    return (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def load_deployed(state_file=DEPLOY_STATE_FILE):
+    """Returns the hardlinks, reflinks and copies recorded by record_deployed(), read
+    again only when the state file has changed.
+
+    Returns:
+        deployed (dict): {path: {"location", "mode", "method", "sha256", "stat"}}"""
+
+    try:
+        key = stat_key(os.stat(state_file))
+    except FileNotFoundError:
+        return {}
+    if _DEPLOYED["key"] != key:
+        try:
+            with open(state_file) as f:
+                entries = loads(f.read())
+        except (OSError, ValueError) as err:
+            trace("deploy_state_unreadable", state_file=state_file, error=err)
+            entries = {}
+        _DEPLOYED.update(key=key, entries=entries)
+    return _DEPLOYED["entries"]
+
+
+def record_deployed(deployed, state_file=DEPLOY_STATE_FILE):
+    """Merges the targets deployed by a run into the state file, holding a lock so the
+    processes reconciling many roots don't overwrite each other's entries.
+
+    Args:
+        deployed (dict): {path: entry from deploy_file() or None to forget the path}
+        state_file (str): The file the deployed targets are recorded in
+
+    Returns:
+        None"""
+
+    import fcntl
+
+    with open(f"{state_file}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(state_file) as f:
+                entries = loads(f.read())
+        except (OSError, ValueError):
+            entries = {}
+        for path, entry in deployed.items():
+            if entry is None:
+                entries.pop(path, None)
+            else:
+                entries[path] = entry
+        tmp_file = f"{state_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(dumps(entries))
+        os.replace(tmp_file, state_file)
+    trace("deploy_state_saved", state_file=state_file, changed=len(deployed))
+
+
+@profiled
+def check_symlinks(filtered_dotfiles, modes=None):
+    """ Checks if the filtered_targets are correctly symlinked to the filtered_locations
+
+    Args:
+        filtered_dotfiles: (dict)
+        modes (dict): {location: mode} of the dotfiles not symlinked, see deploy_modes()
+
+    Returns:
+        erroneous_symlinks (list): dotfiles with no symlinks or with erroneous symlinks
+        [[target, location, None], [target, location, path_target_str]
+"""
+    erroneous_symlinks = []
+    # Checking if symlinks are correctly linked, if not add them to erroneous_symlinks[]
+    for target, location, is_correct, path_target_str in verify_symlinks(
+            filtered_dotfiles, modes=modes):
+        if is_correct:
+            print(f"{SUCCESS_PREFIX} {target} is linked to the correct location.")
+        elif path_target_str is not None:
+            print(f"{WARNING_PREFIX} {target} is linked to the wrong location.")
+            erroneous_symlinks.append([target, location, path_target_str])
+        elif location in (modes or {}):
+            print(f"{WARNING_PREFIX} {target} is NOT an up to date {modes[location]} of "
+                  f"its dotfile.")
+            erroneous_symlinks.append([target, location, None])
+        else:
+            content = content_status(expand_target(target), location)
+            detail = {"identical": " (same content as the dotfile)",
+                      "modified": " (its content differs, see --diff)"}.get(content, "")
+            print(f"{WARNING_PREFIX} {target} has NOT got a symlink{detail}.")
+            erroneous_symlinks.append([target, location, None])
+    
+    trace("symlinks_checked", erroneous=erroneous_symlinks)
+    return erroneous_symlinks
+
+
+@profiled
+def load_selected(selected_env=None, cache=None, workers=DEFAULT_WORKERS,
+    variables=None, compile_shell=False, discovery="scan", untracked=False, deploy=None,
+    dry_run=False):
+    """Scans only the selected environments and returns the dotfiles that win their
+    targets, reading the targets from the inventory cache whenever the dotfiles have
+    not changed.
+
+    Args:
+        selected_env (list): Environments to select or None for all of them
+        cache (dict): The inventory cache from load_inventory_cache() or None
+        workers (int): Number of threads used to read the headers not cached
+        variables (dict): Template variables passed with --var
+        compile_shell (bool): Whether the shell dotfiles are compiled (--compile)
+        discovery (str): The discovery backend passed to discover_dotfiles()
+        untracked (bool): Whether git discovery also finds the untracked dotfiles
+        deploy (dict): {env: mode} from --deploy, see deploy_modes()
+        dry_run (bool): Whether the repo is left as it is (--check, --diff)
+
+    Returns:
+        selected, modes (tuple): [InventoryRecord] one per target and {location: mode}
+        of the dotfiles not symlinked"""
+
+    engine = DotfilesEngine(discovery=discovery, untracked=untracked, variables=variables,
+                            compile_shell=compile_shell, workers=workers, cache=cache,
+                            envs=selected_env, verbose=True, deploy=deploy,
+                            dry_run=dry_run)
+    # stdout may be a bundle or a one line summary, the warnings go to stderr
+    print_collisions(engine.collisions(selected_env), file=stderr)
+    return engine.scan(selected_env), engine.deploy_modes(selected_env)
+
+
+@profiled
+def check_sync(selected, roots=None, modes=None):
+    """Checks whether the targets of the selected dotfiles are linked to them without
+    changing, creating or printing anything.
+
+    Each target costs one lstat() and at most one readlink().
+
+    Args:
+        selected (list): [InventoryRecord] from load_selected()
+        roots (list): Directories ~ is expanded to or None for the user's home
+        modes (dict): {location: mode} of the dotfiles not symlinked, see deploy_modes()
+
+    Returns:
+        statuses (collections.Counter): {status: count} with the statuses returned by
+        link_status()"""
+
+    statuses = Counter()
+    for root in roots or [None]:
+        for record in selected:
+            mode = (modes or {}).get(record.location, "symlink")
+            statuses[link_status(record.location, record.target, root, mode)[0]] += 1
+    trace("check_done", statuses=statuses)
+    return statuses
+
+
+@profiled
+def diff_dotfiles(selected, roots=None, modes=None):
+    """Prints a unified diff between each selected dotfile and its target when the
+    target is a regular file whose content differs from the dotfile, or a link to a
+    rendered template or compiled shell dotfile which would change if rendered or
+    compiled again (see render_templates()).
+
+    Targets are only read when their size matches the dotfile's and their digests are
+    cached by (dev, inode, size, mtime), so a repeated --diff reads nothing new.
+
+    Args:
+        selected (list): [InventoryRecord] from load_selected()
+        roots (list): Directories ~ is expanded to or None for the user's home
+        modes (dict): {location: mode} of the dotfiles not symlinked, see deploy_modes()
+
+    Returns:
+        modified (int): Number of targets whose content differs"""
+
+    modified = 0
+    for root in roots or [None]:
+        for record in selected:
+            mode = (modes or {}).get(record.location, "symlink")
+            status = link_status(record.location, record.target, root, mode)[0]
+            path = expand_target(record.target, root)
+            if status == "wrong" and in_scratch_dir(record.location):
+                path = os.path.realpath(path)
+            elif status != "not_linked":
+                continue
+            if content_status(path, record.location) == "modified":
+                print_diff(record.location, path)
+                modified += 1
+    trace("diff_done", modified=modified)
+    return modified
+
+
+def print_diff(location, path):
+    """Prints the unified diff from a dotfile to its target, or a single line when
+    either of them is binary.
+
+    Args:
+        location (str): The dotfile's location
+        path (str): The expanded target
+
+    Returns:
+        None"""
+
+    from difflib import unified_diff
+
+    with open(location, "rb") as f:
+        old = f.read()
+    with open(path, "rb") as f:
+        new = f.read()
+    if b"\0" in old[:HEADER_SIZE] or b"\0" in new[:HEADER_SIZE]:
+        print(f"Binary files {location} and {path} differ")
+        return
+    colors = {"+": "green", "-": "red", "@": "cyan"}
+    for line in unified_diff(old.decode(errors="replace").splitlines(),
+                             new.decode(errors="replace").splitlines(),
+                             fromfile=location, tofile=path, lineterm=""):
+        color = None if line[:3] in ("---", "+++") else colors.get(line[:1])
+        print(colored(line, color) if color else line)
+
+
+def print_check_summary(statuses):
+    """Prints the one line summary of --check and returns True if nothing drifted.
+
+    Args:
+        statuses (collections.Counter): {status: count} from check_sync()
+
+    Returns:
+        in_sync (bool): True if every target is linked to its dotfile"""
+
+    total = sum(statuses.values())
+    drifted = total - statuses["linked"]
+    if not drifted:
+        print(f"dotfiles: in sync ({total} links)")
+        return True
+    print(f"dotfiles: {drifted} of {total} links drifted ({statuses['missing']} missing, "
+          f"{statuses['wrong']} wrong, {statuses['not_linked']} not linked)")
+    return False
+
+
+def print_syml_changes(erroneous_symlinks):
+    """ Prints the changes that will be performed (Creating or modifying a symlink)
+
+    Args:
+        erroneous_symlinks (list): dotfiles with no symlinks or with erroneous symlinks
+        [[target, location, None], [target, location, path_target_str]
+   
+    Returns:
+        None"""
+    
+    print(f"\n\t2.1 - FIXING SYMLINKS: The following symlinks will be changed on the env")
+    for entries in erroneous_symlinks:
+        target = entries[0]
+        expected_sym = entries[1]
+        current_sym = entries[2]
+        print(f"\tFile: {target}\n"
+              f"\tFrom --> {colored(current_sym, 'red')}\n"
+              f"\tTo   --> {colored(expected_sym, 'green')}\n")
+    return None
+
+
+@profiled
+def fix_symlinks(erroneous_symlinks, workers=DEFAULT_WORKERS, modes=None):
+    """ Receives a list with erroneus symlinks [] and ask the use if he/she wants to
+    modify the symlink. If any symlink is modified, the original file is first backed up.
+
+    Args:
+        erroneous_symlinks (list): dotfiles with no symlinks or with erroneous symlinks
+        [[target, location, None], [target, location, path_target_str]
+        workers (int): Number of threads used to apply the changes
+        modes (dict): {location: mode} of the dotfiles not symlinked, see deploy_modes()
+   
+    Returns:
+        targets_to_source (list): A list of symlinks targets to be changed. If there are 
+        no changes, this function will return None."""
+
+    confirm_changes()
+    try:
+        targets_to_source = apply_symlinks(erroneous_symlinks, workers=workers,
+                                           modes=modes)
+    except Exception as err:
+        print(f"\t{ERROR_PREFIX} {err}")
+        print(f"\t{WARNING_PREFIX} All changes of this run have been rolled back.")
+        logging.exception(f"{ERROR_PREFIX} When creating symlink {err}")
+        exit(1)
+
+    print(f"\t{colored(SUCCESS_PREFIX)} All files have been correctly symlink.")
+    trace("symlinks_fixed", targets=targets_to_source)
+    return targets_to_source
+
+
+def confirm_changes():
+    """Asks the user to confirm the changes and exits if they are declined.
+
+    Returns:
+        None"""
+
+    while True:
+        proceed = input(
+            "\tWould you like to proceed with these changes(y/n)? ").lower()
+        print()
+        if proceed == "y" or proceed == "yes":
+            return
+        elif proceed == "n" or proceed == "no":
+            print(f"\t{colored(ERROR_PREFIX)} EXITING - The symlinks need to be fixed "
+                  f"to continue.")
+            exit(1)
+        else:
+            print('\tInvalid answer - press "y" or "n"\n')
+
+
+@profiled
+def apply_symlinks(erroneous_symlinks, workers=DEFAULT_WORKERS, journal=JOURNAL_FILE,
+    root=None, verbose=True, modes=None, repo="."):
+    """Applies all the symlink changes as a single all-or-nothing step.
+
+    Changes to different targets are applied concurrently. Every change is recorded in
+    a new journal as soon as it is done, including the empty targets created by
+    create_targets(), and the new journal replaces the previous one once all of them
+    succeed, so --rollback always undoes the last successful run. If any of the
+    changes fails, the ones already done in this run are rolled back, the previous
+    journal is kept and the error is raised.
+
+    Args:
+        erroneous_symlinks (list): dotfiles with no symlinks or with erroneous symlinks
+        [[target, location, None], [target, location, path_target_str]
+        workers (int): Number of threads used to apply the changes
+        journal (str): The file the changes are recorded in
+        root (str): The directory ~ is expanded to or None for the user's home
+        verbose (bool): Whether the changes are printed once applied
+        modes (dict): {location: mode} of the dotfiles not deployed as symlinks
+        repo (str): The dotfiles repo, which holds the backups and the copies deployed
+
+    Returns:
+        targets_to_source (list): The expanded targets that have been changed"""
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    modes = modes or {}
+    groups = {}
+    for target, location, _ in erroneous_symlinks:
+        groups.setdefault(expand_target(target, root), []).append(location)
+    if not groups:
+        # Nothing to journal, the journal of the previous run stays rollbackable
+        return []
+
+    journal_lock = Lock()
+    applied = []
+    new_journal = f"{journal}.{os.getpid()}.tmp"
+    with open(new_journal, "w") as journal_file:
+        journal_file.write(dumps({"started": datetime.now().isoformat()}) + "\n")
+        journal_file.flush()
+
+        def apply_group(item):
+            path, locations = item
+            for location in locations:
+                operation = update_symlink(path, location, modes.get(location, "symlink"),
+                                           repo)
+                with journal_lock:
+                    operations = [operation]
+                    if path in _TOUCHED:
+                        # Undone last, removes the empty file create_targets() touched
+                        _TOUCHED.discard(path)
+                        operations.insert(0, {"path": path, "location": None,
+                                              "previous": "missing", "link": None,
+                                              "backup": None, "touched": True})
+                    for operation in operations:
+                        applied.append(operation)
+                        journal_file.write(dumps(operation) + "\n")
+                    journal_file.flush()
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = [pool.submit(apply_group, item) for item in groups.items()]
+            errors = [future.exception() for future in futures if future.exception()]
+        os.fsync(journal_file.fileno())
+
+    if errors:
+        for operation in reversed(applied):
+            undo_operation(operation, repo)
+        refold_dirs([pair for operation in applied for pair in operation.get("unfolded", ())])
+        os.unlink(new_journal)
+        raise errors[0]
+    os.replace(new_journal, journal)
+    applied = [operation for operation in applied if not operation.get("touched")]
+    deployed = {operation["path"]: operation.get("deployed") for operation in applied}
+    state_file = os.path.join(repo, DEPLOY_STATE_FILE)
+    if any(deployed.values()) or (load_deployed(state_file).keys() & deployed.keys()):
+        # Symlinks replacing a copy drop its entry
+        record_deployed(deployed, state_file)
+    if verbose:
+        for operation in applied:
+            print_operation(operation)
+    trace("changes_journaled", journal=journal, changes=len(applied))
+    return list(groups)
+
+
+def backup_file(src, store=BACKUP_DIR):
+    """Backs up a file like ~/.vimrc in the content-addressed backup store.
+
+    The content is stored once under its sha256 in <store>/objects, so backing up the
+    same content again (on any run, for any target or root) only adds an entry to the
+    index. New content is reflinked into the store when the filesystem supports it.
+
+    Args:
+        src (str): I.E ~/.vimrc
+        store (str): The backup store directory
+
+    Returns:
+        digest (str): The sha256 of the content backed up"""
+
+    src = os.path.abspath(os.path.expanduser(src))
+    src_stat = os.stat(src)
+    digest = file_digest(src)
+    blob = blob_path(digest, store)
+    if os.path.exists(blob):
+        trace("backup_deduplicated", path=src, blob=digest)
+    else:
+        os.makedirs(os.path.dirname(blob), mode=0o700, exist_ok=True)
+        tmp_blob = f"{blob}.{os.getpid()}-{get_ident()}.tmp"
+        method = clone_file(src, tmp_blob)
+        os.chmod(tmp_blob, 0o400)
+        os.replace(tmp_blob, blob)
+        trace("backup_stored", path=src, blob=digest, method=method)
+
+    entry = {"target": src, "time": datetime.now().isoformat(timespec="seconds"),
+             "blob": digest, "size": src_stat.st_size, "mode": S_IMODE(src_stat.st_mode)}
+    with _BACKUP_INDEX_LOCK, open(os.path.join(store, "index"), "a") as f:
+        f.write(dumps(entry) + "\n")
+    return digest
+
+
+def blob_path(digest, store=BACKUP_DIR):
+    """Returns the absolute path of a blob of the backup store."""
+
+    return os.path.join(os.path.abspath(store), "objects", digest[:2], digest[2:])
+
+
+def clone_file(src, dst):
+    """Copies src to dst, sharing the blocks of src (reflink) when the filesystem
+    supports it (Btrfs, XFS, ...), falling back to copy_file_range(), which copies in
+    the kernel (and may share blocks on NFS or CIFS), and to a regular copy otherwise.
+
+    Returns:
+        method (str): Either reflink, copy_file_range or copy"""
+
+    from shutil import copyfile
+
+    try:
+        import fcntl
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return "reflink"
+    except (ImportError, OSError):
+        pass
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), DIGEST_CHUNK_SIZE):
+                    pass
+            return "copy_file_range"
+        except OSError:
+            pass
+    copyfile(src, dst)
+    return "copy"
+
+
+def deploy_file(path, location, mode):
+    """Atomically replaces path with a hardlink, reflink or copy of a dotfile.
+
+    Hardlinks fall back to a reflink or copy across filesystems. The copy is made under
+    a temporary name in the same directory and swapped in with os.replace().
+
+    Args:
+        path (str): The expanded target
+        location (str): The dotfile's location
+        mode (str): One of hardlink, reflink or copy
+
+    Returns:
+        deployed (dict): The entry recorded by record_deployed(), with the sha256 of
+        the dotfile and the stat of the copy"""
+
+    from shutil import copyfile
+
+    tmp_path = f"{path}.dotfiles-{os.getpid()}-{get_ident()}.tmp"
+    method = None
+    try:
+        if mode == "hardlink":
+            try:
+                os.link(location, tmp_path)
+                method = "hardlink"
+            except OSError as err:
+                trace("hardlink_failed", path=path, location=location, error=err)
+        if method is None and mode == "copy":
+            copyfile(location, tmp_path)
+            method = "copy"
+        elif method is None:
+            method = clone_file(location, tmp_path)
+        if method != "hardlink":
+            os.chmod(tmp_path, S_IMODE(os.stat(location).st_mode))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    forget_target(path)
+    trace("file_deployed", path=path, location=location, mode=mode, method=method)
+    return {"location": location, "mode": mode, "method": method,
+            "sha256": content_digest(location), "stat": list(stat_key(os.lstat(path)))}
+
+
+def restore_blob(digest, path, mode=None, store=BACKUP_DIR):
+    """Atomically replaces path with the content of a blob of the backup store.
+
+    Args:
+        digest (str): The sha256 of the blob
+        path (str): The expanded path restored
+        mode (int): The permissions of the file restored (Default: 0o644)
+        store (str): The backup store directory
+
+    Returns:
+        None"""
+
+    tmp_path = f"{path}.dotfiles-{os.getpid()}-{get_ident()}.tmp"
+    clone_file(blob_path(digest, store), tmp_path)
+    try:
+        os.chmod(tmp_path, 0o644 if mode is None else mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    forget_target(path)
+
+
+def load_backup_index(store=BACKUP_DIR):
+    """Returns the entries of the backup index, oldest first.
+
+    Returns:
+        entries (list): [{"target", "time", "blob", "size", "mode"}]"""
+
+    entries = []
+    try:
+        with open(os.path.join(store, "index")) as f:
+            for line in f:
+                try:
+                    entries.append(loads(line))
+                except ValueError:
+                    logging.warning(f"Skipping corrupted backup index entry: {line!r}")
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def list_backups(target=None, store=BACKUP_DIR):
+    """Prints the backups stored, optionally only the ones of a target.
+
+    Args:
+        target (str): I.E ~/.vimrc or None for all the targets
+        store (str): The backup store directory
+
+    Returns:
+        None"""
+
+    path = None if target is None else expand_target(target)
+    rows = [["TIME", "TARGET", "SIZE", "BLOB"]]
+    rows += [[entry["time"], entry["target"], str(entry["size"]), entry["blob"][:12]]
+             for entry in load_backup_index(store)
+             if path is None or entry["target"] == path]
+    if len(rows) == 1:
+        print(f"{WARNING_PREFIX} There are no backups in {store}.")
+        return
+    print(render_table(rows))
+
+
+@profiled
+def restore_backup(target, when=None, store=BACKUP_DIR):
+    """Restores the latest backup of a target, or the latest one made at when.
+
+    The current content of the target, if it is a regular file, is backed up first so
+    the restore can be undone with another --restore.
+
+    Args:
+        target (str): I.E ~/.vimrc
+        when (str): A prefix of the backup time I.E 2020-10-10 or 2020-10-10T14:01
+        store (str): The backup store directory
+
+    Returns:
+        None"""
+
+    path = expand_target(target)
+    entries = [entry for entry in load_backup_index(store) if entry["target"] == path
+               and (when is None or entry["time"].startswith(when))]
+    if not entries:
+        print(f"{ERROR_PREFIX} There is no backup of {path}"
+              f"{'' if when is None else f' made at {when}'} in {store}.")
+        exit(1)
+    entry = entries[-1]
+    try:
+        path_stat = os.lstat(path) if os.path.lexists(path) else None
+        if (path_stat is not None and S_ISREG(path_stat.st_mode) and path_stat.st_size
+                and file_digest(path) != entry["blob"]):
+            backup_file(path, store)
+        restore_blob(entry["blob"], path, entry.get("mode"), store)
+    except Exception as err:
+        print(f"{ERROR_PREFIX} {path} could not be restored: {err}")
+        logging.exception(f"{ERROR_PREFIX} {err}")
+        exit(1)
+    print(f"{SUCCESS_PREFIX} {path} has been restored to its backup of {entry['time']}.")
+
+
+@profiled
+def gc_backups(retention_days=BACKUP_RETENTION_DAYS, store=BACKUP_DIR):
+    """Drops the backups older than retention_days and deletes the blobs no longer
+    needed.
+
+    The latest backup of each target is always kept, as well as the blobs referenced
+    by the journals, which are needed by --rollback.
+
+    Args:
+        retention_days (int): Backups made in the last retention_days days are kept
+        store (str): The backup store directory
+
+    Returns:
+        None"""
+
+    cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat(
+        timespec="seconds")
+    entries = load_backup_index(store)
+    latest = {entry["target"]: index for index, entry in enumerate(entries)}
+    kept = [entry for index, entry in enumerate(entries)
+            if entry["time"] >= cutoff or latest[entry["target"]] == index]
+    referenced = {entry["blob"] for entry in kept}
+    # The journals live in the repo holding the store, not in the current dir. Those
+    # of the runs in progress are included, their last line may be incomplete
+    repo = os.path.dirname(os.path.abspath(store))
+    with os.scandir(repo) as repo_entries:
+        journals = [entry.path for entry in repo_entries
+                    if entry.name.startswith(JOURNAL_FILE) and entry.is_file()]
+    for journal in journals:
+        with open(journal) as f:
+            for line in f:
+                try:
+                    backup = loads(line).get("backup") if line.strip() else None
+                except ValueError:
+                    continue
+                if backup:
+                    referenced.add(backup)
+
+    tmp_index = os.path.join(store, f"index.{os.getpid()}.tmp")
+    with open(tmp_index, "w") as f:
+        f.writelines(dumps(entry) + "\n" for entry in kept)
+    os.replace(tmp_index, os.path.join(store, "index"))
+
+    removed_blobs = 0
+    removed_bytes = 0
+    objects_dir = os.path.join(store, "objects")
+    for prefix in os.listdir(objects_dir) if os.path.isdir(objects_dir) else []:
+        prefix_dir = os.path.join(objects_dir, prefix)
+        for name in os.listdir(prefix_dir):
+            if name.endswith(".tmp") or prefix + name in referenced:
+                continue
+            blob = os.path.join(prefix_dir, name)
+            removed_bytes += os.path.getsize(blob)
+            os.unlink(blob)
+            removed_blobs += 1
+    print(f"{SUCCESS_PREFIX} {len(entries) - len(kept)} backups older than "
+          f"{retention_days} days and {removed_blobs} blobs "
+          f"({removed_bytes / 1024:.1f} KB) have been removed from {store}.")
+
+
+@profiled
+def export_bundle(selected, bundle_file):
+    """Streams the selected dotfiles into a gzip compressed tar bundle which
+    --install-bundle links without scanning the repo.
+
+    The first member is a manifest with the target, permissions, size and sha256 of
+    every dotfile, followed by the dotfiles themselves named after their targets, so
+    the bundle can be installed in a single sequential read.
+
+    Args:
+        selected (list): [InventoryRecord] from load_selected()
+        bundle_file (str): The bundle written or - for stdout
+
+    Returns:
+        entries (list): The manifest entries written"""
+
+    import tarfile
+
+    records = sorted(selected, key=lambda record: (record.env, record.name))
+    entries = []
+    for record in records:
+        location_stat = os.stat(record.location)
+        entries.append({"env": record.env, "name": record.name, "target": record.target,
+                        "file": env_target_path(record),
+                        "mode": S_IMODE(location_stat.st_mode),
+                        "size": location_stat.st_size,
+                        "sha256": content_digest(record.location, location_stat)})
+    manifest = dumps({"version": BUNDLE_VERSION,
+                      "created": datetime.now().isoformat(timespec="seconds"),
+                      "envs": sorted({record.env for record in records}),
+                      "entries": entries}, indent=4).encode()
+
+    tmp_file = None if bundle_file == "-" else f"{bundle_file}.{os.getpid()}.tmp"
+    try:
+        with (open(tmp_file, "wb") if tmp_file else
+              open(stdout.fileno(), "wb", closefd=False)) as f, \
+                tarfile.open(fileobj=f, mode="w|gz") as tar:
+            info = tarfile.TarInfo(BUNDLE_MANIFEST)
+            info.size = len(manifest)
+            info.mtime = int(datetime.now().timestamp())
+            tar.addfile(info, BytesIO(manifest))
+            for record, entry in zip(records, entries):
+                info = tarfile.TarInfo(entry["file"])
+                info.size, info.mode = entry["size"], entry["mode"]
+                info.mtime = int(os.stat(record.location).st_mtime)
+                with open(record.location, "rb") as location:
+                    tar.addfile(info, location)
+        if tmp_file:
+            os.replace(tmp_file, bundle_file)
+    except BaseException:
+        if tmp_file and os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+    trace("bundle_exported", bundle_file=bundle_file, entries=len(entries))
+    return entries
+
+
+def env_target_path(record):
+    """Returns a path for a dotfile which is unique as targets are, used to name the
+    dotfiles in bundles and compiled init files: <env>/<target relative to ~> or
+    <env>/_absolute/<target> I.E globals/.vimrc"""
+
+    target = os.path.normpath(record.target)
+    if target == "~" or target.startswith("~/"):
+        return f"{record.env}/{target[2:]}"
+    return f"{record.env}/_absolute/{target.lstrip(os.sep)}"
+
+
+@profiled
+def install_bundle(bundle_file, root=None):
+    """Extracts a bundle written by export_bundle() and links every target to its
+    extracted dotfile, in a single sequential read of the bundle.
+
+    Only the standard library is used, so a new host needs nothing but Python. Targets
+    already linked are left alone, identical files are replaced and any other file is
+    backed up in the backup store of the bundle directory first.
+
+    Args:
+        bundle_file (str): The bundle read or - for stdin
+        root (str): The directory ~ is expanded to or None for the user's home
+
+    Returns:
+        statuses (collections.Counter): {"linked" | "created" | "replaced": count}"""
+
+    import tarfile
+
+    bundle_dir = expand_target(BUNDLE_DIR, root)
+    store = os.path.join(bundle_dir, BACKUP_DIR)
+    statuses = Counter()
+    try:
+        with (open(bundle_file, "rb") if bundle_file != "-" else
+              open(stdin.fileno(), "rb", closefd=False)) as f, \
+                tarfile.open(fileobj=f, mode="r|*") as tar:
+            entries = None
+            for member in tar:
+                if entries is None:
+                    entries = read_bundle_manifest(tar, member)
+                    continue
+                entry = entries.pop(member.name, None)
+                location = os.path.normpath(os.path.join(bundle_dir, member.name))
+                if (entry is None or not member.isfile() or
+                        not location.startswith(bundle_dir + os.sep)):
+                    raise ValueError(f"unexpected member {member.name}")
+                extract_bundle_file(tar.extractfile(member), location, entry)
+                statuses[link_bundle_target(location, expand_target(entry["target"], root),
+                                            store)] += 1
+            if entries is None:
+                raise ValueError("the bundle is empty")
+            if entries:
+                raise ValueError(f"{len(entries)} dotfiles are missing, I.E "
+                                 f"{next(iter(entries))}")
+    except (OSError, ValueError, tarfile.TarError) as err:
+        print(f"{ERROR_PREFIX} {bundle_file} could not be installed: {err}")
+        logging.exception(f"{ERROR_PREFIX} {bundle_file} could not be installed: {err}")
+        exit(1)
+    trace("bundle_installed", bundle_file=bundle_file, root=root, statuses=statuses)
+    return statuses
+
+
+def read_bundle_manifest(tar, member):
+    """Reads the manifest, which must be the first member of a bundle.
+
+    Returns:
+        entries (dict): {member name: manifest entry}"""
+
+    if member.name != BUNDLE_MANIFEST:
+        raise ValueError(f"it is not a dotfiles bundle, its first member is {member.name}")
+    manifest = loads(tar.extractfile(member).read())
+    if manifest.get("version") != BUNDLE_VERSION:
+        raise ValueError(f"unsupported bundle version {manifest.get('version')}")
+    return {entry["file"]: entry for entry in manifest["entries"]}
+
+
+def extract_bundle_file(fileobj, location, entry):
+    """Atomically writes a dotfile of a bundle to location, checking its sha256
+    against the manifest before it replaces the previous version."""
+
+    os.makedirs(os.path.dirname(location), exist_ok=True)
+    tmp_location = f"{location}.dotfiles-{os.getpid()}.tmp"
+    digest = sha256()
+    try:
+        with open(tmp_location, "wb") as f:
+            for chunk in iter(lambda: fileobj.read(DIGEST_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                f.write(chunk)
+        if digest.hexdigest() != entry["sha256"]:
+            raise ValueError(f"{entry['file']} does not match its sha256")
+        os.chmod(tmp_location, entry["mode"])
+        os.replace(tmp_location, location)
+    except BaseException:
+        if os.path.exists(tmp_location):
+            os.unlink(tmp_location)
+        raise
+
+
+def link_bundle_target(location, path, store):
+    """Links an expanded target to a dotfile extracted from a bundle.
+
+    Returns:
+        status (str): Either linked (it already was), created or replaced"""
+
+    path_stat = lstat_target(path)
+    if path_stat is not None and S_ISLNK(path_stat.st_mode):
+        if os.readlink(path) == location:
+            return "linked"
+    elif path_stat is not None:
+        if S_ISDIR(path_stat.st_mode):
+            raise IsADirectoryError(f"{path} is a directory")
+        if path_stat.st_size and not same_content(path, location):
+            backup_file(path, store)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    replace_with_symlink(path, location)
+    return "created" if path_stat is None else "replaced"
+
+
+def replace_with_symlink(path, destination):
+    """Atomically replaces path with a symlink to destination.
+
+    The link is created under a temporary name in the same directory and swapped in
+    with os.replace(), so the path never stops existing."""
+
+    tmp_path = f"{path}.dotfiles-{os.getpid()}-{get_ident()}.tmp"
+    os.symlink(destination, tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    forget_target(path)
+
+
+def unfold_parents(path, repo="."):
+    """Unfolds the directory symlinks created by --fold between / and path, so path can
+    be changed without changing the repo.
+
+    Each folded directory is replaced by a real directory with a symlink to each of its
+    entries, which are unfolded in turn if needed (like GNU Stow does).
+
+    Args:
+        path (str): An expanded target I.E /home/user/.config/nvim/init.vim
+        repo (str): The dotfiles repo (Default: the current dir)
+
+    Returns:
+        unfolded (list): [directory, source] of each directory unfolded, from / down,
+        which refold_dirs() folds back"""
+
+    parent = os.path.dirname(path)
+    if real_parent(parent) == parent:
+        return []
+    repo = os.path.realpath(repo)
+    unfolded = []
+    with _UNFOLD_LOCK:
+        ancestors = []
+        while parent != os.path.dirname(parent):
+            ancestors.append(parent)
+            parent = os.path.dirname(parent)
+        for directory in reversed(ancestors):
+            if not os.path.islink(directory):
+                continue
+            source = os.path.realpath(directory)
+            if source.startswith(repo + os.sep) and os.path.isdir(source):
+                tmp_dir = f"{directory}.dotfiles-{os.getpid()}-{get_ident()}.tmp"
+                os.mkdir(tmp_dir)
+                for name in os.listdir(source):
+                    os.symlink(os.path.join(source, name), os.path.join(tmp_dir, name))
+                os.unlink(directory)
+                os.rename(tmp_dir, directory)
+                unfolded.append([directory, source])
+                trace("dir_unfolded", path=directory, source=source)
+        if unfolded:
+            _LSTAT_CACHE.clear()
+            real_parent.cache_clear()
+    return unfolded
+
+
+def refold_dirs(unfolded):
+    """Folds back the directories unfolded by unfold_parents(), deepest first, when
+    they still hold nothing but the symlinks unfold_parents() created.
+
+    Args:
+        unfolded (list): [directory, source] pairs in the order they were unfolded
+
+    Returns:
+        None"""
+
+    with _UNFOLD_LOCK:
+        for directory, source in reversed(unfolded):
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            if os.path.islink(directory) or any(
+                    not os.path.islink(os.path.join(directory, name)) or
+                    os.readlink(os.path.join(directory, name)) != os.path.join(source, name)
+                    for name in names):
+                print(f"\t{WARNING_PREFIX} {directory} has changed since it was unfolded, "
+                      f"skipping.")
+                continue
+            for name in names:
+                os.unlink(os.path.join(directory, name))
+            os.rmdir(directory)
+            os.symlink(source, directory)
+            trace("dir_refolded", path=directory, source=source)
+        if unfolded:
+            _LSTAT_CACHE.clear()
+            real_parent.cache_clear()
+
+
+def is_folded(path, repo="."):
+    """Returns True if a parent directory of the expanded target is a directory of the
+    repo folded by --fold, which unfold_parents() unfolds before changing path."""
+
+    return real_parent(os.path.dirname(path)).startswith(os.path.realpath(repo) + os.sep)
+
+
+def update_symlink(dotfile, target, mode="symlink", repo="."):
+    """ Updates the current symlink to the correct target.
+
+    Regular files with content are backed up before being replaced, unless their
+    content is identical to the dotfile's. The directories unfolded on the way are
+    recorded in the journal entry, so undoing the change can fold them back.
+
+    Args:
+        dotfile (str): This is the original file to be updated
+        target (str): This is the target to which the dotfile will be symlinnked to
+        mode (str): How the dotfile is deployed, one of DEPLOY_MODES
+        repo (str): The dotfiles repo, which holds the backups
+
+    Returns:
+        operation (dict): The journal entry needed to undo the change"""
+
+    dotfile = expand_target(str(dotfile))
+    unfolded = unfold_parents(dotfile, repo)
+    try:
+        operation = replace_target(dotfile, target, mode, os.path.join(repo, BACKUP_DIR))
+    except BaseException:
+        refold_dirs(unfolded)
+        raise
+    if unfolded:
+        operation["unfolded"] = unfolded
+    trace("symlink_updated", operation=operation)
+    return operation
+
+
+def replace_target(dotfile, target, mode, store=BACKUP_DIR):
+    """Replaces the expanded target with a symlink, hardlink, reflink or copy of the
+    dotfile, see update_symlink().
+
+    Returns:
+        operation (dict): The journal entry needed to undo the change"""
+
+    operation = {"path": dotfile, "location": target, "previous": "missing",
+                 "link": None, "backup": None}
+    dotfile_stat = os.lstat(dotfile) if os.path.lexists(dotfile) else None
+    if dotfile_stat is not None:
+        if S_ISLNK(dotfile_stat.st_mode):
+            operation.update(previous="link", link=os.readlink(dotfile))
+        else:
+            operation.update(previous="file", mode=S_IMODE(dotfile_stat.st_mode))
+            if not dotfile_stat.st_size:
+                pass
+            elif S_ISREG(dotfile_stat.st_mode) and same_content(dotfile, target):
+                # The dotfile holds the same bytes, undo_operation() copies it back
+                operation["identical"] = True
+            else:
+                operation["backup"] = backup_file(dotfile, store)
+
+    if mode == "symlink":
+        replace_with_symlink(dotfile, target)
+    else:
+        operation.update(deploy=mode, deployed=deploy_file(dotfile, target, mode))
+    return operation
+
+
+def print_operation(operation):
+    """Prints the changes made by update_symlink() to a single dotfile."""
+
+    dotfile = operation["path"]
+    if operation["backup"]:
+        print(f'\tThe file: "{dotfile}" has been backed up as --> "'
+              f'{colored(operation["backup"][:12], "cyan")}" (restore it with --restore)')
+    elif operation.get("identical"):
+        print(f'\tThe file: "{dotfile}" had the same content as the dotfile, no backup '
+              f'needed.')
+    verb = DEPLOY_VERBS[operation.get("deploy", "symlink")]
+    print(f'\t{colored(SUCCESS_PREFIX)} The file: "{dotfile}" has been {verb} --> "'
+          f'{colored(operation["location"], "green")}"')
+
+
+def undo_operation(operation, repo="."):
+    """Restores a path to the state recorded in a journal entry. The directories the
+    change unfolded are folded back by the caller with refold_dirs(), once every entry
+    of the run has been undone.
+
+    Args:
+        operation (dict): A journal entry created by update_symlink()
+        repo (str): The dotfiles repo, which holds the backups
+
+    Returns:
+        None"""
+
+    from shutil import copy2
+
+    path = operation["path"]
+    if operation.get("deploy"):
+        changed = os.path.islink(path)
+    else:
+        changed = os.path.islink(path) and os.readlink(path) != operation["location"]
+    if changed:
+        print(f"\t{WARNING_PREFIX} {path} has changed since it was linked, skipping.")
+        return
+    if operation["previous"] == "link":
+        replace_with_symlink(path, operation["link"])
+    elif operation["previous"] == "file":
+        backup = operation["backup"]
+        if operation.get("identical"):
+            tmp_path = f"{path}.dotfiles-{os.getpid()}.tmp"
+            clone_file(operation["location"], tmp_path)
+            os.chmod(tmp_path, operation.get("mode", 0o644))
+            os.replace(tmp_path, path)
+        elif backup and os.sep not in backup:
+            restore_blob(backup, path, operation.get("mode"),
+                         os.path.join(repo, BACKUP_DIR))
+        else:
+            # Journals written before the backup store hold the backup's path instead
+            tmp_path = f"{path}.dotfiles-{os.getpid()}.tmp"
+            if backup:
+                copy2(backup, tmp_path)
+            else:
+                open(tmp_path, "w").close()
+            os.replace(tmp_path, path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+    forget_target(path)
+    trace("symlink_restored", operation=operation)
+
+
+def journal_path(root=None):
+    """Returns the journal file used for the changes made under a root."""
+
+    if root is None:
+        return JOURNAL_FILE
+    return f"{JOURNAL_FILE}-{sha1(root.encode()).hexdigest()[:12]}"
+
+
+@profiled
+def rollback(journal=JOURNAL_FILE, repo=".", verbose=True):
+    """Undoes all the changes recorded in the journal by the last run.
+
+    Args:
+        journal (str): The file the changes were recorded in
+        repo (str): The dotfiles repo, which holds the backups
+        verbose (bool): Whether each path is printed once restored
+
+    Returns:
+        paths (list): The paths restored"""
+
+    try:
+        with open(journal) as f:
+            started = loads(f.readline())["started"]
+            operations = [loads(line) for line in f if line.strip()]
+    except FileNotFoundError as err:
+        raise DotfilesError(
+            f"There is no run to roll back ({journal} not found).") from err
+
+    if verbose:
+        print(f"\nROLLING BACK THE CHANGES MADE ON {started}")
+    for operation in reversed(operations):
+        try:
+            undo_operation(operation, repo)
+        except Exception as err:
+            logging.exception(f"{ERROR_PREFIX} {err}")
+            raise DotfilesError(
+                f"{operation['path']} could not be restored: {err}") from err
+        if verbose:
+            print(f"{SUCCESS_PREFIX} {operation['path']} has been restored.")
+    # Once every path is restored the directories unfolded hold what they did before
+    refold_dirs([pair for operation in operations
+                 for pair in operation.get("unfolded", ())])
+    os.unlink(journal)
+    return [operation["path"] for operation in operations]
+
+
+def path_state(path):
+    """Returns a JSON serialisable fingerprint of a path used to detect whether it has
+    changed between the plan and the apply phases.
+
+    Args:
+        path (str): An expanded target I.E /home/user/.vimrc
+
+    Returns:
+        state (list): None, ["link", destination], ["dir"] or ["file", size, mtime]"""
+
+    path_stat = lstat_target(path)
+    if path_stat is None:
+        return None
+    if S_ISLNK(path_stat.st_mode):
+        return ["link", os.readlink(path)]
+    if S_ISDIR(path_stat.st_mode):
+        return ["dir"]
+    return ["file", path_stat.st_size, path_stat.st_mtime_ns]
+
+
+@profiled
+def build_plan(targets_to_add, files_targets, selected_env, files_envs,
+    filtered_dotfiles, root=None, modes=None, repo="."):
+    """Computes the full changeset for the selected environments without changing
+    anything.
+
+    Args:
+        targets_to_add (list): Non-existent files in the current OS to be created.
+        files_targets (list): Targets where files will be symlinked to on each env
+        selected_env (list): Environments selected by the user via the CLI
+        files_envs (list): Included environments associated to each dotfile
+        filtered_dotfiles (dict): {filtered_targets: filtered locations}
+        root (str): The directory ~ is expanded to or None for the user's home
+        modes (dict): {location: mode} of the dotfiles not symlinked, see deploy_modes()
+        repo (str): The dotfiles repo (Default: the current dir)
+
+    Returns:
+        plan (dict): {"version", "created", "repo", "root", "envs", "create", "links",
+        "backups"}"""
+
+    create = [expand_target(files_targets[index], root)
+              for index, file_to_add in enumerate(targets_to_add)
+              if file_to_add is True and files_envs[index] in selected_env]
+    links = []
+    backups = []
+    modes = modes or {}
+    for target, location, is_correct, path_target_str in verify_symlinks(
+            filtered_dotfiles, root, modes, repo):
+        if is_correct:
+            continue
+        path = expand_target(target, root)
+        state = path_state(path)
+        links.append({"target": target, "path": path, "location": location,
+                      "current": path_target_str, "state": state,
+                      "deploy": modes.get(location, "symlink")})
+        if state is not None and state[0] == "file" and state[1]:
+            backups.append(path)
+    plan = {"version": PLAN_VERSION, "created": datetime.now().isoformat(),
+            "repo": os.path.realpath(repo), "root": root, "envs": selected_env,
+            "create": sorted(set(create)),
+            "links": links, "backups": backups}
+    trace("plan_built", plan=plan)
+    return plan
+
+
+@profiled
+def write_plan(plan, filename):
+    """Writes the plan to a JSON file and prints a summary of it.
+
+    Args:
+        plan (dict): The plan created by build_plan()
+        filename (str): The file the plan will be written to
+
+    Returns:
+        None"""
+
+    try:
+        with open(filename, "w") as f:
+            f.write(dumps(plan, indent=4))
+    except Exception as err:
+        print(f"{ERROR_PREFIX} {err}")
+        logging.exception(f"{ERROR_PREFIX} {err}")
+        exit(1)
+    plans = plan.get("plans", [plan])
+    print(f"\n{SUCCESS_PREFIX} The plan has been written to "
+          f'"{Path(filename).absolute()}": '
+          f'{sum(len(plan["create"]) for plan in plans)} targets to create, '
+          f'{sum(len(plan["links"]) for plan in plans)} symlinks to fix, '
+          f'{sum(len(plan["backups"]) for plan in plans)} backups.')
+
+
+@profiled
+def apply_plan(filename, workers=DEFAULT_WORKERS):
+    """Applies a plan written by --plan without rescanning the repo or asking for
+    confirmation. The plan is only applied if none of the paths it changes have
+    changed since it was created.
+
+    Args:
+        filename (str): The plan file
+        workers (int): Number of threads used to apply the changes
+
+    Returns:
+        targets_to_source (list): The expanded targets that have been changed"""
+
+    try:
+        with open(filename) as f:
+            plan = loads(f.read())
+    except Exception as err:
+        print(f"{ERROR_PREFIX} The plan {filename} cannot be read: {err}")
+        logging.exception(f"{ERROR_PREFIX} {err}")
+        exit(1)
+    if plan.get("version") != PLAN_VERSION:
+        print(f"{ERROR_PREFIX} Unsupported plan version: {plan.get('version')}")
+        exit(1)
+
+    print(f'\nAPPLYING PLAN "{filename}" CREATED ON {plan["created"]}')
+    if "plans" in plan:
+        apply_root_plans(plan["plans"], workers=workers)
+        return []
+
+    changed = plan_changes(plan)
+    if changed:
+        for path in changed:
+            print(f"{ERROR_PREFIX} {path} has changed since the plan was created.")
+        print(f"{ERROR_PREFIX} EXITING - Create a new plan with --plan.")
+        exit(1)
+
+    try:
+        targets_to_source = execute_plan(plan, workers=workers)
+    except Exception as err:
+        print(f"{ERROR_PREFIX} {err}")
+        print(f"{WARNING_PREFIX} All changes of this run have been rolled back.")
+        logging.exception(f"{ERROR_PREFIX} {err}")
+        exit(1)
+    print(f"{SUCCESS_PREFIX} The plan has been applied.")
+    return targets_to_source
+
+
+def plan_changes(plan):
+    """Returns the paths of a plan which have changed since the plan was created."""
+
+    return [link["path"] for link in plan["links"]
+            if path_state(link["path"]) != link["state"]]
+
+
+def execute_plan(plan, workers=DEFAULT_WORKERS, verbose=True):
+    """Creates the missing parent directories and the symlinks of a plan, journaled
+    and backed up in the repo the plan was created from.
+
+    Args:
+        plan (dict): The plan created by build_plan()
+        workers (int): Number of threads used to apply the changes
+        verbose (bool): Whether the changes are printed once applied
+
+    Returns:
+        targets_to_source (list): The expanded targets that have been changed"""
+
+    for path in plan["create"]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    erroneous_symlinks = [[link["path"], link["location"], link["current"]]
+                          for link in plan["links"]]
+    modes = {link["location"]: link["deploy"] for link in plan["links"]
+             if link.get("deploy", "symlink") != "symlink"}
+    repo = plan.get("repo", ".")
+    return apply_symlinks(erroneous_symlinks, workers=workers,
+                          journal=os.path.join(repo, journal_path(plan.get("root"))),
+                          verbose=verbose, modes=modes, repo=repo)
+
+
+def get_roots(values):
+    """Expands the values passed to --root. A value like @roots.txt is replaced by the
+    roots listed in that file, one per line.
+
+    Args:
+        values (list): The values passed to --root
+
+    Returns:
+        roots (list): Absolute paths of the roots, without duplicates"""
+
+    roots = []
+    for value in values:
+        if value.startswith("@"):
+            with open(value[1:]) as f:
+                roots.extend(line.strip() for line in f
+                             if line.strip() and not line.startswith("#"))
+        else:
+            roots.append(value)
+    roots = [os.path.abspath(os.path.expanduser(root)) for root in roots]
+    return list(dict.fromkeys(roots))
+
+
+def _share_inventory(inventory):
+    """Process pool initializer which keeps the inventory in each worker process."""
+
+    global _SHARED_INVENTORY
+    _SHARED_INVENTORY = inventory
+
+
+def _plan_root(root, selected_env, fold=False, env_modes=None):
+    """Builds the plan of a single root from the inventory shared with the worker."""
+
+    return plan_root(_SHARED_INVENTORY, selected_env, root, fold, env_modes)
+
+
+def plan_root(inventory, selected_env, root=None, fold=False, env_modes=None, repo="."):
+    """Builds the plan of a single root without printing anything.
+
+    Args:
+        inventory (Inventory): The dotfiles and their targets
+        selected_env (list): Environments selected by the user via the CLI
+        root (str): The directory ~ is expanded to or None for the user's home
+        fold (bool): Whether the directories are folded, see fold_dotfiles()
+        env_modes (dict): {env: mode} from --deploy, see deploy_modes()
+        repo (str): The dotfiles repo (Default: the current dir)
+
+    Returns:
+        plan (dict): The plan created by build_plan()"""
+
+    modes = deploy_modes(inventory, selected_env, env_modes)
+    if fold:
+        inventory = fold_dotfiles(inventory, selected_env, root, modes, repo)
+    files_targets = inventory.targets
+    targets_to_add = get_nonexistent_targets(inventory.locations, files_targets, root)
+    filtered_dotfiles = select_dotfiles(inventory, selected_env)
+    return build_plan(targets_to_add, files_targets, selected_env, inventory.envs,
+                      filtered_dotfiles, root=root, modes=modes, repo=repo)
+
+
+def _apply_root_plan(plan, workers):
+    """Applies the plan of a single root in a worker process.
+
+    Returns:
+        result (tuple): (root, number of symlinks changed, error or None)"""
+
+    changed = plan_changes(plan)
+    if changed:
+        return plan["root"], 0, f"{len(changed)} paths have changed since the plan " \
+            f"was created, I.E {changed[0]}"
+    try:
+        return plan["root"], len(execute_plan(plan, workers, verbose=False)), None
+    except Exception as err:
+        logging.exception(f"{ERROR_PREFIX} {err}")
+        return plan["root"], 0, f"{err} - All changes have been rolled back."
 
 
-def filter_dotfiles(files_locations, files_targets, files_envs, selected_env):
-    """ 
-    Filters all the files depending on the selected env I.E: --env home
+def pool_size(roots):
+    """Number of worker processes used to reconcile the roots."""
+
+    return max(1, min(len(roots), os.cpu_count() or 1))
+
+
+@profiled
+def reconcile_roots(roots, inventory, selected_env, workers=DEFAULT_WORKERS,
+    plan_file=None, fold=False, env_modes=None):
+    """Checks and fixes the symlinks of many roots from a single scan of the repo.
+
+    The inventory is shared with a pool of worker processes which build a plan for
+    each root. Once the user confirms the changes, the plans are applied by the pool.
 
     Args:
-        files_locations(list): Current files' location, excluding files in .dotignore
-        files_targets (list): Targets where files will be symlinked to on each env
-        files_envs (list): Included environments associated to each dotfile
+        roots (list): Directories ~ is expanded to, I.E /home/user1 /home/user2
+        inventory (Inventory): The dotfiles and their targets
         selected_env (list): Environments selected by the user via the CLI
+        workers (int): Number of threads used by each process to apply the changes
+        plan_file (str): Write the plans to this file instead of applying them
+        fold (bool): Whether the directories are folded, see fold_dotfiles()
+        env_modes (dict): {env: mode} from --deploy, see deploy_modes()
 
     Returns:
-        filtered_dotfiles (dict): {filtered_locations: filtered targets}"""
+        None"""
 
-    selected_env_str = " - ".join(selected_env).upper()
-    print(f'\n2 - CHECKING ALL SYMLINKS ON THE ENVS: "{selected_env_str}"')
-    env_indexes = []
-    
-    for index, env in enumerate(files_envs):
-        if env in selected_env:
-            env_indexes.append(index)
+    from concurrent.futures import ProcessPoolExecutor
 
-    filtered_locations = [files_locations[index] for index in env_indexes]
-    logging.debug(f"filtered_locations: {filtered_locations}")
-    logging.debug(f"Total elements of filtered_locations: {len(filtered_locations)}")
+    selected_env_str = " - ".join(selected_env).upper()
+    print(f'\nCHECKING ALL SYMLINKS ON THE ENVS: "{selected_env_str}" FOR '
+          f'{len(roots)} ROOTS')
+    print_collisions(inventory.select(selected_env)[1])
+    with ProcessPoolExecutor(max_workers=pool_size(roots), initializer=_share_inventory,
+            initargs=(inventory,)) as pool:
+        plans = list(pool.map(_plan_root, roots, [selected_env] * len(roots),
+                              [fold] * len(roots), [env_modes] * len(roots)))
 
-    filtered_targets = [files_targets[index] for index in env_indexes]
-    logging.debug(f"filtered_targets: {filtered_targets}")
-    logging.debug(f"Total elements of filtered_targets: {len(filtered_targets)}")
+    for plan in plans:
+        status = SUCCESS_PREFIX if not plan["links"] else WARNING_PREFIX
+        print(f'{status} {plan["root"]}: {len(plan["links"])} symlinks to fix, '
+              f'{len(plan["backups"])} backups.')
 
-    filtered_dotfiles = (dict(zip(filtered_locations, filtered_targets)))
-    logging.debug(f"filtered_dotfiles: {filtered_dotfiles}")
-    logging.debug(f"Total elements of filtered_dotfiles: {len(filtered_dotfiles)}")
-    
-    return filtered_dotfiles
+    if plan_file:
+        write_plan({"version": PLAN_VERSION, "created": datetime.now().isoformat(),
+                    "repo": os.getcwd(), "plans": plans}, plan_file)
+        return
+    plans = [plan for plan in plans if plan["links"]]
+    if not plans:
+        print(f"{SUCCESS_PREFIX} All roots are correctly symlinked.")
+        return
+    print()
+    confirm_changes()
+    apply_root_plans(plans, workers=workers)
 
 
-def check_symlinks(filtered_dotfiles):
-    """ Checks if the filtered_targets are correctly symlinked to the filtered_locations
+@profiled
+def apply_root_plans(plans, workers=DEFAULT_WORKERS):
+    """Applies the plans of many roots with a pool of worker processes.
 
     Args:
-        filtered_dotfiles: (dict)
+        plans (list): Plans created by build_plan() for each root
+        workers (int): Number of threads used by each process to apply the changes
 
     Returns:
-        erroneous_symlinks (list): dotfiles with no symlinks or with erroneous symlinks
-        [[target, location, None], [target, location, path_target_str]
-"""
-    erroneous_symlinks = []
-    # Checking if symlinks are correctly linked, if not add them to erroneous_symlinks[]
-    for location, target in filtered_dotfiles.items():
-        path_target = Path(target).expanduser()
-        path_target_str = path_target.resolve().as_posix()
-        if path_target.is_symlink():
-            if path_target_str == location:
-                print(
-                    f"{SUCCESS_PREFIX} {target} is linked to the correct location.")
-            else:
-                print(f"{WARNING_PREFIX} {target} is linked to the wrong location.")
-                erroneous_symlinks.append([target, location, path_target_str])
+        None"""
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    roots = [plan["root"] for plan in plans]
+    with ProcessPoolExecutor(max_workers=pool_size(roots)) as pool:
+        results = list(pool.map(_apply_root_plan, plans, [workers] * len(plans)))
+    failed = False
+    for root, changes, error in results:
+        if error:
+            failed = True
+            print(f"{ERROR_PREFIX} {root}: {error}")
         else:
-            print(f"{WARNING_PREFIX} {target} has NOT got a symlink.")
-            erroneous_symlinks.append([target, location, None])
-    
-    logging.debug(f"erroneous_symlinks: {erroneous_symlinks}")
-    logging.debug(f"Total elements of erroneous_symlinks: {len(erroneous_symlinks)}")
-    return erroneous_symlinks
+            print(f"{SUCCESS_PREFIX} {root}: {changes} symlinks have been fixed.")
+    if failed:
+        exit(1)
 
 
-def print_syml_changes(erroneous_symlinks):
-    """ Prints the changes that will be performed (Creating or modifying a symlink)
+def inotify_changes(watch_dirs, skip_dir, watch_files=(), debounce=WATCH_DEBOUNCE):
+    """Yields the sets of paths changed under watch_dirs using Linux's inotify.
+
+    Every directory under watch_dirs is watched, except the excluded ones, and new
+    directories are watched as soon as they are created. Events arriving within the
+    debounce time are yielded together.
 
     Args:
-        erroneous_symlinks (list): dotfiles with no symlinks or with erroneous symlinks
-        [[target, location, None], [target, location, path_target_str]
-   
+        watch_dirs (list): The directories to watch
+        skip_dir (function): Returns True for the directories that are not watched
+        watch_files (list): Files watched through their parent directory only
+        debounce (float): Seconds to wait for more events before yielding a batch
+
     Returns:
-        None"""
-    
-    print(f"\n\t2.1 - FIXING SYMLINKS: The following symlinks will be changed on the env")
-    for entries in erroneous_symlinks:
-        target = entries[0]
-        expected_sym = entries[1]
-        current_sym = entries[2]
-        print(f"\tFile: {target}\n"
-              f"\tFrom --> {colored(current_sym, 'red')}\n"
-              f"\tTo   --> {colored(expected_sym, 'green')}\n")
-    return None
+        changes (generator): Sets of absolute paths that have changed"""
 
+    from ctypes import CDLL, get_errno
+    from ctypes.util import find_library
+    from select import select
+    from struct import unpack_from
 
-def fix_symlinks(erroneous_symlinks):
-    """ Receives a list with erroneus symlinks [] and ask the use if he/she wants to
-    modify the symlink. If any symlink is modified, the original file is first backed up.
+    libc = CDLL(find_library("c") or "libc.so.6", use_errno=True)
+    fd = libc.inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(get_errno(), "inotify_init1 failed")
+    watches = {}
+
+    def add_watch(dir_name, recursive=True):
+        wd = libc.inotify_add_watch(fd, os.fsencode(dir_name), INOTIFY_MASK)
+        if wd >= 0:
+            watches[wd] = dir_name
+        if not recursive:
+            return
+        for entry in os.scandir(dir_name):
+            if entry.is_dir(follow_symlinks=False) and not skip_dir(entry.path):
+                add_watch(entry.path)
+
+    try:
+        for file_name in watch_files:
+            add_watch(os.path.dirname(file_name), recursive=False)
+        for dir_name in watch_dirs:
+            add_watch(dir_name)
+        trace("inotify_watching", dirs=len(watches))
+        while True:
+            changes = set()
+            ready = select([fd], [], [], None)[0]
+            while ready:
+                buffer = os.read(fd, 65536)
+                offset = 0
+                while offset < len(buffer):
+                    wd, mask, _, length = unpack_from("iIII", buffer, offset)
+                    offset += INOTIFY_EVENT_SIZE
+                    name = buffer[offset:offset + length].rstrip(b"\0")
+                    offset += length
+                    if mask & IN_Q_OVERFLOW:
+                        changes.update(watch_files)
+                        changes.update(watch_dirs)
+                        continue
+                    if wd not in watches:
+                        continue
+                    path = os.path.join(watches[wd], os.fsdecode(name))
+                    if mask & IN_IGNORED:
+                        watches.pop(wd)
+                        continue
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        if not skip_dir(path):
+                            add_watch(path)
+                    changes.add(path)
+                ready = select([fd], [], [], debounce)[0]
+            yield changes
+    finally:
+        os.close(fd)
+
+
+def poll_changes(watch_dirs, skip_dir, watch_files=(), interval=WATCH_INTERVAL):
+    """Yields the sets of paths changed under watch_dirs by comparing the
+    (inode, size, mtime) of every file every interval seconds. Used when inotify is not
+    available.
 
     Args:
-        erroneous_symlinks (list): dotfiles with no symlinks or with erroneous symlinks
-        [[target, location, None], [target, location, path_target_str]
-   
-    Returns:
-        targets_to_source (list): A list of symlinks targets to be changed. If there are 
-        no changes, this function will return None."""
+        watch_dirs (list): The directories to watch
+        skip_dir (function): Returns True for the directories that are not watched
+        watch_files (list): Files watched on their own
+        interval (float): Seconds between two snapshots
 
-    while True:
-        proceed = input(
-            "\tWould you like to proceed with these changes(y/n)? ").lower()
-        print()
-        if proceed == "y" or proceed == "yes":
-            targets_to_source = []
-            for entries in erroneous_symlinks:
-                target = entries[0]
-                expected_sym = entries[1]
-                path_target_str = entries[2]
-                symlink_exists =  False if path_target_str is None else True
+    Returns:
+        changes (generator): Sets of absolute paths that have changed"""
 
+    def snapshot():
+        files = {}
+        for file_name in watch_files:
+            try:
+                file_stat = os.stat(file_name)
+                files[file_name] = (file_stat.st_ino, file_stat.st_size,
+                                    file_stat.st_mtime_ns)
+            except OSError:
+                pass
+        pending = list(watch_dirs)
+        while pending:
+            try:
+                entries = list(os.scandir(pending.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not skip_dir(entry.path):
+                        files[entry.path] = None
+                        pending.append(entry.path)
+                    continue
                 try:
-                    original_file = Path(target).expanduser()
-                    if symlink_exists:
-                        backup_file(src=target)
-                        update_symlink(dotfile=original_file, target=expected_sym)
-                        targets_to_source.append(str(original_file))
-                        logging.debug(f"File: {original_file} added to targets_to_source"
-                        )
-                    else:
-                        update_symlink(dotfile=original_file, target=expected_sym)
-                        targets_to_source.append(str(original_file))
-                        logging.debug(f"File: {original_file} added to targets_to_source"
-                        )
+                    entry_stat = entry.stat()
+                except OSError:
                     continue
-                except Exception as err:
-                    print(err)
-                    logging.exception(f"{ERROR_PREFIX} When creating symlink {err}")
-                    exit(1)
-            break
-        elif proceed == "n" or proceed == "no":
-            print(f"\t{colored(ERROR_PREFIX)} EXITING - The symlinks need to be fixed "
-                  f"to continue.")
-            exit(1)
-        else:
-            print('\tInvalid answer - press "y" or "n"\n')
+                files[entry.path] = (entry_stat.st_ino, entry_stat.st_size,
+                                     entry_stat.st_mtime_ns)
+        return files
 
-    print(f"\t{colored(SUCCESS_PREFIX)} All files have been correctly symlink.")
-    logging.debug(f"targets_to_source: {targets_to_source}")
-    return targets_to_source
+    previous = snapshot()
+    while True:
+        sleep(interval)
+        current = snapshot()
+        changes = {path for path in previous.keys() | current.keys()
+                   if previous.get(path, 0) != current.get(path, 0)}
+        previous = current
+        if changes:
+            yield changes
+
+
+def watch_changes(watch_dirs, skip_dir, watch_files=(), interval=WATCH_INTERVAL):
+    """Yields the sets of changed paths with inotify, or by polling if inotify is not
+    available on this system."""
+
+    try:
+        changes = inotify_changes(watch_dirs, skip_dir, watch_files)
+        yield next(changes)
+    except (AttributeError, OSError) as err:
+        trace("inotify_unavailable", error=err, interval=interval)
+        print(f"{WARNING_PREFIX} inotify is not available, polling every {interval}s.")
+        changes = poll_changes(watch_dirs, skip_dir, watch_files, interval)
+    yield from changes
 
 
-def backup_file(src):
-    """Receives a string like ~/.vimrc and creates a backup file like ~/.vimrc-10-10-2020
+def reconcile_dotfiles(dotfiles, files_targets, selected_env, workers=DEFAULT_WORKERS,
+    deploy=None, env_modes=None):
+    """Creates the missing targets and fixes the symlinks of some dotfiles without
+    asking for confirmation.
 
     Args:
-        src (str): I.E ~/.vimrc
+        dotfiles (list): Dotfile(env, location, name) records to reconcile
+        files_targets (list): Targets of each of the dotfiles
+        selected_env (list): Environments selected by the user via the CLI
+        workers (int): Number of threads used to apply the changes
+        deploy (dict): {location: mode} of the DEPLOY= headers
+        env_modes (dict): {env: mode} from --deploy, see deploy_modes()
 
     Returns:
-        None"""
+        targets_to_source (list): The expanded targets that have been changed"""
 
-    src = Path(src).expanduser()
-    today = date.today().strftime("%d-%m-%Y")
-    today_suffix = f"-backup-{today}"
-    backup_file = src.as_posix() + today_suffix
-    try:
-        copy(str(src), backup_file)
-        print(
-            f'\tThe file: "{src}" has been backed up at --> "'
-            f'{colored(backup_file, "cyan")}"')
-        logging.debug(f"File: {src} has been backed up at {backup_file}")
-    except Exception as err:
-        print(err)
-        logging.exception(f"{ERROR_PREFIX} When creating symlink {err}")
-        exit(1)
+    inventory = Inventory(dotfiles, files_targets, deploy)
+    modes = deploy_modes(inventory, selected_env, env_modes)
+    files_locations = inventory.locations
+    for target in files_targets:
+        forget_target(expand_target(target))
+    targets_to_add = get_nonexistent_targets(files_locations, files_targets)
+    if True in targets_to_add:
+        create_targets(
+            targets_to_add, files_targets, selected_env, inventory.envs, files_locations)
+    filtered_dotfiles = select_dotfiles(inventory, selected_env)
+    erroneous_symlinks = check_symlinks(filtered_dotfiles, modes)
+    if not erroneous_symlinks:
+        return []
+    return apply_symlinks(erroneous_symlinks, workers=workers, modes=modes)
 
 
-def update_symlink(dotfile, target):
-    """ Updates the current symlink to the correct target.
+@profiled
+def watch(selected_env, cache=None, workers=DEFAULT_WORKERS, interval=WATCH_INTERVAL,
+    variables=None, env_modes=None):
+    """Keeps the symlinks of the selected environments fixed while the dotfiles are
+    edited.
+
+    The environment directories and .dotignore are watched. Only the dotfiles affected
+    by each change are re-read and checked, unless .dotignore itself changes, in which
+    case the whole repo is scanned again.
+
     Args:
-        dotfile (str): This is the original file to be updated
-        target (str): This is the target to which the dotfile will be symlinnked to
+        selected_env (list): Environments selected by the user via the CLI
+        cache (dict): The inventory cache or None
+        workers (int): Number of threads used to read headers and apply changes
+        interval (float): Seconds between two snapshots when inotify is not available
+        variables (dict): Template variables passed with --var
+        env_modes (dict): {env: mode} from --deploy, see deploy_modes()
 
     Returns:
         None"""
 
-    target = Path(target).expanduser()
-    if target:
-        dotfile.expanduser().unlink()
-        dotfile.expanduser().symlink_to(target)
+    dotignore = os.path.realpath(".dotignore")
+    deploy = {}
 
-    else:
-        dotfile = dotfile.symlink_to(target)
+    def full_scan():
+        is_excluded = compile_exclusions(get_exclusions())
+        environments = [env for env in get_envs(is_excluded) if env in selected_env]
+        dotfiles = scan_dotfiles(environments, is_excluded)
+        deploy.clear()
+        files_targets = get_files_targets(dotfiles, cache=cache, workers=workers,
+                                          deploy=deploy)
+        inventory = dict(zip(dotfiles, files_targets))
+        env_roots = {os.path.realpath(env): env for env in environments}
+        return is_excluded, inventory, env_roots
+
+    def reconcile(affected):
+        rendered = render_inventory(affected, [inventory[dotfile] for dotfile in affected],
+                                    variables, deploy)
+        reconcile_dotfiles(list(rendered), rendered.targets, selected_env, workers,
+                           rendered.deploy, env_modes)
 
-    print(f'\t{colored(SUCCESS_PREFIX)} The file: "{dotfile}" has been symlink --> "'
-          f'{colored(target, "green")}"')
-    logging.debug(f"File: {dotfile} has been symlinked to: {target}")
+    def relative_path(path):
+        env_root = next(env_root for env_root in env_roots
+                        if path.startswith(env_root + os.sep))
+        return env_roots[env_root] + path[len(env_root):]
+
+    def skip_dir(path):
+        return is_excluded(relative_path(path), is_dir=True)
+
+    is_excluded, inventory, env_roots = full_scan()
+    print(f'\nWATCHING THE ENVS: "{" - ".join(selected_env).upper()}" '
+          f"({len(inventory)} dotfiles) - Press Ctrl+C to exit")
+    reconcile(list(inventory))
+
+    try:
+        for changes in watch_changes(list(env_roots), skip_dir, [dotignore], interval):
+            changes = {path for path in changes if path == dotignore or any(
+                path.startswith(env_root + os.sep) for env_root in env_roots)}
+            if not changes:
+                continue
+            print(f"\n[{datetime.now():%H:%M:%S}] {len(changes)} CHANGES DETECTED")
+            try:
+                if dotignore in changes or any(os.path.isdir(path) for path in changes):
+                    is_excluded, inventory, env_roots = full_scan()
+                    affected = list(inventory)
+                else:
+                    by_location = {dotfile.location: dotfile for dotfile in inventory}
+                    affected = []
+                    for path in changes:
+                        dotfile = by_location.get(path)
+                        if dotfile is not None:
+                            del inventory[dotfile]
+                            deploy.pop(path, None)
+                        name = os.path.basename(path)
+                        if (not os.path.isfile(path) or not name.startswith(".") or
+                                is_excluded(relative_path(path))):
+                            continue
+                        dotfile = Dotfile(relative_path(path).split("/")[0], path, name)
+                        try:
+                            inventory[dotfile], deploy[path] = read_header(path)
+                        # Deleted or renamed since the event, like a removal
+                        except FileNotFoundError:
+                            continue
+                        affected.append(dotfile)
+                    # Skip the dotfiles overridden by another one claiming the same target
+                    selected = Inventory(list(inventory),
+                                         list(inventory.values())).select(selected_env)[0]
+                    winners = {(record.env, record.location)
+                               for record in selected.values()}
+                    affected = [dotfile for dotfile in affected
+                                if (dotfile.env, dotfile.location) in winners]
+                if not affected:
+                    continue
+                reconcile(affected)
+            # Errors are reported by the functions above, keep watching anyway
+            except (SystemExit, Exception) as err:
+                logging.exception(f"{ERROR_PREFIX} {err}")
+                print(f"{WARNING_PREFIX} The changes could not be reconciled.")
+    except KeyboardInterrupt:
+        print("\nSTOPPED WATCHING")
 
 
 def print_source_message(targets_to_source):
@@ -477,10 +3930,30 @@ def print_source_message(targets_to_source):
     print(f'\n3 - OPEN A NEW WINDOW FOR CHANGES TO TAKE EFFECT OR ISSUE THE FOLLOWING '
           f'COMMANDS:')
     for target in targets_to_source:
+        if os.path.isdir(target):
+            # A directory folded by --fold
+            continue
         print(f'source {colored(str(target), "green")}')
     print("")
 
 
+def iter_rows(files_locations, files_targets, files_envs):
+    """Yields the table rows one at a time so they can be printed as they are produced
+
+    Args:
+        files_locations(list): Current files' location, excluding files in .dotignore
+        files_targets (list): Targets where files will be symlinked to on each env
+        files_envs (list): Included environments associated to each dotfile
+
+    Returns:
+        rows (generator): [id, name, location, target, env] for each dotfile"""
+
+    for id, location in enumerate(files_locations):
+        target = files_targets[id]
+        yield [id, target.strip("~/"), location, target, files_envs[id]]
+
+
+@profiled
 def create_row_tables(files_locations, files_targets, files_envs):
     """Formats the table rows to be the printed by print_table() 
     
@@ -492,141 +3965,642 @@ def create_row_tables(files_locations, files_targets, files_envs):
     Returns:
         table_data (List of dicts): Returns a list of dictionaries. Each dict is a row"""
 
-    table_data = []
-    for id, location in enumerate(files_locations):
-        name = files_targets[id].strip("~/")
-        target = files_targets[id]
-        env = files_envs[id]
-        rows = [id, name, location, target, env]
-        table_data.append(rows)
-    logging.debug(f"table_data: {table_data}")
+    table_data = list(iter_rows(files_locations, files_targets, files_envs))
+    trace("rows_created", rows=len(table_data))
     return table_data
 
 
-def print_table(table_data, files_envs):
-    """Prints the dotfiles table
+@profiled
+def print_table(table_data, files_envs=None, fmt="table", color=True):
+    """Prints the dotfiles table, streaming the rows as they are produced
 
     Args:
-        table_data (list of dicts): Returns a list of dictionaries. Each dict is a row
-        files_envs (list): Included environments associated to each dotfile
+        table_data (iterable): The rows [id, name, location, target, env], I.E a list
+        from create_row_tables() or the generator from iter_rows()
+        files_envs (list): Included environments associated to each dotfile, used to
+        size the ID column when the rows are a generator
+        fmt (str): "table" (Default), "tsv" or "ndjson"
+        color (bool): Whether the table is colored (only for the "table" format)
     
     Returns:
         None"""
 
-    HEADERS_C = "yellow"
-    logging.debug(f"Table headers color: {HEADERS_C}")
-
-    id = colored(HEADERS[0], HEADERS_C, attrs=["bold", "underline"])
-    name = colored(HEADERS[1], HEADERS_C, attrs=["bold", "underline"])
-    location = colored(HEADERS[2], HEADERS_C, attrs=["bold", "underline"])
-    target = colored(HEADERS[3], HEADERS_C, attrs=["bold", "underline"])
-    env = colored(HEADERS[4], HEADERS_C, attrs=["bold", "underline"])
-    colored_headers = [id, name, location, target, env]
-
-    colored_table_data = table_data.copy()
-    colored_table_data.insert(0, colored_headers)
-
-    first_row_env = colored_table_data[1][4]
-    previous_dir = first_row_env
+    if fmt == "ndjson":
+        header_lowcase = [header.lower() for header in HEADERS]
+        for row in table_data:
+            print(dumps(dict(zip(header_lowcase, row))))
+        return
+    if fmt == "tsv":
+        print("\t".join(HEADERS))
+        for row in table_data:
+            print("\t".join(str(cell) for cell in row))
+        return
 
+    HEADERS_C = "yellow"
     colors = ["cyan", "green", "yellow"]
-    logging.debug(f"Table body colors: {colors}")
     color_pool = cycle(colors)
-    color = next(color_pool)
+    row_color = next(color_pool)
+    rows = iter(table_data)
+    sample = list(islice(rows, TABLE_SAMPLE_ROWS))
+    previous_dir = sample[0][4] if sample else None
 
-    for index, row in enumerate(colored_table_data[1:], start=1):
+    print(f'\nTABLE: ')
+    widths = table_widths(sample)
+    if files_envs:
+        # IDs are passed back on the command line, the column fits the last one
+        widths[0] = max(widths[0], len(str(len(files_envs) - 1)))
+    print_table_row(HEADERS, widths, HEADERS_C if color else None,
+                    attrs=["bold", "underline"], border=True)
+    for row in chain(sample, rows):
         current_dir = row[4]
-
         if previous_dir != current_dir:
-            color = next(color_pool)
+            row_color = next(color_pool)
             previous_dir = current_dir
+        print_table_row(row, widths, row_color if color else None)
+    print(table_border(widths))
 
-        row_id = colored(str(row[0]), color) 
-        row_name = colored(str(row[1]), color)
-        row_loc = colored(str(row[2]), color)
-        row_targ = colored(str(row[3]), color)
-        row_env = colored(str(row[4]), color)
-        colored_table_data[index] = [ row_id, row_name, row_loc, row_targ, row_env] 
 
-    table = AsciiTable(colored_table_data)
-    print(f'\nTABLE: ')
-    print(table.table)
+def table_widths(rows, headers=HEADERS):
+    """Column widths of a table, computed from a sample of its rows and its headers."""
+
+    widths = [len(header) for header in headers]
+    for row in rows:
+        widths = [max(width, len(str(cell))) for width, cell in zip(widths, row)]
+    return widths
+
+
+def table_border(widths):
+    """Returns a border line of a table like +----+------+"""
+
+    return "+" + "+".join("-" * (width + 2) for width in widths) + "+"
+
+
+def print_table_row(row, widths, color=None, attrs=None, border=False):
+    """Prints a single table row padded to the column widths. Text cells wider than
+    their column (the widths come from a sample of the rows) are truncated, the ID is
+    never truncated.
+
+    Args:
+        row (list): The cells of the row
+        widths (list): The width of each column
+        color (str): The termcolor color of the row or None
+        attrs (list): termcolor attributes of the row I.E ["bold"]
+        border (bool): Whether the row is printed between two borders (Headers)
+
+    Returns:
+        None"""
+
+    cells = []
+    for index, (cell, width) in enumerate(zip(row, widths)):
+        cell = str(cell)
+        if len(cell) > width and index:
+            cell = cell[:width - 3] + "..."
+        cell = cell.ljust(width)
+        cells.append(colored(cell, color, attrs=attrs) if color else cell)
+    line = "| " + " | ".join(cells) + " |"
+    if border:
+        line = f"{table_border(widths)}\n{line}\n{table_border(widths)}"
+    print(line)
+
+
+def render_table(rows):
+    """Returns a list of rows as a plain table, the first row being the headers."""
+
+    widths = table_widths(rows[1:], rows[0])
+    lines = [table_border(widths)]
+    for index, row in enumerate(rows):
+        lines.append("| " + " | ".join(str(cell).ljust(width)
+                                       for cell, width in zip(row, widths)) + " |")
+        if index == 0:
+            lines.append(table_border(widths))
+    lines.append(table_border(widths))
+    return "\n".join(lines)
+
+
+def set_color(enabled):
+    """Enables or disables colored output for the rest of the run."""
 
+    if not enabled:
+        os.environ["ANSI_COLORS_DISABLED"] = "1"
+        os.environ["NO_COLOR"] = "1"
 
-def table_to_json_file(table_data,  environments, filename=".db.json"):
-    """ This function turns the table_data[headers,row1,row2,...] into JSON and copies it
-    to the file defined by filename which is passed by the user via CLI. 
+
+@profiled
+def table_to_json_file(table_data,  environments, filename="db.json", since=None):
+    """ This function turns the table rows into JSON and streams them to the file
+    defined by filename which is passed by the user via CLI.
+
+    Each entry gets the link status of its target and a sha256 digest of its content.
+    Files ending in .ndjson or .jsonl get one JSON entry per line, other files get a
+    JSON document {"version": 2, "envs": {env: [entries]}}. The rows are expected to be
+    grouped by env, as they are produced by scan_dotfiles().
+
+    When since is passed, the entries of that previous export whose file and link
+    status haven't changed are copied as they are, so only the changed entries are
+    hashed and serialised again. The file isn't rewritten if nothing has changed.
     
     Args:
-        table_data (List of dicts): Returns a list of dictionaries. Each dict is a row
+        table_data (iterable): The rows [id, name, location, target, env]
         environments (list): Environments(dirs not excluded)
         filename (str): The filename to write the table to (JSON serialised).
+        since (str): A previous export of the table or None
 
     Returns:
         None"""
 
-    rows = table_data[1:]
-    logging.debug(f"Table Headers: {HEADERS}")
-    logging.debug(f"Table rows: {rows}")
-
-    if len(HEADERS) != len(rows[0]):
-        print(f"{ERROR_PREFIX} headers and rows' lengths are different.")
-        logging.exception(f"{ERROR_PREFIX} headers and rows' lengths are different")
-        exit(1)
-    
+    ndjson = filename.endswith((".ndjson", ".jsonl"))
+    previous = load_export(since) if since else {}
     header_lowcase = [header.lower() for header in HEADERS]
-    db_dict = {"version": 1, "envs": {}}
-    for row in rows:
-        row_dict = dict(zip(header_lowcase, row))
-        env_name = row_dict["env"]
-        if env_name in environments:
-            row_dict.pop('env')
-            if env_name in db_dict["envs"].keys():
-                db_dict['envs'][env_name].append(row_dict)
-                logging.debug(f"Adding: {row_dict} to db_dict")
-            else:
-                db_dict['envs'].update({env_name: [row_dict]})
-                logging.debug(f'Updating Env: "{env_name.upper()}" on db_dict')
-    pprint(db_dict)
-    db_json = dumps(db_dict, indent=4, sort_keys=True)
-
+    changed = 0
+    total = 0
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
     try:
-        with open(filename, "w") as f:
-            f.write(db_json)
-        # return db_json
+        with open(tmp_file, "w") as f:
+            if not ndjson:
+                f.write(f'{{"version": {EXPORT_VERSION}, "envs": {{')
+            current_env = None
+            for row in table_data:
+                entry = dict(zip(header_lowcase, row))
+                env_name = entry["env"]
+                if env_name not in environments:
+                    continue
+                file_stat = os.stat(entry["location"])
+                entry["status"] = link_status(entry["location"], entry["target"])[0]
+                entry.update(size=file_stat.st_size, mtime=file_stat.st_mtime_ns)
+                previous_entry, previous_line = previous.get(entry["location"],
+                                                             (None, None))
+                if (previous_entry is not None and
+                        all(previous_entry.get(key) == value
+                            for key, value in entry.items())):
+                    line = previous_line if ndjson else dumps(previous_entry)
+                else:
+                    entry["sha256"] = file_digest(entry["location"])
+                    line = dumps(entry)
+                    changed += 1
+                total += 1
+                if ndjson:
+                    f.write(line.rstrip("\n") + "\n")
+                    continue
+                if env_name != current_env:
+                    f.write("\n    ]," if current_env is not None else "")
+                    f.write(f"\n  {dumps(env_name)}: [\n    ")
+                    current_env = env_name
+                else:
+                    f.write(",\n    ")
+                f.write(line)
+            if not ndjson:
+                f.write("\n    ]\n  }}\n" if current_env is not None else "}}\n")
+        removed = len(previous.keys()) - (total - changed)
         db_file = Path(filename).absolute()
-        print(f'\n{SUCCESS_PREFIX} The json file has been written to "{db_file}"')
-        logging.debug(f'The json file has been written to "{db_file}"')
+        if since and not changed and not removed and os.path.exists(filename):
+            os.unlink(tmp_file)
+            print(f'\n{SUCCESS_PREFIX} Nothing has changed since "{since}", "{db_file}" '
+                  f'has not been rewritten')
+            return
+        os.replace(tmp_file, filename)
+        print(f'\n{SUCCESS_PREFIX} The json file has been written to "{db_file}" '
+              f'({total} entries, {changed} changed)')
+        trace("json_written", filename=db_file)
     except Exception as err:
         print(f"{ERROR_PREFIX} {err}")
         logging.exception(f"{ERROR_PREFIX} {err}")
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+
+
+def load_export(filename):
+    """Loads a previous export written by table_to_json_file().
+
+    Args:
+        filename (str): The previous export
+
+    Returns:
+        entries (dict): {location: (entry, line)} where line is the entry as it was
+        written in the file. Empty if the file doesn't exist or can't be read."""
+
+    entries = {}
+    try:
+        with open(filename) as f:
+            if filename.endswith((".ndjson", ".jsonl")):
+                for line in f:
+                    if line.strip():
+                        entry = loads(line)
+                        entries[entry["location"]] = (entry, line)
+                return entries
+            db_dict = loads(f.read())
+    except (OSError, ValueError) as err:
+        trace("export_unreadable", filename=filename, error=err)
+        return {}
+    if db_dict.get("version") != EXPORT_VERSION:
+        return {}
+    for env_name, env_entries in db_dict["envs"].items():
+        for entry in env_entries:
+            entries[entry["location"]] = (entry, None)
+    return entries
+
+
+def file_digest(file_name):
+    """Returns the sha256 of a file, read in chunks into a single reused buffer."""
+
+    digest = sha256()
+    buffer = bytearray(DIGEST_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(file_name, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+def content_digest(path, path_stat=None):
+    """Returns the sha256 of a file, cached by (dev, inode, size, mtime) for the whole
+    run and between runs through the inventory cache.
+
+    Args:
+        path (str): The file to hash
+        path_stat (os.stat_result): The stat of the file if already known
+
+    Returns:
+        digest (str): The hex digest of the file's content"""
+
+    path_stat = path_stat or os.stat(path)
+    key = (path_stat.st_dev, path_stat.st_ino, path_stat.st_size, path_stat.st_mtime_ns)
+    cached = _DIGEST_CACHE.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    digest = file_digest(path)
+    # The scratch dir of a dry run is removed on exit, its digests are never reused
+    if not in_scratch_dir(path):
+        _DIGEST_CACHE[path] = (key, digest)
+    trace("digest_computed", path=path, size=path_stat.st_size)
+    return digest
+
+
+def same_content(path, location):
+    """Returns True if the file at path has the same content as the dotfile.
+
+    The sizes are compared first so files that differ in size are never read.
+
+    Args:
+        path (str): An expanded target that is a regular file
+        location (str): The dotfile's location
+
+    Returns:
+        bool"""
+
+    path_stat = os.stat(path)
+    location_stat = os.stat(location)
+    if (path_stat.st_dev, path_stat.st_ino) == (location_stat.st_dev, location_stat.st_ino):
+        return True
+    if path_stat.st_size != location_stat.st_size:
+        return False
+    return content_digest(path, path_stat) == content_digest(location, location_stat)
+
+
+def content_status(path, location):
+    """Returns "identical" or "modified" for a target that is a regular file with
+    content and None for anything else or when either file cannot be read."""
+
+    path_stat = lstat_target(path)
+    if path_stat is None or not S_ISREG(path_stat.st_mode) or not path_stat.st_size:
+        return None
+    try:
+        return "identical" if same_content(path, location) else "modified"
+    except OSError as err:
+        trace("content_unreadable", path=path, error=err)
+        return None
+
+
+class DotfilesEngine:
+    """The inventory of a dotfiles repo kept in memory, for programs which query and
+    link dotfiles many times without paying a rescan each time, I.E a provisioning
+    agent:
+
+        engine = DotfilesEngine("~/dotfiles")
+        engine.check(["globals", "home"])   # {"~/.vimrc": "linked", ...}
+        engine.apply(engine.plan(["globals", "home"]))
+        engine.rollback()                   # Undoes the last apply
+        engine.refresh()                    # After a git pull
+
+    Nothing is printed, asked or exited: a missing .dotignore, invalid dotfiles and
+    stale plans raise a DotfilesError and filesystem errors an OSError. The repo is
+    passed to every function called, the working directory is never changed, and
+    each call holds the engine's lock.
+
+    Args:
+        repo (str): The dotfiles repo
+        discovery (str): "scan" or "git", see discover_dotfiles()
+        untracked (bool): Whether git discovery also finds the untracked dotfiles
+        variables (dict): Template variables, like --var
+        compile_shell (bool): Whether the shell dotfiles are compiled, like --compile
+        workers (int): Number of threads used to read headers and apply changes
+        cache (dict): An inventory cache, I.E from load_inventory_cache(), updated in
+        place. By default the cache only lives in the engine
+        envs (list): Only discover these environments (Default: all of them)
+        verbose (bool): Whether discovery warnings are printed (used by the CLI)
+        deploy (dict): {env: mode}, like --deploy, the env None for all the envs
+        dry_run (bool): Leave the rendered templates and compiled shell dotfiles of the
+        repo as they are, for engines which only check, see render_templates()"""
+
+    def __init__(self, repo=".", discovery="scan", untracked=False, variables=None,
+                 compile_shell=False, workers=DEFAULT_WORKERS, cache=None, envs=None,
+                 verbose=False, deploy=None, dry_run=False):
+        self.repo = os.path.realpath(os.path.expanduser(repo))
+        self.discovery = discovery
+        self.untracked = untracked
+        self.variables = variables
+        self.compile_shell = compile_shell
+        self.workers = workers
+        self.cache = {} if cache is None else cache
+        self.envs = envs
+        self.verbose = verbose
+        self.deploy = deploy
+        self.dry_run = dry_run
+        self.environments = []
+        self.inventory = None
+        self._lock = RLock()
+
+    def refresh(self):
+        """Discovers the dotfiles again. Only the headers of the dotfiles whose stat has
+        changed are read again and, with git discovery, nothing is listed when HEAD and
+        the index have not changed.
+
+        Returns:
+            inventory (Inventory): The dotfiles and their targets"""
+
+        with self._lock:
+            is_excluded = compile_exclusions(get_exclusions(self.repo))
+            self.environments, dotfiles = discover_dotfiles(
+                is_excluded, self.envs, self.discovery, self.untracked,
+                verbose=self.verbose, repo=self.repo)
+            deploy = {}
+            files_targets = get_files_targets(dotfiles, cache=self.cache,
+                                              workers=self.workers, deploy=deploy)
+            self.inventory = render_inventory(dotfiles, files_targets, self.variables,
+                                              deploy, self.dry_run, self.repo)
+            trace("engine_refreshed", repo=self.repo, dotfiles=len(self.inventory))
+            return self.inventory
+
+    def inventory_for(self, selected_env=None):
+        """Returns the inventory, refreshed if it never was, with the shell dotfiles of
+        the selected environments compiled if needed, and the environments selected
+        (Default: all of them).
+
+        Returns:
+            inventory, selected_env (tuple): The Inventory and the environments"""
+
+        with self._lock:
+            if self.inventory is None:
+                self.refresh()
+            selected_env = list(selected_env or self.environments)
+            inventory = self.inventory
+            if self.compile_shell:
+                inventory = compile_shell_init(
+                    inventory, selected_env, os.path.join(self.repo, COMPILE_DIR),
+                    self.dry_run)
+            return inventory, selected_env
+
+    def scan(self, selected_env=None):
+        """Returns the dotfiles of the selected environments (Default: all of them)
+        that win their targets, from memory.
+
+        Returns:
+            selected (list): [InventoryRecord] one per target"""
+
+        inventory, envs = self.inventory_for(selected_env)
+        return list(inventory.select(envs)[0].values())
+
+    def collisions(self, selected_env=None):
+        """Returns {target: [InventoryRecord]} for the targets claimed by many dotfiles
+        of the selected environments, the one selected last."""
+
+        inventory, envs = self.inventory_for(selected_env)
+        return inventory.select(envs)[1]
+
+    def deploy_modes(self, selected_env=None):
+        """Returns {location: mode} for the selected dotfiles not deployed as symlinks,
+        see deploy_modes()."""
+
+        inventory, envs = self.inventory_for(selected_env)
+        return deploy_modes(inventory, envs, self.deploy)
+
+    def check(self, selected_env=None, root=None):
+        """Returns the status of the target of each selected dotfile.
+
+        Args:
+            selected_env (list): Environments to check (Default: all of them)
+            root (str): The directory ~ is expanded to or None for the user's home
+
+        Returns:
+            statuses (dict): {target: status} with the statuses of link_status()"""
+
+        with self._lock:
+            inventory, envs = self.inventory_for(selected_env)
+            modes = deploy_modes(inventory, envs, self.deploy)
+            forget_filesystem()
+            return {record.target: link_status(record.location, record.target, root,
+                                               modes.get(record.location, "symlink"),
+                                               self.repo)[0]
+                    for record in inventory.select(envs)[0].values()}
+
+    def plan(self, selected_env=None, root=None, fold=False):
+        """Computes the changes needed to link the selected dotfiles without changing
+        anything.
+
+        Returns:
+            plan (dict): The plan created by build_plan(), to pass to apply()"""
+
+        with self._lock:
+            inventory, envs = self.inventory_for(selected_env)
+            forget_filesystem()
+            return plan_root(inventory, envs, root, fold, self.deploy, self.repo)
+
+    def apply(self, plan):
+        """Applies a plan from plan() as a single all-or-nothing step, recorded in the
+        journal of its root so it can be rolled back.
+
+        Returns:
+            targets (list): The expanded targets that have been changed"""
+
+        with self._lock:
+            forget_filesystem()
+            changed = plan_changes(plan)
+            if changed:
+                raise DotfilesError(f"{len(changed)} paths have changed since the plan "
+                                    f"was created, I.E {changed[0]}")
+            return execute_plan(plan, workers=self.workers, verbose=False)
+
+    def rollback(self, root=None):
+        """Undoes the last plan applied under a root, like --rollback.
+
+        Args:
+            root (str): The root the plan was applied under or None for the user's home
+
+        Returns:
+            paths (list): The paths restored"""
+
+        with self._lock:
+            forget_filesystem()
+            return rollback(os.path.join(self.repo, journal_path(root)), self.repo,
+                            verbose=False)
+
+
+def forget_filesystem():
+    """Drops the stats cached by lstat_target() and real_parent(), so a long lived
+    process sees the targets as they are now."""
+
+    _LSTAT_CACHE.clear()
+    real_parent.cache_clear()
 
 
 def main():
 
     cli_args = parse_arguments()
 
-    conf_logging(debug=cli_args.debug)
-    logging.debug(f"CLI ARGS: {cli_args}")
+    conf_logging(debug=cli_args.debug, trace_file=cli_args.trace)
+    trace("cli_args", args=vars(cli_args))
+
+    if cli_args.no_color:
+        set_color(False)
+
+    if cli_args.profile or cli_args.profile_json or cli_args.profile_samples:
+        start_profiling(json_file=cli_args.profile_json,
+                        samples_file=cli_args.profile_samples)
     
     selected_env = cli_args.env
 
-    exclusions = get_exclusions()
+    if cli_args.install_bundle:
+        if cli_args.install_bundle == "-" and len(cli_args.root or []) > 1:
+            print(f"{ERROR_PREFIX} A bundle read from stdin can only be installed under "
+                  f"one root.")
+            exit(1)
+        for root in cli_args.root or [None]:
+            statuses = install_bundle(cli_args.install_bundle, root)
+            print(f"{SUCCESS_PREFIX} {statuses['created']} links created, "
+                  f"{statuses['replaced']} replaced and {statuses['linked']} already "
+                  f"linked under {expand_target('~', root)}.")
+        return
+
+    if cli_args.export_bundle:
+        cache = None if cli_args.no_cache else load_inventory_cache()
+        selected, _ = load_selected(selected_env, cache=cache, workers=cli_args.workers,
+                                    variables=cli_args.var, compile_shell=cli_args.compile,
+                                    discovery=cli_args.discovery,
+                                    untracked=cli_args.untracked)
+        if cache is not None:
+            save_inventory_cache(cache)
+        entries = export_bundle(selected, cli_args.export_bundle)
+        if cli_args.export_bundle != "-":
+            print(f"{SUCCESS_PREFIX} {len(entries)} dotfiles have been bundled in "
+                  f"{cli_args.export_bundle}.")
+        return
+
+    if cli_args.check or cli_args.diff:
+        cache = None if cli_args.no_cache else load_inventory_cache()
+        cached_entries = dict(cache or {})
+        cached_digests = dict(_DIGEST_CACHE)
+        cached_discovery = dict(_DISCOVERY_CACHE)
+        selected, modes = load_selected(
+            selected_env, cache=cache, workers=cli_args.workers, variables=cli_args.var,
+            compile_shell=cli_args.compile, discovery=cli_args.discovery,
+            untracked=cli_args.untracked, deploy=cli_args.deploy, dry_run=True)
+        if cli_args.diff:
+            modified = diff_dotfiles(selected, roots=cli_args.root, modes=modes)
+        else:
+            statuses = check_sync(selected, roots=cli_args.root, modes=modes)
+        if cache is not None and (cache != cached_entries or
+                                  _DIGEST_CACHE != cached_digests or
+                                  _DISCOVERY_CACHE != cached_discovery):
+            save_inventory_cache(cache)
+        if cli_args.diff:
+            print(f"dotfiles: {modified} target(s) differ from their dotfiles" if modified
+                  else "dotfiles: no target differs from its dotfile")
+            exit(1 if modified else 0)
+        exit(0 if print_check_summary(statuses) else 1)
+
+    if cli_args.rollback:
+        for root in cli_args.root or [None]:
+            rollback(journal_path(root))
+        return
+
+    if cli_args.backups:
+        list_backups(None if cli_args.backups is True else cli_args.backups)
+        return
+
+    if cli_args.restore:
+        restore_backup(*cli_args.restore)
+        return
 
-    environments = get_envs(exclusions)
+    if cli_args.gc is not None:
+        gc_backups(cli_args.gc)
+        return
 
-    files_envs = get_files_envs(environments, exclusions)
+    if cli_args.apply:
+        targets_to_source = apply_plan(cli_args.apply, workers=cli_args.workers)
+        if targets_to_source:
+            print_source_message(targets_to_source)
+        return
+
+    if cli_args.watch:
+        cache = None if cli_args.no_cache else load_inventory_cache()
+        watch(selected_env, cache=cache, workers=cli_args.workers, variables=cli_args.var,
+              env_modes=cli_args.deploy)
+        if cache is not None:
+            save_inventory_cache(cache)
+        return
+
+    cache = None if cli_args.no_cache else load_inventory_cache()
+
+    engine = DotfilesEngine(discovery=cli_args.discovery, untracked=cli_args.untracked,
+                            variables=cli_args.var, compile_shell=cli_args.compile,
+                            workers=cli_args.workers, cache=cache, verbose=True,
+                            deploy=cli_args.deploy)
+    inventory = engine.refresh()
+    environments = engine.environments
 
-    files_locations = get_files_locations(environments, exclusions)
+    if cache is not None:
+        save_inventory_cache(cache)
 
-    files_targets = get_files_targets(files_locations)
+    files_locations, files_targets, files_envs = (
+        inventory.locations, inventory.targets, inventory.envs)
 
     if not selected_env:
-        table_data = create_row_tables(
-            files_locations, files_targets, files_envs)
-        print_table(table_data, files_envs)
+        table_data = iter_rows(files_locations, files_targets, files_envs)
+        print_table(table_data, files_envs, fmt=cli_args.format,
+                    color=not cli_args.no_color)
+
+    # The JSON export lists the dotfiles themselves, not the folded directories or the
+    # compiled shell dotfiles
+    exported = inventory
+    if selected_env:
+        inventory, selected_env = engine.inventory_for(selected_env)
+        files_locations = inventory.locations
 
     # selected_env=["globals", "home"]
+    if selected_env and cli_args.root:
+        reconcile_roots(cli_args.root, inventory, selected_env, workers=cli_args.workers,
+                        plan_file=cli_args.plan, fold=cli_args.fold,
+                        env_modes=cli_args.deploy)
+        return
+
+    collisions = None
+    modes = deploy_modes(inventory, selected_env, cli_args.deploy) if selected_env else {}
+    if selected_env and cli_args.fold:
+        collisions = inventory.select(selected_env)[1]
+        inventory = fold_dotfiles(inventory, selected_env, modes=modes)
+        files_locations, files_targets, files_envs = (
+            inventory.locations, inventory.targets, inventory.envs)
+
+    if selected_env and cli_args.plan:
+        targets_to_add = get_nonexistent_targets(files_locations, files_targets)
+        filtered_dotfiles = filter_dotfiles(inventory, selected_env, collisions)
+        plan = build_plan(targets_to_add, files_targets, selected_env, files_envs,
+                          filtered_dotfiles, modes=modes)
+        write_plan(plan, cli_args.plan)
+        return
+
     if selected_env:
         targets_to_add = get_nonexistent_targets(
             files_locations, files_targets)
@@ -638,20 +4612,34 @@ def main():
             print(f'\n1 - CHECKING IF TARGETS EXISTS IN THE OS\n'
                   f'{SUCCESS_PREFIX} All targets exist in the OS.')
 
-        filtered_dotfiles = filter_dotfiles(
-            files_locations, files_targets,files_envs, selected_env)
+        filtered_dotfiles = filter_dotfiles(inventory, selected_env, collisions)
 
-        erroneous_symlinks = check_symlinks(filtered_dotfiles)
+        erroneous_symlinks = check_symlinks(filtered_dotfiles, modes)
 
         if erroneous_symlinks:
             print_syml_changes(erroneous_symlinks)
-            targets_to_source = fix_symlinks(erroneous_symlinks)
+            targets_to_source = fix_symlinks(erroneous_symlinks, workers=cli_args.workers,
+                                             modes=modes)
             print_source_message(targets_to_source)
 
     # cli_args.json = "db.json"
     if cli_args.json:
-        table_to_json_file(table_data, environments, filename=cli_args.json)
+        since = cli_args.json if cli_args.since is True else cli_args.since
+        table_data = iter_rows(exported.locations, exported.targets, exported.envs)
+        table_to_json_file(table_data, environments, filename=cli_args.json, since=since)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        main()
+    except BrokenPipeError:
+        # The output was piped to a command which exited early, I.E head
+        os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+        exit(1)
+    except DotfilesError as err:
+        print(f"{ERROR_PREFIX} {err}")
+        logging.exception(f"{ERROR_PREFIX} {err}")
+        exit(1)
+    except Exception as err:
+        logging.exception(f"{ERROR_PREFIX} {err}")
+        raise
\ No newline at end of file
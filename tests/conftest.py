@@ -0,0 +1,49 @@
+import os
+import sys
+
+import pytest
+
+# dotfiles.py is a script, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dotfiles  # noqa: E402
+
+DOTFILES = {
+    "globals/.vimrc": "set number\n",
+    "globals/.aliases": "# TARGET=~/.bash_aliases\nalias ll='ls -l'\n",
+    "home/.zshrc": "export EDITOR=vim\n",
+}
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    """Drops the state dotfiles keeps for the whole run, as each test is a new run."""
+
+    yield
+    dotfiles.forget_filesystem()
+    dotfiles._DIGEST_CACHE.clear()
+    dotfiles._DISCOVERY_CACHE.clear()
+    dotfiles._TOUCHED.clear()
+    dotfiles._DEPLOYED.update(key=None, entries={})
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """An empty home directory, ~ is expanded to it."""
+
+    home = tmp_path / "home"
+    home.mkdir()
+    monkeypatch.setenv("HOME", str(home))
+    return str(home)
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A dotfiles repo with the globals and home envs, see DOTFILES."""
+
+    repo = tmp_path / "repo"
+    for path, content in DOTFILES.items():
+        (repo / path).parent.mkdir(parents=True, exist_ok=True)
+        (repo / path).write_text(content)
+    (repo / ".dotignore").write_text("")
+    return os.path.realpath(str(repo))
@@ -0,0 +1,45 @@
+import os
+
+from dotfiles import (BACKUP_DIR, JOURNAL_FILE, apply_symlinks, backup_file, blob_path,
+                      gc_backups, load_backup_index)
+
+
+def write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_same_content_is_stored_once(repo, home):
+    store = os.path.join(repo, BACKUP_DIR)
+    write(os.path.join(home, ".vimrc"), "same\n")
+    write(os.path.join(home, ".zshrc"), "same\n")
+
+    digests = {backup_file("~/.vimrc", store), backup_file("~/.zshrc", store)}
+
+    assert len(digests) == 1
+    assert len(load_backup_index(store)) == 2
+    assert os.path.exists(blob_path(digests.pop(), store))
+
+
+def test_gc_keeps_backups_referenced_by_journals(repo, home, tmp_path, monkeypatch):
+    store = os.path.join(repo, BACKUP_DIR)
+    vimrc = os.path.join(home, ".vimrc")
+    write(vimrc, "dropped\n")
+    dropped = backup_file(vimrc, store)
+    # The run journaled replaces the next content of ~/.vimrc
+    write(vimrc, "journaled\n")
+    apply_symlinks([["~/.vimrc", os.path.join(repo, "globals", ".vimrc"), None]],
+                   journal=os.path.join(repo, JOURNAL_FILE), verbose=False, repo=repo)
+    journaled = load_backup_index(store)[-1]["blob"]
+    os.unlink(vimrc)
+    write(vimrc, "latest\n")
+    latest = backup_file(vimrc, store)
+    # gc may run from anywhere, the journals are looked up next to the store
+    monkeypatch.chdir(tmp_path)
+
+    gc_backups(-1, store)
+
+    assert not os.path.exists(blob_path(dropped, store))
+    assert os.path.exists(blob_path(journaled, store))
+    assert os.path.exists(blob_path(latest, store))
+    assert [entry["blob"] for entry in load_backup_index(store)] == [latest]
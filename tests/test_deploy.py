@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from dotfiles import DotfilesEngine
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("mode", ["hardlink", "reflink", "copy"])
+def test_deploy_modes(repo, home, mode):
+    engine = DotfilesEngine(repo, deploy={None: mode})
+    location = os.path.join(repo, "globals", ".vimrc")
+    target = os.path.join(home, ".vimrc")
+
+    engine.apply(engine.plan(["globals"]))
+
+    assert not os.path.islink(target)
+    assert read(target) == read(location)
+    assert os.path.samefile(target, location) == (mode == "hardlink")
+    assert set(engine.check(["globals"]).values()) == {"linked"}
+
+
+def test_edited_copies_drift_and_are_rolled_back(repo, home):
+    engine = DotfilesEngine(repo, deploy={None: "copy"})
+    target = os.path.join(home, ".vimrc")
+    engine.apply(engine.plan(["globals"]))
+    with open(target, "a") as f:
+        f.write("set paste\n")
+
+    assert engine.check(["globals"])["~/.vimrc"] == "not_linked"
+
+    engine.apply(engine.plan(["globals"]))
+    assert engine.check(["globals"])["~/.vimrc"] == "linked"
+    engine.rollback()
+    assert read(target) == "set number\nset paste\n"
+
+
+def test_deploy_header_wins(repo, home):
+    with open(os.path.join(repo, "globals", ".vimrc"), "w") as f:
+        f.write("\" TARGET=~/.vimrc DEPLOY=copy\n")
+    engine = DotfilesEngine(repo)
+
+    engine.apply(engine.plan(["globals"]))
+
+    assert not os.path.islink(os.path.join(home, ".vimrc"))
+    assert os.path.islink(os.path.join(home, ".bash_aliases"))
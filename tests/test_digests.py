@@ -0,0 +1,55 @@
+import json
+import os
+
+import dotfiles
+from dotfiles import (RENDER_DIR, content_digest, live_digests, load_inventory_cache,
+                      save_inventory_cache, scratch_dir)
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_digests_are_cached_by_stat(repo):
+    location = os.path.join(repo, "globals", ".vimrc")
+    digest = content_digest(location)
+
+    assert dotfiles._DIGEST_CACHE[location][1] == digest
+    write(location, "set nonumber\n")
+    assert content_digest(location) != digest
+
+
+def test_scratch_files_are_not_cached():
+    path = os.path.join(scratch_dir(RENDER_DIR), "globals", ".zshrc")
+    write(path, "rendered by a dry run\n")
+
+    content_digest(path)
+
+    assert path not in dotfiles._DIGEST_CACHE
+
+
+def test_only_live_digests_are_saved(repo, home, tmp_path):
+    location = os.path.join(repo, "globals", ".aliases")
+    target = os.path.join(home, ".bash_aliases")
+    rendered = os.path.join(repo, RENDER_DIR, "globals", ".zshrc")
+    changed = os.path.join(repo, RENDER_DIR, "globals", ".bashrc")
+    other = str(tmp_path / "root" / ".bash_aliases")
+    for path in (target, rendered, changed, other):
+        write(path, "content\n")
+        content_digest(path)
+    content_digest(location)
+    write(changed, "changed since it was hashed\n")
+    entries = {location: (0, 0, 0, 0, "~/.bash_aliases", "globals", None)}
+
+    assert sorted(live_digests(entries, repo)) == sorted([location, target, rendered])
+
+    cache_file = os.path.join(repo, dotfiles.CACHE_FILE)
+    dotignore = os.path.join(repo, ".dotignore")
+    save_inventory_cache(entries, cache_file, dotignore)
+    with open(cache_file) as f:
+        assert sorted(json.load(f)["digests"]) == sorted([location, target, rendered])
+    dotfiles._DIGEST_CACHE.clear()
+    assert load_inventory_cache(cache_file, dotignore) == entries
+    assert sorted(dotfiles._DIGEST_CACHE) == sorted([location, target, rendered])
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from dotfiles import JOURNAL_FILE, DotfilesEngine, DotfilesError
+
+
+@pytest.fixture
+def elsewhere(tmp_path, monkeypatch):
+    """A current dir which is not the repo."""
+
+    cwd = tmp_path / "cwd"
+    cwd.mkdir()
+    monkeypatch.chdir(cwd)
+    return str(cwd)
+
+
+def test_engine_never_changes_the_current_dir(repo, home, elsewhere):
+    engine = DotfilesEngine(repo)
+
+    assert engine.check(["globals"]) == {"~/.vimrc": "missing",
+                                         "~/.bash_aliases": "missing"}
+    engine.apply(engine.plan(["globals"]))
+
+    assert os.getcwd() == elsewhere
+    assert os.listdir(elsewhere) == []
+    assert os.path.exists(os.path.join(repo, JOURNAL_FILE))
+    assert set(engine.check(["globals"]).values()) == {"linked"}
+
+
+def test_engine_rollback(repo, home, elsewhere):
+    with open(os.path.join(home, ".vimrc"), "w") as f:
+        f.write("my own vimrc\n")
+    engine = DotfilesEngine(repo)
+    engine.apply(engine.plan(["globals", "home"]))
+
+    assert len(engine.rollback()) == 3
+
+    assert sorted(os.listdir(home)) == [".vimrc"]
+    with open(os.path.join(home, ".vimrc")) as f:
+        assert f.read() == "my own vimrc\n"
+    with pytest.raises(DotfilesError):
+        engine.rollback()
+
+
+def test_engine_picks_up_changes_on_refresh(repo, home, elsewhere):
+    engine = DotfilesEngine(repo)
+    assert len(engine.scan()) == 3
+    with open(os.path.join(repo, "home", ".tmux.conf"), "w") as f:
+        f.write("set -g mouse on\n")
+
+    engine.refresh()
+
+    assert "~/.tmux.conf" in engine.check(["home"])
+
+
+def test_stale_plans_are_rejected(repo, home, elsewhere):
+    engine = DotfilesEngine(repo)
+    plan = engine.plan(["globals"])
+    with open(os.path.join(home, ".vimrc"), "w") as f:
+        f.write("created after the plan\n")
+
+    with pytest.raises(DotfilesError, match="changed since the plan"):
+        engine.apply(plan)
+
+
+def test_missing_dotignore_raises(tmp_path, elsewhere):
+    (tmp_path / "empty").mkdir()
+
+    with pytest.raises(DotfilesError, match=".dotignore cannot be found"):
+        DotfilesEngine(str(tmp_path / "empty")).refresh()
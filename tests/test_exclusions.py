@@ -0,0 +1,108 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from dotfiles import compile_exclusions
+
+EXCLUSIONS = [
+    "# comment",
+    "",
+    "README.md",
+    "*.swp",
+    "!keep.swp",
+    ".c?nf",
+    "cache/",
+    "/work/.zshrc",
+    "globals/.config/*.json",
+    "docs/**/*.txt",
+    "**/secret",
+    "[ab].ini",
+    "private",
+    "!private/",
+]
+
+PATHS = [
+    "README.md",
+    "home/README.md",
+    "home/.vimrc.swp",
+    "home/keep.swp",
+    "home/.conf",
+    "home/.cnf",
+    "home/.cxnf",
+    "home/cache/.cached",
+    "home/cache.d/.cached",
+    "home/.cache",
+    "work/.zshrc",
+    "home/work/.zshrc",
+    "globals/.config/settings.json",
+    "globals/.config/sub/settings.json",
+    "globals/docs/a.txt",
+    "docs/a.txt",
+    "docs/x/y/a.txt",
+    "home/secret",
+    "home/.config/secret/.token",
+    "home/a.ini",
+    "home/c.ini",
+    "home/private",
+    "globals/private/.token",
+]
+
+
+def git_ignored(repo, path):
+    result = subprocess.run(["git", "check-ignore", "-q", "--no-index", path],
+                            cwd=repo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return result.returncode == 0
+
+
+def walk(repo, is_ignored):
+    """Returns {path: is_dir} of the paths reached walking the repo, without entering
+    the ignored directories, as discover_dotfiles() and git do."""
+
+    reached = {}
+    pending = [""]
+    while pending:
+        directory = pending.pop()
+        for name in sorted(os.listdir(os.path.join(repo, directory))):
+            if name == ".git":
+                continue
+            path = f"{directory}/{name}" if directory else name
+            is_dir = os.path.isdir(os.path.join(repo, path))
+            reached[path] = is_dir
+            if is_dir and not is_ignored(path, is_dir):
+                pending.append(path)
+    return reached
+
+
+@pytest.mark.skipif(not shutil.which("git"), reason="git is not installed")
+def test_matches_git_check_ignore(tmp_path):
+    repo = str(tmp_path)
+    subprocess.run(["git", "init", "-q", repo], check=True)
+    with open(os.path.join(repo, ".gitignore"), "w") as f:
+        f.write("\n".join(EXCLUSIONS) + "\n")
+    for path in PATHS:
+        os.makedirs(os.path.join(repo, os.path.dirname(path)), exist_ok=True)
+        open(os.path.join(repo, path), "w").close()
+    is_excluded = compile_exclusions(EXCLUSIONS)
+
+    expected = {path: git_ignored(repo, path)
+                for path in walk(repo, lambda path, is_dir: git_ignored(repo, path))}
+    found = {path: is_excluded(path, is_dir)
+             for path, is_dir in walk(repo, is_excluded).items()}
+
+    assert found == expected
+
+
+def test_last_entry_wins():
+    is_excluded = compile_exclusions(["*.swp", "!keep.swp", "keep.*"])
+
+    assert is_excluded("home/a.swp")
+    assert is_excluded("home/keep.swp")
+
+
+def test_dir_only_entries_skip_files():
+    is_excluded = compile_exclusions(["cache/"])
+
+    assert is_excluded("home/cache", is_dir=True)
+    assert not is_excluded("home/cache")
@@ -0,0 +1,84 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from dotfiles import read_git_index
+
+pytestmark = pytest.mark.skipif(not shutil.which("git"), reason="git is not installed")
+
+FILES = [
+    ".dotignore",
+    "globals/.vimrc",
+    "globals/.config/Code/User/settings.json",
+    "globals/.config/Code/User/keybindings.json",
+    "home/.zshrc",
+    "home/.zshrc.tmpl",
+    "home/café/.bashrc",
+    "work/" + "x" * 200 + "/.tmux.conf",
+]
+
+
+def git(repo, *args):
+    return subprocess.run(["git", *args], cwd=repo, check=True, stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout
+
+
+def ls_files(repo):
+    """Returns the paths of the index listed by git, without the submodules."""
+
+    paths = []
+    for line in git(repo, "-c", "core.quotePath=false", "ls-files", "--stage",
+                    "-z").split("\0"):
+        if line:
+            info, path = line.split("\t", 1)
+            if not info.startswith("160000"):
+                paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = str(tmp_path)
+    git(repo, "init", "-q")
+    for path in FILES:
+        os.makedirs(os.path.join(repo, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(repo, path), "w") as f:
+            f.write(path)
+    os.symlink(".vimrc", os.path.join(repo, "globals", ".gvimrc"))
+    git(repo, "add", ".")
+    # An intent-to-add entry sets the extended flags of versions 3 and 4
+    open(os.path.join(repo, "home", ".profile"), "w").close()
+    git(repo, "add", "-N", "home/.profile")
+    git(repo, "update-index", "--add", "--cacheinfo", f"160000,{'1' * 40},submodule")
+    return repo
+
+
+@pytest.mark.parametrize("version", [2, 3, 4])
+def test_matches_git_ls_files(repo, version):
+    if version == 2:
+        # Version 2 can't hold the extended flags, git would write version 3
+        git(repo, "rm", "-q", "--cached", "home/.profile")
+    git(repo, "update-index", "--index-version", str(version))
+    index = os.path.join(repo, ".git", "index")
+    with open(index, "rb") as f:
+        assert int.from_bytes(f.read(8)[4:], "big") == version
+
+    paths = read_git_index(index)
+
+    assert paths == ls_files(repo)
+    assert ("home/.profile" in paths) == (version > 2)
+    assert "submodule" not in paths
+
+
+def test_missing_index(tmp_path):
+    assert read_git_index(str(tmp_path / "index")) == []
+
+
+def test_not_an_index(tmp_path):
+    index = tmp_path / "index"
+    index.write_bytes(b"not an index")
+
+    with pytest.raises(ValueError):
+        read_git_index(str(index))
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from dotfiles import (JOURNAL_FILE, apply_symlinks, create_targets, expand_target,
+                      rollback, DotfilesError)
+
+
+def link(repo, *names):
+    """Returns the erroneous_symlinks entries linking ~/<name> to globals/<name>."""
+
+    return [[f"~/{name}", os.path.join(repo, "globals", name), None] for name in names]
+
+
+def test_rollback_restores_replaced_files(repo, home):
+    journal = os.path.join(repo, JOURNAL_FILE)
+    with open(os.path.join(home, ".vimrc"), "w") as f:
+        f.write("my own vimrc\n")
+
+    apply_symlinks(link(repo, ".vimrc", ".aliases"), journal=journal, verbose=False,
+                   repo=repo)
+
+    assert os.readlink(os.path.join(home, ".vimrc")) == os.path.join(repo, "globals",
+                                                                     ".vimrc")
+    assert sorted(rollback(journal, repo, verbose=False)) == [
+        os.path.join(home, ".aliases"), os.path.join(home, ".vimrc")]
+    assert not os.path.islink(os.path.join(home, ".vimrc"))
+    with open(os.path.join(home, ".vimrc")) as f:
+        assert f.read() == "my own vimrc\n"
+    assert not os.path.lexists(os.path.join(home, ".aliases"))
+    assert not os.path.exists(journal)
+
+
+def test_rollback_removes_created_targets(repo, home):
+    journal = os.path.join(repo, JOURNAL_FILE)
+    location = os.path.join(repo, "globals", ".vimrc")
+
+    create_targets([True], ["~/.vimrc"], ["globals"], ["globals"], [location])
+    assert os.path.isfile(expand_target("~/.vimrc"))
+    apply_symlinks(link(repo, ".vimrc"), journal=journal, verbose=False, repo=repo)
+    rollback(journal, repo, verbose=False)
+
+    assert os.listdir(home) == []
+
+
+def test_failed_run_keeps_previous_journal(repo, home):
+    journal = os.path.join(repo, JOURNAL_FILE)
+    apply_symlinks(link(repo, ".vimrc"), journal=journal, verbose=False, repo=repo)
+    with open(journal) as f:
+        previous = f.read()
+    # ~/.aliases/.x can't be created while ~/.aliases is a regular file
+    with open(os.path.join(home, ".aliases"), "w") as f:
+        f.write("not a dir\n")
+    failing = [["~/.aliases/.x", os.path.join(repo, "globals", ".aliases"), None]]
+
+    with pytest.raises(OSError):
+        apply_symlinks(link(repo, ".zshrc") + failing, journal=journal,
+                       verbose=False, repo=repo)
+
+    with open(journal) as f:
+        assert f.read() == previous
+    assert sorted(os.listdir(repo)) == [".dotignore", JOURNAL_FILE, "globals", "home"]
+    # The failed run was undone, the previous one can still be rolled back
+    assert not os.path.lexists(os.path.join(home, ".zshrc"))
+    rollback(journal, repo, verbose=False)
+    assert not os.path.lexists(os.path.join(home, ".vimrc"))
+
+
+def test_rollback_without_journal(repo):
+    with pytest.raises(DotfilesError, match="no run to roll back"):
+        rollback(os.path.join(repo, JOURNAL_FILE), repo)
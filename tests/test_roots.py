@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "dotfiles.py")
+
+
+def run(repo, *args):
+    return subprocess.run([sys.executable, SCRIPT, "--no-color", "--no-cache", *args],
+                          cwd=repo, input="y\n", stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+@pytest.fixture
+def absolute_target(repo, tmp_path):
+    """A dotfile of the globals env with an absolute target outside of the home."""
+
+    target = str(tmp_path / "etc" / "absrc")
+    with open(os.path.join(repo, "globals", ".absrc"), "w") as f:
+        f.write(f"# TARGET={target}\n")
+    return target
+
+
+def test_roots_leave_the_home_untouched(repo, home, tmp_path, absolute_target):
+    roots = [str(tmp_path / "root1"), str(tmp_path / "root2")]
+
+    result = run(repo, "-e", "globals", "--root", *roots)
+
+    assert result.returncode == 0, result.stdout
+    assert os.listdir(home) == []
+    assert not os.path.lexists(absolute_target)
+    for root in roots:
+        assert os.readlink(os.path.join(root, ".vimrc")) == os.path.join(
+            repo, "globals", ".vimrc")
+        # Absolute targets are rebased under the root
+        assert os.readlink(root + absolute_target) == os.path.join(
+            repo, "globals", ".absrc")
+
+
+def test_root_rollback(repo, home, tmp_path):
+    root = str(tmp_path / "root")
+    run(repo, "-e", "globals", "home", "--root", root)
+
+    result = run(repo, "--rollback", "--root", root)
+
+    assert result.returncode == 0, result.stdout
+    assert os.listdir(root) == []
+    assert os.listdir(home) == []
@@ -0,0 +1,84 @@
+import shutil
+import subprocess
+
+import pytest
+
+from dotfiles import scan_shell_line, strip_shell_comments
+
+SCRIPT = """#!/bin/sh
+# A comment
+
+export EDITOR=vim  # trailing comments are kept
+    # An indented comment
+alias ll='ls -l # not a comment'
+echo "a string
+# spanning many lines
+"
+echo 'a single quoted
+# string'
+cat <<EOF
+# kept in the here-document
+
+EOF
+cat <<-'END'
+	# kept with tabs stripped
+	END
+cat <<< "# a here-string"
+# removed
+echo done
+"""
+
+
+def test_strips_comments_and_blank_lines():
+    assert strip_shell_comments(SCRIPT.splitlines()) == [
+        "#!/bin/sh",
+        "export EDITOR=vim  # trailing comments are kept",
+        "alias ll='ls -l # not a comment'",
+        'echo "a string',
+        "# spanning many lines",
+        '"',
+        "echo 'a single quoted",
+        "# string'",
+        "cat <<EOF",
+        "# kept in the here-document",
+        "",
+        "EOF",
+        "cat <<-'END'",
+        "\t# kept with tabs stripped",
+        "\tEND",
+        'cat <<< "# a here-string"',
+        "echo done",
+    ]
+
+
+def test_shebang():
+    assert strip_shell_comments(["#!/bin/sh", "echo"], keep_shebang=False) == ["echo"]
+    # Only the first line can be a shebang
+    assert strip_shell_comments(["echo", "#!/bin/sh"]) == ["echo"]
+
+
+@pytest.mark.parametrize("line, quote, expected", [
+    ("echo 'open", None, ("'", None)),
+    ("closed' more", "'", (None, None)),
+    ('escaped \\" quote', None, (None, None)),
+    ('echo "it\'s"', None, (None, None)),
+    ("echo # 'not a quote", None, (None, None)),
+    ("echo a#'b", None, ("'", None)),
+    ("cat << EOF", None, (None, ("EOF", False))),
+    ('cat <<-"EOF" > file', None, (None, ("EOF", True))),
+    ("cat <<\\EOF", None, (None, ("EOF", False))),
+    ("cat <<< word", None, (None, None)),
+])
+def test_scan_shell_line(line, quote, expected):
+    assert scan_shell_line(line, quote) == expected
+
+
+@pytest.mark.skipif(not shutil.which("bash"), reason="bash is not installed")
+def test_output_unchanged():
+    def run(script):
+        return subprocess.run(["bash"], input=script, stdout=subprocess.PIPE,
+                              universal_newlines=True, check=True).stdout
+
+    stripped = "\n".join(strip_shell_comments(SCRIPT.splitlines())) + "\n"
+
+    assert run(stripped) == run(SCRIPT)
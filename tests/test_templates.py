@@ -0,0 +1,105 @@
+import re
+
+import pytest
+
+from dotfiles import render_template
+
+FACTS = {"os": "darwin", "hostname": "laptop", "work": "", "shell": "zsh"}
+
+
+def render(text, facts=FACTS):
+    used = {}
+    return render_template(text, facts, used), used
+
+
+def test_variables():
+    assert render("host={{ hostname }} {{os}}\n") == (
+        "host=laptop darwin\n", {"hostname": "laptop", "os": "darwin"})
+
+
+def test_unknown_variable():
+    with pytest.raises(ValueError, match="line 2: unknown variable 'user'"):
+        render("a\n{{ user }}\n")
+
+
+def test_branches():
+    text = ('{% if os == "linux" %}\n'
+            "linux\n"
+            '{% elif os == "darwin" %}\n'
+            "darwin\n"
+            "{% else %}\n"
+            "other\n"
+            "{% endif %}\n"
+            "end\n")
+
+    assert render(text) == ("darwin\nend\n", {"os": "darwin"})
+    assert render(text, {"os": "linux"})[0] == "linux\nend\n"
+    assert render(text, {"os": "windows"})[0] == "other\nend\n"
+
+
+def test_block_tags_leave_no_blank_lines():
+    text = ("a\n"
+            "    {% if shell == 'zsh' %}\n"
+            "    zsh\n"
+            "    {% endif %}\n"
+            "b\n")
+
+    assert render(text)[0] == "a\n    zsh\nb\n"
+
+
+def test_inline_tags():
+    assert render("x{% if work %}work{% else %}home{% endif %}x")[0] == "xhomex"
+
+
+@pytest.mark.parametrize("condition, expected", [
+    ("work", False),
+    ("not work", True),
+    ("os != 'linux'", True),
+    ("os == 'darwin' and work", False),
+    ("os == 'darwin' and not work", True),
+    ("work or shell == 'zsh'", True),
+    ("missing", False),
+    ('shell == "zsh or bash"', False),
+    ("shell != 'a and b' and os == 'darwin'", True),
+])
+def test_conditions(condition, expected):
+    text = f"{{% if {condition} %}}yes{{% else %}}no{{% endif %}}"
+
+    assert render(text)[0] == ("yes" if expected else "no")
+
+
+def test_operators_inside_quoted_strings():
+    facts = {"shell": "zsh or bash", "os": "linux"}
+
+    assert render("{% if shell == 'zsh or bash' %}yes{% endif %}", facts)[0] == "yes"
+    assert render('{% if os == "linux" and shell == "zsh or bash" %}yes{% endif %}',
+                  facts)[0] == "yes"
+
+
+def test_nested_blocks():
+    text = ("{% if os == 'darwin' %}\n"
+            "{% if work %}\n"
+            "work\n"
+            "{% else %}\n"
+            "home\n"
+            "{% endif %}\n"
+            "{% else %}\n"
+            "{% if hostname %}\n"
+            "{{ undefined }}\n"
+            "{% endif %}\n"
+            "{% endif %}\n")
+
+    # The variables of the branches not taken are neither required nor used
+    assert render(text) == ("home\n", {"os": "darwin", "work": ""})
+
+
+@pytest.mark.parametrize("text, error", [
+    ("{% if os %}\n", "without {% endif %}"),
+    ("{% endif %}\n", "without {% if %}"),
+    ("{% else %}\n", "without {% if %}"),
+    ("{% for x in y %}\n", "unknown tag 'for'"),
+    ("{% if os = 'x' %}{% endif %}", "invalid condition"),
+])
+def test_errors(text, error):
+    with pytest.raises(ValueError, match=re.escape(error)):
+        render(text)
@@ -0,0 +1,51 @@
+import io
+import json
+import logging
+from collections import deque
+
+import dotfiles
+from dotfiles import TraceDumpHandler, trace
+
+
+class Unformattable:
+    """A field which fails the test if the event is ever formatted."""
+
+    def __repr__(self):
+        raise AssertionError("the trace fields were formatted")
+
+    __str__ = __repr__
+
+
+def test_fields_are_not_formatted_unless_enabled(monkeypatch):
+    monkeypatch.setitem(dotfiles._TRACE, "buffer", deque(maxlen=2))
+
+    for index in range(3):
+        trace("event", index=index, value=Unformattable())
+
+    assert [fields["index"] for _, _, fields in dotfiles._TRACE["buffer"]] == [1, 2]
+
+
+def test_trace_file_gets_json_lines(monkeypatch):
+    trace_file = io.StringIO()
+    monkeypatch.setitem(dotfiles._TRACE, "file", trace_file)
+
+    trace("cache_saved", entries=10, path=object())
+
+    event = json.loads(trace_file.getvalue())
+    assert event["event"] == "cache_saved"
+    assert event["entries"] == 10
+
+
+def test_buffer_is_dumped_once_on_error(monkeypatch, caplog):
+    monkeypatch.setitem(dotfiles._TRACE, "buffer", deque(maxlen=10))
+    trace("before_error", target="~/.vimrc")
+    logger = logging.getLogger("test_trace")
+    logger.addHandler(TraceDumpHandler())
+
+    with caplog.at_level(logging.WARNING, logger="trace"):
+        logger.error("first")
+        logger.error("second")
+
+    dumped = [record.getMessage() for record in caplog.records if record.name == "trace"]
+    assert len(dumped) == 2
+    assert "before_error target='~/.vimrc'" in dumped[1]
@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+
+import dotfiles
+
+
+def fake_changes(*batches):
+    """Replaces watch_changes(): runs each batch, a function returning the changed
+    paths, then stops watching like Ctrl+C."""
+
+    def watch_changes(watch_dirs, skip_dir, watch_files=(), interval=None):
+        for batch in batches:
+            yield batch()
+        raise KeyboardInterrupt
+
+    return watch_changes
+
+
+def test_links_new_dotfiles_and_survives_vanished_ones(repo, home, monkeypatch):
+    monkeypatch.chdir(repo)
+    new = os.path.join(repo, "globals", ".newrc")
+    ghost = os.path.join(repo, "globals", ".ghost")
+    read_header = dotfiles.read_header
+
+    def vanishing_read_header(location):
+        if location == ghost:
+            # Removed between the event and the read
+            raise FileNotFoundError(location)
+        return read_header(location)
+
+    def add_new():
+        with open(new, "w") as f:
+            f.write("# TARGET=~/.newrc\n")
+        return {new}
+
+    def add_ghost():
+        open(ghost, "w").close()
+        return {ghost}
+
+    monkeypatch.setattr(dotfiles, "read_header", vanishing_read_header)
+    monkeypatch.setattr(dotfiles, "watch_changes", fake_changes(add_ghost, add_new))
+
+    dotfiles.watch(["globals"], workers=1)
+
+    assert os.readlink(os.path.join(home, ".newrc")) == new
+    assert os.readlink(os.path.join(home, ".vimrc")) == os.path.join(
+        repo, "globals", ".vimrc")
+    assert not os.path.lexists(os.path.join(home, ".ghost"))
+
+
+@pytest.mark.parametrize("option", [["--root", "/tmp/root"], ["--fold"], ["--compile"],
+                                    ["--discovery", "git"]])
+def test_options_ignored_by_watch_are_rejected(option, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["dotfiles.py", "-e", "globals", "--watch", *option])
+
+    with pytest.raises(SystemExit):
+        dotfiles.parse_arguments()